@@ -1,17 +1,45 @@
-<<<<<<< HEAD
 import os
+import sys
 import asyncio
+import bisect
+import csv
+import gzip
+import io
+import json
 import logging
+import re
+import itertools
+import signal
+import socket
 import sqlite3
-from datetime import datetime
-from typing import List, Tuple, Optional
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, Type
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
+from aiogram.filters.callback_data import CallbackData
+from aiogram.methods import EditMessageText, GetUpdates
+from aiogram.types import (
+    FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, InlineQuery, InlineQueryResultArticle,
+    InputTextMessageContent, Message, CallbackQuery, TelegramObject,
+)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -24,129 +52,2631 @@ if not BOT_TOKEN:
 
 DB_PATH = os.getenv('USERS_DB', '../users.db')
 ADMIN_ID = 8444406750
+# Альтернативный Bot API сервер (локальный stub для тестов или telegram-bot-api)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Роль процесса при запуске с воркерами (WORKERS > 0): супервизор задаёт её дочерним процессам.
+# None — обычный единственный процесс, 'shard' — обработчик апдейтов своих чатов, 'background' — долгие задачи
+WORKER_ROLE = os.getenv('WORKER_ROLE')
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', '0'))
+# Рассылки и сводка изменений крутятся в одном процессе: в единственном или в фоновом воркере №0
+RUNS_BACKGROUND_JOBS = WORKER_ROLE is None or (WORKER_ROLE == 'background' and WORKER_INDEX == 0)
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+logger = logging.getLogger('admin_bot')
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
+# ==================== METRICS ====================
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _prom_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values: Dict[str, float] = {}
+
+    def inc(self, key: str, amount: float = 1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{_prom_label(key)}"}} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series: Dict[str, List[float]] = {}
+
+    def observe(self, key: str, value: float):
+        # [счётчики по бакетам..., +Inf, count, sum]; бакеты не кумулятивные, суммируются при выводе
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def quantile(self, key: str, q: float) -> float:
+        series = self.series.get(key)
+        if not series or not series[-2]:
+            return 0.0
+        rank = q * series[-2]
+        seen = 0
+        lower = 0.0
+        for i, bound in enumerate(self.buckets):
+            count = series[i]
+            if seen + count >= rank and count:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, series in sorted(self.series.items()):
+            label = f'{self.label}="{_prom_label(key)}"'
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += series[i]
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{label}}} {series[-2]}')
+            lines.append(f'{self.name}_sum{{{label}}} {series[-1]}')
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.handler_seconds = Histogram('admin_bot_handler_seconds', 'Время обработки апдейта хендлером', 'handler')
+        self.db_seconds = Histogram('admin_bot_db_query_seconds', 'Время выполнения SQL-запроса', 'query')
+        self.db_rows = Counter('admin_bot_db_rows_total', 'Строк возвращено SQL-запросами', 'query')
+        self.api_seconds = Histogram('admin_bot_api_request_seconds', 'Длительность вызовов Bot API', 'method')
+        self.api_errors = Counter('admin_bot_api_errors_total', 'Ошибки Bot API', 'method')
+        self.api_retry_after = Counter('admin_bot_api_retry_after_total', 'Ответы RetryAfter от Bot API', 'method')
+        self.loop_lag = Histogram('admin_bot_event_loop_lag_seconds', 'Задержка event loop', 'loop')
+        self.render_cache = Counter('admin_bot_render_cache_total', 'Обращения к кэшу рендеринга', 'result')
+        self.outbound_wait = Histogram('admin_bot_outbound_wait_seconds', 'Ожидание в очереди исходящих запросов', 'priority')
+        self.outbound_skipped = Counter('admin_bot_outbound_skipped_total', 'Исходящие запросы, не ушедшие в Telegram', 'reason')
+        self.started = time.time()
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.handler_seconds, self.db_seconds, self.db_rows, self.api_seconds,
+                       self.api_errors, self.api_retry_after, self.loop_lag, self.render_cache,
+                       self.outbound_wait, self.outbound_skipped):
+            lines.extend(metric.render())
+        lines.append('# HELP admin_bot_uptime_seconds Время работы процесса')
+        lines.append('# TYPE admin_bot_uptime_seconds gauge')
+        lines.append(f'admin_bot_uptime_seconds {time.time() - self.started}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def sql_label(sql: str) -> str:
+    return re.sub(r'\s+', ' ', sql).strip()[:80]
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.handler_seconds.observe(name, time.perf_counter() - start)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot: Bot, method):
+        # getUpdates — long polling, его длительность не показательна
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            metrics.api_retry_after.inc(name)
+            raise
+        except TelegramAPIError:
+            metrics.api_errors.inc(name)
+            raise
+        finally:
+            metrics.api_seconds.observe(name, time.perf_counter() - start)
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        metrics.loop_lag.observe('main', max(0.0, loop.time() - start - interval))
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+
+# ==================== DATABASE ====================
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+
+
+# Пул долгоживущих соединений (WAL); запросы выполняются в потоках, не блокируя event loop
+class Database:
+    def __init__(self, path: str, size: int = 4):
+        self.path = path
+        self.size = max(1, size)
+        self._pool: Optional[asyncio.Queue] = None
+        self._conns: List[sqlite3.Connection] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._open_lock = asyncio.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # cached_statements: повторно используем подготовленные выражения внутри соединения
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self._pool is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='db')
+            loop = asyncio.get_running_loop()
+            pool = asyncio.Queue()
+            for _ in range(self.size):
+                conn = await loop.run_in_executor(self._executor, self._connect)
+                self._conns.append(conn)
+                pool.put_nowait(conn)
+            self._pool = pool
+
+    async def close(self):
+        if self._pool is None:
+            return
+        for _ in range(len(self._conns)):
+            conn = await self._pool.get()
+            conn.close()
+        self._conns.clear()
+        self._pool = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        return await self._run(fn.__name__, fn, *args)
+
+    async def _run(self, label: str, fn: Callable[..., Any], *args) -> Any:
+        if self._pool is None:
+            await self.open()
+        pool = self._pool
+        conn = await pool.get()
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(self._executor, partial(fn, conn, *args))
+
+        def release(done: asyncio.Future):
+            # Соединение возвращается в пул только после завершения потока: при отмене ожидающей
+            # задачи (таймаут инлайн-запроса, остановка) поток ещё может работать с conn
+            metrics.db_seconds.observe(label, time.perf_counter() - start)
+            if not done.cancelled():
+                done.exception()
+            pool.put_nowait(conn)
+
+        future.add_done_callback(release)
+        return await asyncio.shield(future)
+
+    async def fetchone(self, sql: str, params: Sequence = ()) -> Optional[sqlite3.Row]:
+        label = sql_label(sql)
+        row = await self._run(label, lambda conn: conn.execute(sql, params).fetchone())
+        metrics.db_rows.inc(label, 1 if row is not None else 0)
+        return row
+
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List[sqlite3.Row]:
+        label = sql_label(sql)
+        rows = await self._run(label, lambda conn: conn.execute(sql, params).fetchall())
+        metrics.db_rows.inc(label, len(rows))
+        return rows
+
+    async def execute(self, sql: str, params: Sequence = ()) -> int:
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self._run(sql_label(sql), _execute)
+
+    async def executescript(self, script: str):
+        def _executescript(conn):
+            conn.executescript(script)
+            conn.commit()
+        await self._run('executescript', _executescript)
+
+
+db = Database(DB_PATH, DB_POOL_SIZE)
+
+# Снимок для тяжёлых чтений: копия БД через backup() в память ('memory') или в отдельный файл.
+# Обновляется раз в SNAPSHOT_INTERVAL секунд или после SNAPSHOT_WRITES записей; пустое значение — читать из основной БД
+SNAPSHOT_MODE = os.getenv('SNAPSHOT', '')
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '60'))
+SNAPSHOT_WRITES = int(os.getenv('SNAPSHOT_WRITES', '500'))
+
+
+class Snapshot:
+    def __init__(self, primary: Database, target: str, interval: float = SNAPSHOT_INTERVAL,
+                 max_writes: int = SNAPSHOT_WRITES):
+        self.primary = primary
+        self.target = target
+        self.interval = interval
+        self.max_writes = max_writes
+        self.taken_at: Optional[float] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending_writes = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.target)
+
+    @property
+    def path(self) -> str:
+        # Файл, который можно открыть отдельным read-only соединением (экспорт)
+        if self.enabled and self.target != 'memory' and self._conn is not None:
+            return self.target
+        return self.primary.path
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        # Один поток: чтения снимка последовательны, и подмена соединения не пересекается с ними
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-snapshot')
+        await self.refresh()
+        self._task = asyncio.create_task(self._loop())
+
+    def _copy(self, src: sqlite3.Connection) -> sqlite3.Connection:
+        if self.target == 'memory':
+            dst = sqlite3.connect(':memory:', check_same_thread=False)
+            src.backup(dst)
+        else:
+            tmp = self.target + '.tmp'
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            dst = sqlite3.connect(tmp)
+            src.backup(dst)
+            # Без WAL копию можно открыть с mode=ro, не создавая -shm
+            dst.execute('PRAGMA journal_mode=DELETE')
+            dst.close()
+            os.replace(tmp, self.target)
+            dst = sqlite3.connect(f'file:{self.target}?mode=ro', uri=True, check_same_thread=False)
+        dst.row_factory = sqlite3.Row
+        return dst
+
+    def _swap(self, conn: sqlite3.Connection):
+        old, self._conn = self._conn, conn
+        if old is not None:
+            old.close()
+
+    async def refresh(self):
+        self._pending_writes = 0
+        start = time.perf_counter()
+        conn = await self.primary.run(self._copy)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._swap, conn)
+        self.taken_at = time.time()
+        # Отрисованные из старого снимка страницы больше не актуальны
+        render_cache.clear()
+        logger.debug('Снимок БД обновлён за %.3f с', time.perf_counter() - start)
+
+    def note_writes(self, n: int = 1):
+        if not self.enabled or n <= 0:
+            return
+        self._pending_writes += n
+        if self._pending_writes >= self.max_writes:
+            self._wake.set()
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.refresh()
+            except sqlite3.Error:
+                logger.exception('Не удалось обновить снимок БД')
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        if self._conn is None:
+            return await self.primary.run(fn, *args)
+        return await self._run(fn.__name__, fn, *args)
+
+    async def _run(self, label: str, fn: Callable[..., Any], *args) -> Any:
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, lambda: fn(self._conn, *args)
+            )
+        finally:
+            metrics.db_seconds.observe(label, time.perf_counter() - start)
+
+    # Метки запросов те же, что у основной базы: /perf сравним со снимком и без него
+    async def fetchone(self, sql: str, params: Sequence = ()) -> Optional[sqlite3.Row]:
+        if self._conn is None:
+            return await self.primary.fetchone(sql, params)
+        label = sql_label(sql)
+        row = await self._run(label, lambda conn: conn.execute(sql, params).fetchone())
+        metrics.db_rows.inc(label, 1 if row is not None else 0)
+        return row
+
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List[sqlite3.Row]:
+        if self._conn is None:
+            return await self.primary.fetchall(sql, params)
+        label = sql_label(sql)
+        rows = await self._run(label, lambda conn: conn.execute(sql, params).fetchall())
+        metrics.db_rows.inc(label, len(rows))
+        return rows
+
+    def caption(self) -> str:
+        if self._conn is None or self.taken_at is None:
+            return ''
+        taken = datetime.fromtimestamp(self.taken_at, timezone.utc).strftime('%H:%M:%S')
+        return f'\n\n🕒 Данные на {taken} UTC (снимок)'
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._executor is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._swap, None)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.taken_at = None
+
+
+snapshot = Snapshot(db, SNAPSHOT_MODE)
+
+# Очередь записи: один писатель на отдельном соединении склеивает ожидающие UPDATE
+# в групповые коммиты, вместо fsync и борьбы за блокировку на каждый оператор
+WRITE_BATCH = int(os.getenv('WRITE_BATCH', '256'))
+WRITE_LINGER = float(os.getenv('WRITE_LINGER_MS', '2')) / 1000
+DURABILITY_LEVELS = ('normal', 'full')
+
+
+class WriteQueue:
+    def __init__(self, path: str, batch: int = WRITE_BATCH, linger: float = WRITE_LINGER):
+        self.path = path
+        self.batch = batch
+        self.linger = linger
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = db._connect()
+        conn.isolation_level = None  # транзакциями управляет _commit_group
+        return conn
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._conn = await asyncio.get_running_loop().run_in_executor(self._executor, self._connect)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def execute(self, sql: str, params: Sequence = (), durability: str = 'normal') -> int:
+        # durability='full' — коммит группы с synchronous=FULL (fsync WAL до ответа),
+        # 'normal' — как у пула: переживает падение процесса, но не питания
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f'Неизвестный режим durability: {durability}')
+        if self._task is None:
+            await self.start()
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((sql, params, durability, fut))
+        return await fut
+
+    def _commit_group(self, items: List[Tuple[str, Sequence, str]]) -> List[Any]:
+        conn = self._conn
+        full = any(d == 'full' for _, _, d in items)
+        if full:
+            conn.execute('PRAGMA synchronous=FULL')
+        results: List[Any] = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for sql, params, _ in items:
+                # Точка сохранения на каждый оператор: ошибка одного не откатывает чужие записи
+                conn.execute('SAVEPOINT w')
+                try:
+                    results.append(conn.execute(sql, params).rowcount)
+                    conn.execute('RELEASE w')
+                except sqlite3.Error as e:
+                    conn.execute('ROLLBACK TO w')
+                    conn.execute('RELEASE w')
+                    results.append(e)
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            if full:
+                conn.execute('PRAGMA synchronous=NORMAL')
+        return results
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            if self.linger and self._queue.empty():
+                await asyncio.sleep(self.linger)
+            group = [first]
+            stop = False
+            while len(group) < self.batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                group.append(item)
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._commit_group, [(sql, params, d) for sql, params, d, _ in group]
+                )
+            except Exception as e:
+                results = [e] * len(group)
+            finally:
+                metrics.db_seconds.observe('write_group', time.perf_counter() - start)
+                metrics.db_rows.inc('write_group', len(group))
+            for (_, _, _, fut), result in zip(group, results):
+                if fut.done():
+                    continue
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+            snapshot.note_writes(sum(r for r in results if isinstance(r, int)))
+            if stop:
+                return
+
+    async def close(self):
+        # Всё, что уже поставлено в очередь, коммитится до закрытия соединения
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._conn.close)
+        self._conn = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+writes = WriteQueue(DB_PATH)
+
+# ==================== FSM STORAGE ====================
+FSM_TTL = int(os.getenv('FSM_TTL', str(7 * 86400)))
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.5'))
+FSM_EVICT_INTERVAL = 600
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))
+
+
+# Состояния FSM в той же SQLite: чтения из write-through кэша в памяти, записи копятся
+# и сбрасываются одной транзакцией раз в FSM_FLUSH_INTERVAL и при остановке.
+# Кэш локален для процесса — при нескольких процессах чат должен всегда обслуживаться одним из них.
+# Кэш — LRU не больше cache_size ключей; промахи (чат без состояния) не кэшируются
+class SQLiteStorage(BaseStorage):
+    def __init__(self, database: Database, ttl: int = FSM_TTL, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 cache_size: int = FSM_CACHE_SIZE):
+        self.db = database
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_destiny=True, with_bot_id=True)
+        self._cache: 'OrderedDict[str, Tuple[Optional[str], Dict[str, Any], float]]' = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_evict = time.monotonic()
+
+    async def _load(self, key: StorageKey) -> Tuple[str, Optional[str], Dict[str, Any]]:
+        k = self.key_builder.build(key)
+        entry = self._cache.get(k)
+        if entry is None:
+            row = await self.db.fetchone('SELECT state, data, expires_at FROM fsm_states WHERE key=?', (k,))
+            # Пока шёл запрос, ключ мог быть записан — свежая запись в кэше важнее
+            entry = self._cache.get(k)
+            if entry is None:
+                if row is None:
+                    return k, None, {}
+                entry = (row['state'], json.loads(row['data']) if row['data'] else {}, row['expires_at'])
+                self._remember(k, entry)
+        else:
+            self._cache.move_to_end(k)
+        state, data, expires_at = entry
+        if expires_at and expires_at < time.time():
+            return k, None, {}
+        return k, state, data
+
+    def _remember(self, k: str, entry: Tuple[Optional[str], Dict[str, Any], float]):
+        self._cache[k] = entry
+        self._cache.move_to_end(k)
+        excess = len(self._cache) - self.cache_size
+        if excess > 0:
+            # Несохранённые записи не вытесняем: flush() берёт их из кэша
+            oldest = itertools.islice(self._cache, excess + len(self._dirty))
+            for old in [key for key in oldest if key not in self._dirty][:excess]:
+                del self._cache[old]
+
+    def _write(self, k: str, state: Optional[str], data: Dict[str, Any]):
+        expires_at = time.time() + self.ttl if (state is not None or data) else 0
+        self._dirty.add(k)
+        self._remember(k, (state, data, expires_at))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, _, data = await self._load(key)
+        self._write(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k, state, _ = await self._load(key)
+        self._write(k, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, _, data = await self._load(key)
+        return dict(data)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        # Ключи снимаются с «грязных» только после успешной записи: сбой сериализации
+        # или записи оставляет их на следующий flush()
+        keys = set(self._dirty)
+        upserts, deletes = [], []
+        for k in keys:
+            state, data, expires_at = self._cache.get(k, (None, {}, 0))
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), int(expires_at)))
+
+        def _flush_states(conn):
+            with conn:
+                conn.executemany(
+                    'INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, expires_at=excluded.expires_at',
+                    upserts
+                )
+                conn.executemany('DELETE FROM fsm_states WHERE key=?', deletes)
+        # Записанное во время ожидания снова попадёт в _dirty через _write
+        self._dirty -= keys
+        try:
+            await self.db.run(_flush_states)
+        except BaseException:
+            self._dirty |= keys
+            raise
+        # Удалённое состояние равносильно промаху — держать его в кэше незачем
+        for (k,) in deletes:
+            if k not in self._dirty and self._cache.get(k, (None, None, 0))[:2] == (None, {}):
+                del self._cache[k]
+
+    async def evict_expired(self):
+        now = time.time()
+        for k, (_, _, expires_at) in list(self._cache.items()):
+            if expires_at and expires_at < now and k not in self._dirty:
+                del self._cache[k]
+        await self.db.execute('DELETE FROM fsm_states WHERE expires_at > 0 AND expires_at < ?', (int(now),))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_evict > FSM_EVICT_INTERVAL:
+                    self._last_evict = time.monotonic()
+                    await self.evict_expired()
+            except (sqlite3.Error, TypeError, ValueError):
+                logger.exception('FSM: не удалось сохранить состояния, повтор через %s с', self.flush_interval)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+
+fsm_storage = SQLiteStorage(db)
+dp = Dispatcher(storage=fsm_storage)
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.inline_query.middleware(HandlerMetricsMiddleware())
 
 # ==================== DATABASE FUNCTIONS ====================
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def ensure_users_table():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            registered INTEGER DEFAULT 0,
-            reg_date TEXT,
-            deposit_amount REAL DEFAULT 0,
-            deposit_confirmed INTEGER DEFAULT 0,
-            deposit_date TEXT,
-            trader_id TEXT,
-            click_id TEXT
+USERS_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    registered INTEGER DEFAULT 0,
+    reg_date TEXT,
+    deposit_amount REAL DEFAULT 0,
+    deposit_confirmed INTEGER DEFAULT 0,
+    deposit_date TEXT,
+    trader_id TEXT,
+    click_id TEXT
+);
+"""
+
+# Агрегаты для дашборда поддерживаются триггерами, поэтому /stats читает одну строку
+STATS_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS users_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    total INTEGER NOT NULL DEFAULT 0,
+    registered INTEGER NOT NULL DEFAULT 0,
+    deposited INTEGER NOT NULL DEFAULT 0,
+    deposit_sum REAL NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS users_stats_ai AFTER INSERT ON users BEGIN
+    UPDATE users_stats SET
+        total = total + 1,
+        registered = registered + (NEW.registered = 1),
+        deposited = deposited + (NEW.deposit_confirmed = 1),
+        deposit_sum = deposit_sum + CASE WHEN NEW.deposit_confirmed = 1 THEN COALESCE(NEW.deposit_amount, 0) ELSE 0 END
+    WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_stats_ad AFTER DELETE ON users BEGIN
+    UPDATE users_stats SET
+        total = total - 1,
+        registered = registered - (OLD.registered = 1),
+        deposited = deposited - (OLD.deposit_confirmed = 1),
+        deposit_sum = deposit_sum - CASE WHEN OLD.deposit_confirmed = 1 THEN COALESCE(OLD.deposit_amount, 0) ELSE 0 END
+    WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_stats_au AFTER UPDATE OF registered, deposit_confirmed, deposit_amount ON users BEGIN
+    UPDATE users_stats SET
+        registered = registered - (OLD.registered = 1) + (NEW.registered = 1),
+        deposited = deposited - (OLD.deposit_confirmed = 1) + (NEW.deposit_confirmed = 1),
+        deposit_sum = deposit_sum
+            - CASE WHEN OLD.deposit_confirmed = 1 THEN COALESCE(OLD.deposit_amount, 0) ELSE 0 END
+            + CASE WHEN NEW.deposit_confirmed = 1 THEN COALESCE(NEW.deposit_amount, 0) ELSE 0 END
+    WHERE id = 1;
+END;
+"""
+
+# Триграммный FTS5-индекс для поиска по подстроке; синхронизируется с users триггерами
+SEARCH_SCHEMA_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    user_id, username, trader_id, click_id,
+    content='users', content_rowid='user_id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+    INSERT INTO users_fts(rowid, user_id, username, trader_id, click_id)
+    VALUES (NEW.user_id, NEW.user_id, NEW.username, NEW.trader_id, NEW.click_id);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+    INSERT INTO users_fts(users_fts, rowid, user_id, username, trader_id, click_id)
+    VALUES ('delete', OLD.user_id, OLD.user_id, OLD.username, OLD.trader_id, OLD.click_id);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF user_id, username, trader_id, click_id ON users BEGIN
+    INSERT INTO users_fts(users_fts, rowid, user_id, username, trader_id, click_id)
+    VALUES ('delete', OLD.user_id, OLD.user_id, OLD.username, OLD.trader_id, OLD.click_id);
+    INSERT INTO users_fts(rowid, user_id, username, trader_id, click_id)
+    VALUES (NEW.user_id, NEW.user_id, NEW.username, NEW.trader_id, NEW.click_id);
+END;
+"""
+
+BROADCAST_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    chat_id INTEGER,
+    message_id INTEGER,
+    created_at TEXT,
+    finished_at TEXT
+);
+"""
+
+STATS_RECOMPUTE_SQL = (
+    'SELECT COUNT(*), '
+    'COALESCE(SUM(registered=1), 0), '
+    'COALESCE(SUM(deposit_confirmed=1), 0), '
+    'COALESCE(SUM(deposits_total), 0), '
+    'COALESCE(SUM(deposits_count >= 2), 0) '
+    'FROM users'
+)
+
+# click_id становится уникальным. Данные миграция не меняет: при повторах _migrate останавливает
+# запуск со списком конфликтов, разрешить их (чей click_id верный) должен оператор
+INDEXES_SQL = """
+DROP INDEX IF EXISTS idx_users_click_id;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_click_id ON users(click_id) WHERE click_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_users_trader_id ON users(trader_id);
+CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_users_deposit_confirmed ON users(deposit_date, deposit_amount) WHERE deposit_confirmed = 1;
+CREATE INDEX IF NOT EXISTS idx_users_registered ON users(user_id) WHERE registered = 1;
+"""
+
+# Даты хранятся строками (основной бот пишет их сам), а триггеры приводят их к epoch-секундам
+# в reg_ts/deposit_ts; по ним же ведутся дневные роллапы daily_stats (день = ts / 86400, UTC)
+# Версия до журнала депозитов — часть миграции 3, не менять
+DAILY_REBUILD_V3_SQL = """
+DELETE FROM daily_stats;
+INSERT INTO daily_stats (day, registrations, deposits, deposit_sum)
+SELECT day, SUM(r), SUM(d), SUM(amount) FROM (
+    SELECT reg_ts / 86400 AS day, 1 AS r, 0 AS d, 0 AS amount FROM users WHERE registered = 1 AND reg_ts IS NOT NULL
+    UNION ALL
+    SELECT deposit_ts / 86400, 0, 1, COALESCE(deposit_amount, 0) FROM users WHERE deposit_confirmed = 1 AND deposit_ts IS NOT NULL
+) GROUP BY day;
+"""
+
+TIMESERIES_SQL = """
+ALTER TABLE users ADD COLUMN reg_ts INTEGER;
+ALTER TABLE users ADD COLUMN deposit_ts INTEGER;
+UPDATE users SET reg_ts = CAST(strftime('%s', reg_date) AS INTEGER) WHERE reg_date IS NOT NULL;
+UPDATE users SET deposit_ts = CAST(strftime('%s', deposit_date) AS INTEGER) WHERE deposit_date IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_users_reg_ts ON users(reg_ts);
+CREATE INDEX IF NOT EXISTS idx_users_deposit_ts ON users(deposit_ts) WHERE deposit_confirmed = 1;
+
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day INTEGER PRIMARY KEY,
+    registrations INTEGER NOT NULL DEFAULT 0,
+    deposits INTEGER NOT NULL DEFAULT 0,
+    deposit_sum REAL NOT NULL DEFAULT 0
+);
+""" + DAILY_REBUILD_V3_SQL + """
+CREATE TRIGGER IF NOT EXISTS users_ts_ai AFTER INSERT ON users
+WHEN (NEW.reg_date IS NOT NULL AND NEW.reg_ts IS NULL) OR (NEW.deposit_date IS NOT NULL AND NEW.deposit_ts IS NULL)
+BEGIN
+    UPDATE users SET
+        reg_ts = COALESCE(reg_ts, CAST(strftime('%s', reg_date) AS INTEGER)),
+        deposit_ts = COALESCE(deposit_ts, CAST(strftime('%s', deposit_date) AS INTEGER))
+    WHERE user_id = NEW.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS users_reg_ts_au AFTER UPDATE OF reg_date ON users
+WHEN NEW.reg_ts IS NOT CAST(strftime('%s', NEW.reg_date) AS INTEGER)
+BEGIN
+    UPDATE users SET reg_ts = CAST(strftime('%s', NEW.reg_date) AS INTEGER) WHERE user_id = NEW.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS users_deposit_ts_au AFTER UPDATE OF deposit_date ON users
+WHEN NEW.deposit_ts IS NOT CAST(strftime('%s', NEW.deposit_date) AS INTEGER)
+BEGIN
+    UPDATE users SET deposit_ts = CAST(strftime('%s', NEW.deposit_date) AS INTEGER) WHERE user_id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS daily_stats_ai AFTER INSERT ON users BEGIN
+    INSERT INTO daily_stats (day, registrations)
+    SELECT NEW.reg_ts / 86400, 1 WHERE NEW.registered = 1 AND NEW.reg_ts IS NOT NULL
+    ON CONFLICT(day) DO UPDATE SET registrations = registrations + 1;
+    INSERT INTO daily_stats (day, deposits, deposit_sum)
+    SELECT NEW.deposit_ts / 86400, 1, COALESCE(NEW.deposit_amount, 0) WHERE NEW.deposit_confirmed = 1 AND NEW.deposit_ts IS NOT NULL
+    ON CONFLICT(day) DO UPDATE SET deposits = deposits + 1, deposit_sum = deposit_sum + excluded.deposit_sum;
+END;
+CREATE TRIGGER IF NOT EXISTS daily_stats_ad AFTER DELETE ON users BEGIN
+    UPDATE daily_stats SET registrations = registrations - 1
+    WHERE day = OLD.reg_ts / 86400 AND OLD.registered = 1;
+    UPDATE daily_stats SET deposits = deposits - 1, deposit_sum = deposit_sum - COALESCE(OLD.deposit_amount, 0)
+    WHERE day = OLD.deposit_ts / 86400 AND OLD.deposit_confirmed = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS daily_stats_reg_au AFTER UPDATE OF registered, reg_ts ON users
+WHEN OLD.registered IS NOT NEW.registered OR OLD.reg_ts IS NOT NEW.reg_ts
+BEGIN
+    UPDATE daily_stats SET registrations = registrations - 1
+    WHERE day = OLD.reg_ts / 86400 AND OLD.registered = 1;
+    INSERT INTO daily_stats (day, registrations)
+    SELECT NEW.reg_ts / 86400, 1 WHERE NEW.registered = 1 AND NEW.reg_ts IS NOT NULL
+    ON CONFLICT(day) DO UPDATE SET registrations = registrations + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS daily_stats_dep_au AFTER UPDATE OF deposit_confirmed, deposit_ts, deposit_amount ON users
+WHEN OLD.deposit_confirmed IS NOT NEW.deposit_confirmed OR OLD.deposit_ts IS NOT NEW.deposit_ts
+    OR OLD.deposit_amount IS NOT NEW.deposit_amount
+BEGIN
+    UPDATE daily_stats SET deposits = deposits - 1, deposit_sum = deposit_sum - COALESCE(OLD.deposit_amount, 0)
+    WHERE day = OLD.deposit_ts / 86400 AND OLD.deposit_confirmed = 1;
+    INSERT INTO daily_stats (day, deposits, deposit_sum)
+    SELECT NEW.deposit_ts / 86400, 1, COALESCE(NEW.deposit_amount, 0) WHERE NEW.deposit_confirmed = 1 AND NEW.deposit_ts IS NOT NULL
+    ON CONFLICT(day) DO UPDATE SET deposits = deposits + 1, deposit_sum = deposit_sum + excluded.deposit_sum;
+END;
+"""
+
+FSM_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT,
+    expires_at INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states(expires_at) WHERE expires_at > 0;
+"""
+
+# Журнал изменений users: только дописывается, seq монотонен (AUTOINCREMENT не переиспользует номера)
+CHANGES_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS user_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    amount REAL,
+    ts INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+CREATE TABLE IF NOT EXISTS feed_state (
+    name TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS user_changes_ai AFTER INSERT ON users BEGIN
+    INSERT INTO user_changes (user_id, kind) VALUES (NEW.user_id, 'new');
+    INSERT INTO user_changes (user_id, kind) SELECT NEW.user_id, 'registration' WHERE NEW.registered = 1;
+    INSERT INTO user_changes (user_id, kind, amount)
+    SELECT NEW.user_id, 'deposit', COALESCE(NEW.deposit_amount, 0) WHERE NEW.deposit_confirmed = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS user_changes_ad AFTER DELETE ON users BEGIN
+    INSERT INTO user_changes (user_id, kind) VALUES (OLD.user_id, 'delete');
+END;
+CREATE TRIGGER IF NOT EXISTS user_changes_reg_au AFTER UPDATE OF registered ON users
+WHEN NEW.registered = 1 AND OLD.registered IS NOT 1
+BEGIN
+    INSERT INTO user_changes (user_id, kind) VALUES (NEW.user_id, 'registration');
+END;
+CREATE TRIGGER IF NOT EXISTS user_changes_dep_au AFTER UPDATE OF deposit_confirmed, deposit_amount ON users
+WHEN NEW.deposit_confirmed = 1 AND (OLD.deposit_confirmed IS NOT 1 OR OLD.deposit_amount IS NOT NEW.deposit_amount)
+BEGIN
+    INSERT INTO user_changes (user_id, kind, amount)
+    SELECT NEW.user_id, 'deposit', COALESCE(NEW.deposit_amount, 0) WHERE OLD.deposit_confirmed IS NOT 1;
+    INSERT INTO user_changes (user_id, kind, amount)
+    SELECT NEW.user_id, 'deposit_change', COALESCE(NEW.deposit_amount, 0) - COALESCE(OLD.deposit_amount, 0)
+    WHERE OLD.deposit_confirmed = 1;
+END;
+"""
+
+SEGMENTS_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    expr TEXT NOT NULL UNIQUE,
+    member_count INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER NOT NULL DEFAULT 0,
+    anchor INTEGER NOT NULL DEFAULT 0,
+    refreshed_at INTEGER NOT NULL DEFAULT 0,
+    used_at INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS segment_members (
+    segment_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (segment_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_users_deposit_amount ON users(deposit_amount) WHERE deposit_confirmed = 1;
+ALTER TABLE broadcast_jobs ADD COLUMN segment_id INTEGER;
+
+-- Сегменты пересчитываются по журналу изменений, поэтому в него попадают и отмены, и смена дат
+CREATE TRIGGER IF NOT EXISTS user_changes_au AFTER UPDATE OF registered, deposit_confirmed, reg_ts, deposit_ts ON users
+WHEN (OLD.registered = 1 AND NEW.registered IS NOT 1) OR (OLD.deposit_confirmed = 1 AND NEW.deposit_confirmed IS NOT 1)
+    OR (OLD.reg_ts IS NOT NULL AND OLD.reg_ts IS NOT NEW.reg_ts)
+    OR (OLD.deposit_ts IS NOT NULL AND OLD.deposit_ts IS NOT NEW.deposit_ts)
+BEGIN
+    INSERT INTO user_changes (user_id, kind) VALUES (NEW.user_id, 'update');
+END;
+"""
+
+DAILY_REBUILD_SQL = """
+DELETE FROM daily_stats;
+INSERT INTO daily_stats (day, registrations, deposits, deposit_sum)
+SELECT day, SUM(r), SUM(d), SUM(amount) FROM (
+    SELECT reg_ts / 86400 AS day, 1 AS r, 0 AS d, 0 AS amount FROM users WHERE registered = 1 AND reg_ts IS NOT NULL
+    UNION ALL
+    SELECT ts / 86400, 0, 1, amount FROM deposits
+) GROUP BY day;
+"""
+
+# Журнал депозитов: только дописывается. Триггер на вставку обновляет последний депозит
+# и накопительные deposits_total/deposits_count в users, дневной роллап и журнал изменений;
+# агрегаты users_stats и daily_stats по деньгам теперь считаются от журнала, а не от deposit_amount
+DEPOSITS_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS deposits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    ts INTEGER NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_deposits_user_ts ON deposits(user_id, ts);
+CREATE INDEX IF NOT EXISTS idx_deposits_ts ON deposits(ts);
+ALTER TABLE users ADD COLUMN deposits_total REAL NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN deposits_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users_stats ADD COLUMN repeat_users INTEGER NOT NULL DEFAULT 0;
+
+INSERT INTO deposits (user_id, amount, ts, source)
+SELECT user_id, COALESCE(deposit_amount, 0), COALESCE(deposit_ts, reg_ts, CAST(strftime('%s', 'now') AS INTEGER)), 'migration'
+FROM users WHERE deposit_confirmed = 1 ORDER BY user_id;
+UPDATE users SET deposits_total = COALESCE(deposit_amount, 0), deposits_count = 1 WHERE deposit_confirmed = 1;
+
+DROP TRIGGER IF EXISTS users_stats_ai;
+DROP TRIGGER IF EXISTS users_stats_ad;
+DROP TRIGGER IF EXISTS users_stats_au;
+CREATE TRIGGER users_stats_ai AFTER INSERT ON users BEGIN
+    UPDATE users_stats SET
+        total = total + 1,
+        registered = registered + (NEW.registered = 1),
+        deposited = deposited + (NEW.deposit_confirmed = 1),
+        deposit_sum = deposit_sum + NEW.deposits_total,
+        repeat_users = repeat_users + (NEW.deposits_count >= 2)
+    WHERE id = 1;
+END;
+CREATE TRIGGER users_stats_ad AFTER DELETE ON users BEGIN
+    UPDATE users_stats SET
+        total = total - 1,
+        registered = registered - (OLD.registered = 1),
+        deposited = deposited - (OLD.deposit_confirmed = 1),
+        deposit_sum = deposit_sum - OLD.deposits_total,
+        repeat_users = repeat_users - (OLD.deposits_count >= 2)
+    WHERE id = 1;
+END;
+CREATE TRIGGER users_stats_au AFTER UPDATE OF registered, deposit_confirmed, deposits_total, deposits_count ON users BEGIN
+    UPDATE users_stats SET
+        registered = registered - (OLD.registered = 1) + (NEW.registered = 1),
+        deposited = deposited - (OLD.deposit_confirmed = 1) + (NEW.deposit_confirmed = 1),
+        deposit_sum = deposit_sum - OLD.deposits_total + NEW.deposits_total,
+        repeat_users = repeat_users - (OLD.deposits_count >= 2) + (NEW.deposits_count >= 2)
+    WHERE id = 1;
+END;
+
+DROP TRIGGER IF EXISTS daily_stats_ai;
+DROP TRIGGER IF EXISTS daily_stats_ad;
+DROP TRIGGER IF EXISTS daily_stats_dep_au;
+CREATE TRIGGER daily_stats_ai AFTER INSERT ON users BEGIN
+    INSERT INTO daily_stats (day, registrations)
+    SELECT NEW.reg_ts / 86400, 1 WHERE NEW.registered = 1 AND NEW.reg_ts IS NOT NULL
+    ON CONFLICT(day) DO UPDATE SET registrations = registrations + 1;
+END;
+CREATE TRIGGER daily_stats_ad AFTER DELETE ON users BEGIN
+    UPDATE daily_stats SET registrations = registrations - 1
+    WHERE day = OLD.reg_ts / 86400 AND OLD.registered = 1;
+END;
+DROP TRIGGER IF EXISTS user_changes_dep_au;
+
+CREATE TRIGGER deposits_ai AFTER INSERT ON deposits BEGIN
+    UPDATE users SET
+        deposit_confirmed = 1,
+        deposit_amount = CASE WHEN NEW.ts >= COALESCE(deposit_ts, 0) THEN NEW.amount ELSE deposit_amount END,
+        deposit_date = CASE WHEN NEW.ts >= COALESCE(deposit_ts, 0) THEN datetime(NEW.ts, 'unixepoch') ELSE deposit_date END,
+        deposits_total = deposits_total + NEW.amount,
+        deposits_count = deposits_count + 1
+    WHERE user_id = NEW.user_id;
+    INSERT INTO daily_stats (day, deposits, deposit_sum) VALUES (NEW.ts / 86400, 1, NEW.amount)
+    ON CONFLICT(day) DO UPDATE SET deposits = deposits + 1, deposit_sum = deposit_sum + excluded.deposit_sum;
+    INSERT INTO user_changes (user_id, kind, amount) VALUES (NEW.user_id, 'deposit', NEW.amount);
+END;
+CREATE TRIGGER deposits_bu BEFORE UPDATE ON deposits BEGIN
+    SELECT RAISE(ABORT, 'deposits: журнал только дописывается');
+END;
+CREATE TRIGGER deposits_bd BEFORE DELETE ON deposits BEGIN
+    SELECT RAISE(ABORT, 'deposits: журнал только дописывается');
+END;
+""" + DAILY_REBUILD_SQL + """
+UPDATE users_stats SET
+    deposit_sum = (SELECT COALESCE(SUM(deposits_total), 0) FROM users),
+    repeat_users = (SELECT COALESCE(SUM(deposits_count >= 2), 0) FROM users)
+WHERE id = 1;
+"""
+
+# Записи в users в обход confirm_deposit (другой процесс, ручной SQL) тоже попадают в журнал депозитов:
+# подтверждение или новая сумма — новая запись, как при повторном confirm_deposit. Обновления самого
+# deposits_ai меняют deposits_count и потому сюда не попадают. Событие 'deposit' в user_changes
+# теперь пишет только deposits_ai, поэтому user_changes_ai пересоздаётся без него
+DEPOSITS_SYNC_SQL = """
+DROP TRIGGER IF EXISTS user_changes_ai;
+CREATE TRIGGER user_changes_ai AFTER INSERT ON users BEGIN
+    INSERT INTO user_changes (user_id, kind) VALUES (NEW.user_id, 'new');
+    INSERT INTO user_changes (user_id, kind) SELECT NEW.user_id, 'registration' WHERE NEW.registered = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_deposit_ai AFTER INSERT ON users
+WHEN NEW.deposit_confirmed = 1 AND NEW.deposits_count = 0
+BEGIN
+    INSERT INTO deposits (user_id, amount, ts, source) VALUES (
+        NEW.user_id, COALESCE(NEW.deposit_amount, 0),
+        COALESCE(CAST(strftime('%s', NEW.deposit_date) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+        'direct'
+    );
+END;
+CREATE TRIGGER IF NOT EXISTS users_deposit_au AFTER UPDATE OF deposit_confirmed, deposit_amount ON users
+WHEN NEW.deposit_confirmed = 1 AND NEW.deposits_count = OLD.deposits_count
+    AND (OLD.deposit_confirmed IS NOT 1 OR OLD.deposit_amount IS NOT NEW.deposit_amount)
+BEGIN
+    INSERT INTO deposits (user_id, amount, ts, source) VALUES (
+        NEW.user_id, COALESCE(NEW.deposit_amount, 0),
+        COALESCE(
+            CASE WHEN NEW.deposit_date IS NOT OLD.deposit_date THEN CAST(strftime('%s', NEW.deposit_date) AS INTEGER) END,
+            CAST(strftime('%s', 'now') AS INTEGER)
+        ),
+        'direct'
+    );
+END;
+-- Подтверждённые после миграции 7 в обход журнала
+INSERT INTO deposits (user_id, amount, ts, source)
+SELECT user_id, COALESCE(deposit_amount, 0), COALESCE(deposit_ts, CAST(strftime('%s', 'now') AS INTEGER)), 'migration'
+FROM users WHERE deposit_confirmed = 1 AND deposits_count = 0;
+"""
+
+# Миграции применяются по порядку, номер последней хранится в PRAGMA user_version.
+# Каждая выполняется в своей транзакции; SQL должен быть идемпотентным для баз, созданных до миграций.
+MIGRATIONS: List[Tuple[int, str]] = [
+    (1, USERS_SCHEMA_SQL + STATS_SCHEMA_SQL + SEARCH_SCHEMA_SQL + BROADCAST_SCHEMA_SQL),
+    (2, INDEXES_SQL),
+    (3, TIMESERIES_SQL),
+    (4, FSM_SCHEMA_SQL),
+    (5, CHANGES_SCHEMA_SQL),
+    (6, SEGMENTS_SCHEMA_SQL),
+    (7, DEPOSITS_SCHEMA_SQL),
+    (8, DEPOSITS_SYNC_SQL),
+]
+
+def _check_duplicate_click_ids(conn: sqlite3.Connection):
+    rows = conn.execute(
+        'SELECT click_id, GROUP_CONCAT(user_id) FROM users WHERE click_id IS NOT NULL '
+        'GROUP BY click_id HAVING COUNT(*) > 1 ORDER BY click_id'
+    ).fetchall()
+    if rows:
+        listed = '; '.join(f'{r[0]}: {r[1]}' for r in rows[:20]) + (' …' if len(rows) > 20 else '')
+        raise RuntimeError(
+            f'Миграция 2 не применена: {len(rows)} click_id принадлежат нескольким пользователям '
+            f'(click_id: user_id, …): {listed}. Оставьте каждый click_id одному пользователю и перезапустите бота'
         )
-        """
-    )
-    conn.commit()
-    conn.close()
-
-def stats() -> Tuple[int, int, int, float]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT COUNT(*) FROM users')
-    total = cur.fetchone()[0]
-    cur.execute('SELECT COUNT(*) FROM users WHERE registered=1')
-    registered = cur.fetchone()[0]
-    cur.execute('SELECT COUNT(*) FROM users WHERE deposit_confirmed=1')
-    deposited = cur.fetchone()[0]
-    cur.execute('SELECT SUM(deposit_amount) FROM users WHERE deposit_confirmed=1')
-    s = cur.fetchone()[0]
+
+def _migrate(conn: sqlite3.Connection) -> List[int]:
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    applied = []
+    for version, sql in MIGRATIONS:
+        if version <= current:
+            continue
+        if version == 2:
+            _check_duplicate_click_ids(conn)
+        try:
+            conn.executescript(f'BEGIN;\n{sql}\nPRAGMA user_version = {version};\nCOMMIT;')
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise RuntimeError(f'Миграция {version} не применена: {e}') from e
+        applied.append(version)
+    return applied
+
+async def ensure_users_table():
+    fts_exists = await db.fetchone("SELECT 1 FROM sqlite_master WHERE name='users_fts'")
+    applied = await db.run(_migrate)
+    if applied:
+        logger.info('Применены миграции БД: %s', ', '.join(map(str, applied)))
+    if await db.fetchone('SELECT 1 FROM users_stats WHERE id=1') is None:
+        await rebuild_stats()
+    if not fts_exists:
+        await rebuild_search_index()
+
+async def stats() -> Tuple[int, int, int, float]:
+    row = await snapshot.fetchone('SELECT total, registered, deposited, deposit_sum FROM users_stats WHERE id=1')
+    if row is None:
+        await rebuild_stats()
+        row = await db.fetchone('SELECT total, registered, deposited, deposit_sum FROM users_stats WHERE id=1')
+    total, registered, deposited, s = row
     total_deposits = float(s) if s is not None else 0.0
-    conn.close()
     return total, registered, deposited, total_deposits
 
-def fetch_users(offset: int = 0, limit: int = 10) -> List[sqlite3.Row]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT user_id, username, registered FROM users ORDER BY user_id LIMIT ? OFFSET ?', (limit, offset))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def fetch_user(user_identifier: str) -> Optional[sqlite3.Row]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM users WHERE user_id=?', (user_identifier,))
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return row
-    cur.execute('SELECT * FROM users WHERE username=?', (user_identifier,))
-    row = cur.fetchone()
-    conn.close()
-    return row
-
-def search_users(query: str, offset: int = 0, limit: int = 10) -> List[sqlite3.Row]:
-    q = f"%{query}%"
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        'SELECT user_id, username, registered FROM users WHERE CAST(user_id AS TEXT) LIKE ? OR username LIKE ? OR trader_id LIKE ? ORDER BY user_id LIMIT ? OFFSET ?',
-        (q, q, q, limit, offset)
+def _rebuild_stats(conn: sqlite3.Connection) -> Tuple[Optional[tuple], tuple]:
+    with conn:
+        old = conn.execute('SELECT total, registered, deposited, deposit_sum, repeat_users FROM users_stats WHERE id=1').fetchone()
+        fresh = conn.execute(STATS_RECOMPUTE_SQL).fetchone()
+        conn.execute(
+            'INSERT OR REPLACE INTO users_stats (id, total, registered, deposited, deposit_sum, repeat_users) '
+            'VALUES (1, ?, ?, ?, ?, ?)',
+            tuple(fresh)
+        )
+        for statement in DAILY_REBUILD_SQL.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+    return (tuple(old) if old else None), tuple(fresh)
+
+async def rebuild_stats() -> Tuple[Optional[tuple], tuple]:
+    # Полный пересчёт агрегатов; возвращает (было, стало) для проверки согласованности
+    return await db.run(_rebuild_stats)
+
+STATS_PERIODS = {'today': ('Сегодня', 1), '7d': ('7 дней', 7), '30d': ('30 дней', 30)}
+
+async def period_stats(days: int) -> Tuple[int, int, float]:
+    # Не более `days` строк роллапа, независимо от размера users
+    today = int(time.time()) // 86400
+    row = await snapshot.fetchone(
+        'SELECT COALESCE(SUM(registrations), 0), COALESCE(SUM(deposits), 0), COALESCE(SUM(deposit_sum), 0) '
+        'FROM daily_stats WHERE day > ? AND day <= ?',
+        (today - days, today)
+    )
+    return row[0], row[1], float(row[2])
+
+async def repeat_deposit_stats(days: Optional[int] = None) -> Tuple[int, float]:
+    # Повторные депозиты за период: у пользователя есть более ранняя запись журнала.
+    # Диапазон по idx_deposits_ts и проверка по idx_deposits_user_ts — без скана users
+    since = (int(time.time()) // 86400 - days + 1) * 86400 if days else 0
+    row = await snapshot.fetchone(
+        'SELECT COUNT(*), COALESCE(SUM(d.amount), 0) FROM deposits d WHERE d.ts >= ? AND EXISTS ('
+        'SELECT 1 FROM deposits p WHERE p.user_id = d.user_id AND (p.ts < d.ts OR (p.ts = d.ts AND p.id < d.id)))',
+        (since,)
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def confirm_registration(user_id: int) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('UPDATE users SET registered=1 WHERE user_id=?', (user_id,))
-    conn.commit()
-    updated = cur.rowcount
-    conn.close()
+    return row[0], float(row[1])
+
+async def repeat_users_count() -> int:
+    row = await snapshot.fetchone('SELECT repeat_users FROM users_stats WHERE id=1')
+    return row[0] if row else 0
+
+USER_DEPOSITS_HISTORY = 5
+
+async def fetch_deposit_history(user_id: int, limit: int = USER_DEPOSITS_HISTORY) -> List[sqlite3.Row]:
+    return await db.fetchall('SELECT amount, ts FROM deposits WHERE user_id=? ORDER BY ts DESC, id DESC LIMIT ?',
+                             (user_id, limit))
+
+def utc_now_str() -> str:
+    # Тот же формат, что и у CURRENT_TIMESTAMP в SQLite
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def parse_user_id(value: str) -> Optional[int]:
+    # Только ASCII-цифры в пределах INTEGER SQLite: isdigit() пропускает '²', а '9' * 25 не влезает в 64 бита
+    if re.fullmatch(r'[0-9]{1,19}', value) and int(value) < 1 << 63:
+        return int(value)
+    return None
+
+USERS_PAGE_SIZE = 10
+
+def _fetch_users_page(conn: sqlite3.Connection, after: Optional[int], before: Optional[int], limit: int):
+    cols = 'user_id, username, registered, deposit_confirmed'
+    if before is not None:
+        rows = conn.execute(f'SELECT {cols} FROM users WHERE user_id < ? ORDER BY user_id DESC LIMIT ?', (before, limit)).fetchall()
+        rows.reverse()
+    else:
+        start = after if after is not None else -(1 << 63)
+        rows = conn.execute(f'SELECT {cols} FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (start, limit)).fetchall()
+    if not rows:
+        return rows, False, False
+    has_prev = conn.execute('SELECT 1 FROM users WHERE user_id < ? LIMIT 1', (rows[0]['user_id'],)).fetchone() is not None
+    has_next = conn.execute('SELECT 1 FROM users WHERE user_id > ? LIMIT 1', (rows[-1]['user_id'],)).fetchone() is not None
+    return rows, has_prev, has_next
+
+async def fetch_users(after: Optional[int] = None, before: Optional[int] = None,
+                      limit: int = USERS_PAGE_SIZE) -> Tuple[List[sqlite3.Row], bool, bool]:
+    # Keyset-пагинация: страница ищется по индексу user_id, стоимость не зависит от глубины
+    return await snapshot.run(_fetch_users_page, after, before, limit)
+
+async def fetch_user(user_identifier: str) -> Optional[sqlite3.Row]:
+    # Username в Telegram не может состоять из одних цифр, поэтому тип запроса однозначен
+    identifier = str(user_identifier).strip().lstrip('@')
+    user_id = parse_user_id(identifier)
+    if user_id is not None:
+        return await db.fetchone('SELECT * FROM users WHERE user_id=?', (user_id,))
+    return await db.fetchone('SELECT * FROM users WHERE username=? COLLATE NOCASE', (identifier,))
+
+SEARCH_MIN_TRIGRAM = 3
+SEARCH_PAGE_SIZE = 10
+# Ранжируется не весь результат MATCH, а первые SEARCH_CANDIDATES совпадений по rowid
+# плюс точные совпадения и префиксы username, найденные по индексам; об обрезке сообщается админу
+SEARCH_CANDIDATES = int(os.getenv('SEARCH_CANDIDATES', '1000'))
+
+SEARCH_COLUMNS = 'u.user_id, u.username, u.registered, u.deposit_confirmed'
+
+async def search_users(query: str, offset: int = 0, limit: int = 10,
+                       columns: str = SEARCH_COLUMNS) -> Tuple[List[sqlite3.Row], bool, bool]:
+    # Ранжирование: точное совпадение, затем префикс, затем подстрока; внутри — по user_id.
+    # Возвращает (строки, есть ли ещё, обрезан ли набор кандидатов до SEARCH_CANDIDATES)
+    query = query.strip()
+    if not query:
+        return [], False, False
+    prefix = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    rank = (
+        "CASE WHEN CAST(u.user_id AS TEXT) = :q OR u.username = :q OR u.trader_id = :q OR u.click_id = :q THEN 0 "
+        "WHEN u.username LIKE :prefix ESCAPE '\\' OR CAST(u.user_id AS TEXT) LIKE :prefix ESCAPE '\\' THEN 1 ELSE 2 END"
+    )
+    params = {'q': query, 'prefix': prefix, 'limit': limit + 1, 'offset': offset, 'cap': SEARCH_CANDIDATES}
+    params['qid'] = parse_user_id(query)
+    # Кандидаты по индексам: точное совпадение любого ключа и префикс username (idx_users_username_nocase)
+    indexed = (
+        'SELECT user_id FROM users WHERE user_id = :qid OR username = :q COLLATE NOCASE '
+        'OR trader_id = :q OR click_id = :q '
+        "UNION SELECT user_id FROM (SELECT user_id FROM users WHERE username LIKE :prefix ESCAPE '\\' LIMIT :cap)"
+    )
+    # Обрезка видна по тому, что источник кандидатов отдаёт больше SEARCH_CANDIDATES строк
+    overflow = [
+        "SELECT COUNT(*) > :cap FROM (SELECT 1 FROM users WHERE username LIKE :prefix ESCAPE '\\' LIMIT :cap + 1)"
+    ]
+    if len(query) >= SEARCH_MIN_TRIGRAM:
+        overflow.append('SELECT COUNT(*) > :cap FROM (SELECT 1 FROM users_fts WHERE users_fts MATCH :match LIMIT :cap + 1)')
+        # MATCH без ORDER BY отдаёт rowid по порядку и останавливается на LIMIT. bm25 не используется:
+        # ему нужна частота фразы по всему индексу, а это полный проход по списку совпадений
+        params['match'] = '"' + query.replace('"', '""') + '"'
+        candidates = (
+            'SELECT user_id FROM (SELECT rowid AS user_id FROM users_fts WHERE users_fts MATCH :match LIMIT :cap) '
+            f'UNION {indexed}'
+        )
+    else:
+        # Триграммы не работают для 1-2 символов: только точные совпадения и префикс username
+        candidates = indexed
+    sql = (
+        f'SELECT {columns}, {rank} AS r FROM ({candidates}) c JOIN users u ON u.user_id = c.user_id '
+        'ORDER BY r, u.user_id LIMIT :limit OFFSET :offset'
+    )
+    rows = await snapshot.fetchall(sql, params)
+    truncated = await snapshot.fetchone('SELECT ' + ' OR '.join(f'({q})' for q in overflow), params)
+    return rows[:limit], len(rows) > limit, bool(truncated[0])
+
+async def rebuild_search_index():
+    await db.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+async def confirm_registration(user_id: int) -> bool:
+    updated = await writes.execute('UPDATE users SET registered=1, reg_date=COALESCE(reg_date, ?) WHERE user_id=?',
+                                   (utc_now_str(), user_id))
+    render_cache.invalidate_user(user_id)
     return updated > 0
 
-def confirm_deposit(user_id: int, amount: float) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('UPDATE users SET deposit_confirmed=1, deposit_amount=?, deposit_date=? WHERE user_id=?', 
-                (amount, datetime.now().isoformat(), user_id))
-    conn.commit()
-    updated = cur.rowcount
-    conn.close()
+async def confirm_deposit(user_id: int, amount: float) -> bool:
+    # Каждое подтверждение — новая запись журнала; users обновляет триггер deposits_ai
+    updated = await writes.execute("INSERT INTO deposits (user_id, amount, ts, source) "
+                                   "SELECT user_id, ?, ?, 'admin' FROM users WHERE user_id=?",
+                                   (amount, int(time.time()), user_id), durability='full')
+    render_cache.invalidate_user(user_id)
     return updated > 0
 
+# ==================== IMPORT ====================
+IMPORT_BATCH = 1000
+IMPORT_DEPOSIT_EVENTS = {'dep', 'deposit', 'ftd', 'first_deposit', 'redeposit'}
+IMPORT_REG_EVENTS = {'reg', 'registration', 'register', 'signup'}
+
+
+def iter_import_rows(path: str) -> Iterator[Dict[str, str]]:
+    # CSV или JSONL читаются построчно, файл целиком в память не загружается
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        first = f.read(1)
+        f.seek(0)
+        if path.lower().endswith(('.jsonl', '.ndjson', '.json')) or first in ('{', '['):
+            for line in f:
+                line = line.strip()
+                if line:
+                    obj = json.loads(line)
+                    # Строка-не-объект (массив, число) не содержит полей и считается некорректной
+                    yield {str(k).lower(): v for k, v in obj.items()} if isinstance(obj, dict) else {}
+        else:
+            sample = f.read(4096)
+            f.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+            except csv.Error:
+                dialect = csv.excel
+            for row in csv.DictReader(f, dialect=dialect):
+                yield {(k or '').strip().lower(): v for k, v in row.items()}
+
+
+def _parse_import_row(row: Dict[str, Any]) -> Optional[Tuple[str, Optional[int], Optional[str], Optional[str], float, Optional[str]]]:
+    def clean(key):
+        v = row.get(key)
+        v = str(v).strip() if v is not None else ''
+        return v or None
+    user_id = parse_user_id(clean('user_id') or '')
+    click_id = clean('click_id') or clean('subid') or clean('sub_id')
+    trader_id = clean('trader_id')
+    try:
+        amount = float((clean('amount') or clean('sum') or '0').replace(',', '.'))
+    except ValueError:
+        amount = 0.0
+    event = (clean('event') or clean('type') or clean('status') or '').lower()
+    if event in IMPORT_DEPOSIT_EVENTS or (event not in IMPORT_REG_EVENTS and amount > 0):
+        kind = 'dep'
+    else:
+        kind = 'reg'
+    if user_id is None and not click_id and not trader_id:
+        return None
+    # Без даты: регистрации ставится время импорта, депозит дедуплицируется без учёта времени
+    date = clean('date') or clean('timestamp')
+    return kind, user_id, click_id, trader_id, amount, date
+
+
+def _apply_import_batch(conn: sqlite3.Connection, batch: List[tuple], summary: Dict[str, int], seen: set, touched: Set[int]):
+    user_ids = {r[1] for r in batch if r[1] is not None}
+    click_ids = {r[2] for r in batch if r[2]}
+    trader_ids = {r[3] for r in batch if r[1] is None and r[3]}
+    by_id, by_click, by_trader = {}, {}, {}
+    current_click: Dict[int, Optional[str]] = {}
+    # Поиск по первичному ключу и индексам click_id/trader_id, по одному запросу на пачку
+    for column, keys, target in (('user_id', user_ids, by_id), ('click_id', click_ids, by_click),
+                                 ('trader_id', trader_ids, by_trader)):
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            for r in conn.execute(f'SELECT user_id, {column}, click_id FROM users WHERE {column} IN ({marks})', chunk):
+                target[r[1]] = r[0]
+                current_click[r[0]] = r[2]
+    regs, deps = [], []
+    for kind, user_id, click_id, trader_id, amount, date in batch:
+        if user_id is None:
+            # Неизвестный click_id не мешает найти пользователя по trader_id
+            user_id = by_click.get(click_id) if click_id else None
+            if user_id is None:
+                user_id = by_trader.get(trader_id)
+        elif user_id not in by_id:
+            # Импорт подтверждает существующих пользователей, новых не заводит
+            user_id = None
+        if user_id is None:
+            summary['unmatched'] += 1
+            continue
+        if click_id:
+            # click_id уникален: строка, отдающая чужой click_id (из БД или из этой же пачки), не применяется
+            owner = by_click.get(click_id)
+            if owner is not None and owner != user_id:
+                summary['conflicts'] += 1
+                continue
+            if owner is None and current_click.get(user_id) is None:
+                by_click[click_id] = user_id
+                current_click[user_id] = click_id
+        key = (kind, user_id, amount, date) if kind == 'dep' else (kind, user_id)
+        if key in seen:
+            summary['duplicates'] += 1
+            continue
+        seen.add(key)
+        touched.add(user_id)
+        if kind == 'dep':
+            deps.append((user_id, click_id, trader_id, amount, date))
+        else:
+            regs.append((user_id, click_id, trader_id, date))
+    with conn:
+        reg_changed = conn.executemany(
+            'UPDATE users SET registered=1, reg_date=COALESCE(reg_date, ?3), '
+            'click_id=COALESCE(click_id, ?1), trader_id=COALESCE(trader_id, ?2) '
+            'WHERE user_id=?4 AND registered IS NOT 1',
+            [(click_id, trader_id, date or utc_now_str(), user_id) for user_id, click_id, trader_id, date in regs]
+        ).rowcount
+        conn.executemany(
+            'UPDATE users SET click_id=COALESCE(click_id, ?1), trader_id=COALESCE(trader_id, ?2) '
+            'WHERE user_id=?3 AND ((click_id IS NULL AND ?1 IS NOT NULL) OR (trader_id IS NULL AND ?2 IS NOT NULL))',
+            [(click_id, trader_id, user_id) for user_id, click_id, trader_id, _, _ in deps]
+        )
+        # Депозит — запись журнала; повтор того же файла не дублирует: с датой — по (пользователь, время, сумма),
+        # без даты (или с нераспознанной) — по (пользователь, сумма) среди таких же недатированных записей
+        dep_changed = conn.executemany(
+            "INSERT INTO deposits (user_id, amount, ts, source) "
+            "SELECT ?1, ?2, COALESCE(t.ts, CAST(strftime('%s', 'now') AS INTEGER)), "
+            "CASE WHEN t.ts IS NULL THEN 'import_undated' ELSE 'import' END "
+            "FROM (SELECT CAST(strftime('%s', ?3) AS INTEGER) AS ts) t "
+            'WHERE NOT EXISTS (SELECT 1 FROM deposits d WHERE d.user_id = ?1 AND d.amount = ?2 AND '
+            "CASE WHEN t.ts IS NULL THEN d.source = 'import_undated' ELSE d.ts = t.ts END)",
+            [(user_id, amount, date) for user_id, _, _, amount, date in deps]
+        ).rowcount
+    # Строки, не изменившие БД (уже зарегистрированы или такой депозит уже в журнале), считаем дубликатами
+    summary['registrations'] += reg_changed
+    summary['deposits'] += dep_changed
+    summary['duplicates'] += (len(regs) - reg_changed) + (len(deps) - dep_changed)
+
+
+def _import_file(conn: sqlite3.Connection, path: str, touched: Set[int]) -> Dict[str, int]:
+    summary = {'rows': 0, 'invalid': 0, 'unmatched': 0, 'conflicts': 0, 'duplicates': 0, 'registrations': 0,
+               'deposits': 0}
+    seen: set = set()
+    batch: List[tuple] = []
+    for raw in iter_import_rows(path):
+        summary['rows'] += 1
+        parsed = _parse_import_row(raw)
+        if parsed is None:
+            summary['invalid'] += 1
+            continue
+        batch.append(parsed)
+        if len(batch) >= IMPORT_BATCH:
+            _apply_import_batch(conn, batch, summary, seen, touched)
+            batch = []
+    if batch:
+        _apply_import_batch(conn, batch, summary, seen, touched)
+    return summary
+
+
+async def import_file(path: str) -> Dict[str, int]:
+    touched: Set[int] = set()
+    try:
+        return await db.run(_import_file, path, touched)
+    finally:
+        # Пачки коммитятся по мере импорта, поэтому сбрасываем кэш и при ошибке
+        if len(touched) > render_cache.maxsize:
+            render_cache.clear()
+        else:
+            render_cache.invalidate_users(touched)
+        snapshot.note_writes(len(touched))
+
+
+def format_import_summary(summary: Dict[str, int]) -> str:
+    return (
+        f"Импорт завершён.\n"
+        f"Строк: {summary['rows']}\n"
+        f"Подтверждено регистраций: {summary['registrations']}\n"
+        f"Подтверждено депозитов: {summary['deposits']}\n"
+        f"Не найдено пользователей: {summary['unmatched']}\n"
+        f"Конфликты click_id: {summary['conflicts']}\n"
+        f"Дубликаты: {summary['duplicates']}\n"
+        f"Некорректные строки: {summary['invalid']}"
+    )
+
+# ==================== EXPORT ====================
+EXPORT_COLUMNS = ('user_id', 'username', 'registered', 'reg_date', 'deposit_amount', 'deposit_confirmed',
+                  'deposit_date', 'trader_id', 'click_id')
+EXPORT_FETCH = 5000
+EXPORT_PROGRESS_INTERVAL = 3.0
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+
+class ExportFilters:
+    def __init__(self, registered: bool = False, deposited: bool = False,
+                 date_from: Optional[date] = None, date_to: Optional[date] = None):
+        self.registered = registered
+        self.deposited = deposited
+        self.date_from = date_from
+        self.date_to = date_to
+
+    @property
+    def empty(self) -> bool:
+        return not (self.registered or self.deposited or self.date_from or self.date_to)
+
+    def where(self) -> Tuple[str, List[Any]]:
+        clauses, params = [], []
+        if self.registered:
+            clauses.append('registered = 1')
+        if self.deposited:
+            clauses.append('deposit_confirmed = 1')
+        # Границы в UTC по индексу reg_ts, верхняя — начало следующего дня
+        if self.date_from:
+            clauses.append('reg_ts >= ?')
+            params.append(date_to_epoch(self.date_from))
+        if self.date_to:
+            clauses.append('reg_ts < ?')
+            params.append(date_to_epoch(self.date_to) + 86400)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+def date_to_epoch(d: date) -> int:
+    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp())
+
+
+def parse_export_args(args: Sequence[str]) -> Tuple[str, ExportFilters]:
+    fmt = 'csv'
+    filters = ExportFilters()
+    for arg in args:
+        arg = arg.lower()
+        if arg in ('csv', 'xlsx'):
+            fmt = arg
+        elif arg in ('registered', 'reg'):
+            filters.registered = True
+        elif arg in ('deposited', 'dep'):
+            filters.deposited = True
+        elif arg.startswith('from='):
+            filters.date_from = date.fromisoformat(arg[5:])
+        elif arg.startswith('to='):
+            filters.date_to = date.fromisoformat(arg[3:])
+        else:
+            raise ValueError(f'неизвестный параметр {arg!r}')
+    return fmt, filters
+
+
+def _iter_export_rows(conn: sqlite3.Connection, filters: ExportFilters, progress: List[int]) -> Iterator[tuple]:
+    where, params = filters.where()
+    cur = conn.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM users{where} ORDER BY user_id", params)
+    while True:
+        rows = cur.fetchmany(EXPORT_FETCH)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        progress[0] += len(rows)
+
+
+def _write_csv_gz(path: str, rows: Iterator[tuple]):
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        writer.writerows(rows)
+
+
+def _xlsx_cell(ref: str, value: Any) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}"><v>{value}</v></c>'
+    return f'<c r="{ref}" t="inlineStr"><is><t>{xml_escape(str(value))}</t></is></c>'
+
+
+def _xlsx_col(index: int) -> str:
+    name = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+
+def _write_xlsx(path: str, rows: Iterator[tuple]):
+    # Минимальный XLSX без сторонних зависимостей: лист пишется потоково прямо в zip
+    cols = [_xlsx_col(i) for i in range(len(EXPORT_COLUMNS))]
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'
+        ))
+        zf.writestr('_rels/.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ))
+        zf.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="users" sheetId="1" r:id="rId1"/></sheets></workbook>'
+        ))
+        zf.writestr('xl/_rels/workbook.xml.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'
+        ))
+        with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as raw:
+            f = io.TextIOWrapper(raw, encoding='utf-8')
+            f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            for n, row in enumerate(itertools.chain([EXPORT_COLUMNS], rows), start=1):
+                f.write(f'<row r="{n}">' + ''.join(_xlsx_cell(f'{c}{n}', v) for c, v in zip(cols, row)) + '</row>')
+            f.write('</sheetData></worksheet>')
+            f.flush()
+            f.detach()
+
+
+def _export_users(path: str, fmt: str, filters: ExportFilters, progress: List[int]):
+    # Отдельное read-only соединение: экспорт не занимает пул и не держит блокировок записи.
+    # При файловом снимке читаем его, а не основную БД
+    conn = sqlite3.connect(f'file:{snapshot.path}?mode=ro', uri=True)
+    try:
+        rows = _iter_export_rows(conn, filters, progress)
+        if fmt == 'xlsx':
+            _write_xlsx(path, rows)
+        else:
+            _write_csv_gz(path, rows)
+    finally:
+        conn.close()
+
+
+async def export_users(path: str, fmt: str, filters: ExportFilters,
+                       on_progress: Optional[Callable[[int], Awaitable[Any]]] = None) -> int:
+    progress = [0]
+    task = asyncio.ensure_future(asyncio.to_thread(_export_users, path, fmt, filters, progress))
+    while not task.done():
+        await asyncio.wait({task}, timeout=EXPORT_PROGRESS_INTERVAL)
+        if not task.done() and on_progress is not None:
+            await on_progress(progress[0])
+    task.result()
+    return progress[0]
+
+# ==================== OUTBOUND ====================
+# Лимит Telegram — на бота, а бакет — на процесс: с воркерами супервизор передаёт детям
+# OUTBOUND_PROCESSES, и каждый процесс получает равную долю OUTBOUND_RATE
+OUTBOUND_RATE = float(os.getenv('OUTBOUND_RATE', '30'))
+OUTBOUND_PROCESSES = max(1, int(os.getenv('OUTBOUND_PROCESSES', '1')))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', '10'))
+OUTBOUND_CHAT_BUCKETS = 10000
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '8'))
+OUTBOUND_MAX_RETRIES = 2
+
+PRIORITY_INTERACTIVE, PRIORITY_NOTIFY, PRIORITY_BULK = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_NOTIFY: 'notify', PRIORITY_BULK: 'bulk'}
+# Приоритет исходящих запросов текущей задачи; фоновые задачи понижают его для себя и своих подзадач
+outbound_priority: ContextVar[int] = ContextVar('outbound_priority', default=PRIORITY_INTERACTIVE)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # RetryAfter от Telegram касается всего бота, поэтому останавливаем всех отправителей
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class OutboundJob:
+    __slots__ = ('priority', 'seq', 'bot', 'method', 'make_request', 'futures', 'key', 'enqueued')
+
+    def __init__(self, priority: int, seq: int, bot: Bot, method, make_request, key: Optional[tuple]):
+        self.priority = priority
+        self.seq = seq
+        self.bot = bot
+        self.method = method
+        self.make_request = make_request
+        self.futures: List[asyncio.Future] = []
+        self.key = key
+        self.enqueued = time.perf_counter()
+
+    def __lt__(self, other: 'OutboundJob') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# Все вызовы Bot API, кроме getUpdates, проходят через очередь с приоритетами и токен-бакетами
+# (общий и, для адресованных чату, на чат). Ещё не отправленное edit_text того же сообщения заменяется новым —
+# промежуточные страницы, которые админ уже пролистал, в Telegram не уходят
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self, rate: float = OUTBOUND_RATE / OUTBOUND_PROCESSES, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 workers: int = OUTBOUND_WORKERS):
+        self.global_bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self._chat_buckets: OrderedDict = OrderedDict()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._pending_edits: Dict[tuple, OutboundJob] = {}
+        self._seq = itertools.count()
+        self._tasks: List[asyncio.Task] = []
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, OUTBOUND_CHAT_BURST)
+            if len(self._chat_buckets) > OUTBOUND_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if isinstance(method, GetUpdates):
+            # Long polling держит соединение минутами и в лимит сообщений не входит
+            return await make_request(bot, method)
+        chat_id = getattr(method, 'chat_id', None)
+        self._start()
+        fut = asyncio.get_running_loop().create_future()
+        key = None
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            key = (chat_id, method.message_id)
+            job = self._pending_edits.get(key)
+            if job is not None:
+                job.method = method
+                job.make_request = make_request
+                job.futures.append(fut)
+                metrics.outbound_skipped.inc('coalesced')
+                return await fut
+        job = OutboundJob(outbound_priority.get(), next(self._seq), bot, method, make_request, key)
+        job.futures.append(fut)
+        if key is not None:
+            self._pending_edits[key] = job
+        self._queue.put_nowait(job)
+        return await fut
+
+    async def _acquire(self, bucket: Optional[TokenBucket]):
+        if bucket is not None:
+            await bucket.acquire()
+        await self.global_bucket.acquire()
+
+    async def _send(self, job: OutboundJob, bucket: Optional[TokenBucket]):
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            try:
+                return await job.make_request(job.bot, job.method)
+            except TelegramRetryAfter as e:
+                # Flood wait действует на весь бот, а не только на этот чат
+                self.global_bucket.pause(e.retry_after)
+                if bucket is not None:
+                    bucket.pause(e.retry_after)
+                # Массовые отправители (рассылка) сами решают, повторять ли
+                if job.priority == PRIORITY_BULK or attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                await self._acquire(bucket)
+            except TelegramBadRequest as e:
+                if 'message is not modified' in e.message:
+                    metrics.outbound_skipped.inc('not_modified')
+                    return True
+                raise
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                if all(f.done() for f in job.futures):
+                    continue
+                metrics.outbound_wait.observe(PRIORITY_NAMES[job.priority], time.perf_counter() - job.enqueued)
+                # Ответы админу на его же действия лимитом чата не тормозим: их темп задаёт сам админ,
+                # а правки одного сообщения и так склеиваются. Лимит чата — для уведомлений и рассылок
+                # answerCallbackQuery, answerInlineQuery и т.п. без чата расходуют только общий бакет
+                chat_id = getattr(job.method, 'chat_id', None)
+                bucket = None if job.priority == PRIORITY_INTERACTIVE or chat_id is None else self._chat_bucket(chat_id)
+                await self._acquire(bucket)
+                # Пока ждали токен, правки того же сообщения продолжали склеиваться в эту задачу
+                if job.key is not None and self._pending_edits.get(job.key) is job:
+                    del self._pending_edits[job.key]
+                try:
+                    result = await self._send(job, bucket)
+                except Exception as e:
+                    for f in job.futures:
+                        if not f.done():
+                            f.set_exception(e)
+                else:
+                    for f in job.futures:
+                        if not f.done():
+                            f.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    async def close(self, timeout: float = 10):
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Исходящая очередь не разобрана за %s с, осталось %s', timeout, self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._queue = None
+        self._pending_edits.clear()
+
+
+outbound = OutboundScheduler()
+# Планировщик снаружи метрик: в admin_bot_api_request_seconds не попадает ожидание в очереди
+bot.session.middleware(outbound)
+bot.session.middleware(ApiMetricsMiddleware())
+
+# ==================== BROADCAST ====================
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '30'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_BATCH = 50
+BROADCAST_PROGRESS_INTERVAL = 5.0
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_PICKUP_INTERVAL = 2.0
+
+
+# Рассылка идёт по курсору user_id пачками; прогресс сохраняется после каждой пачки,
+# поэтому после перезапуска задача продолжается с места остановки (at-least-once в пределах пачки)
+class BroadcastEngine:
+    def __init__(self, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def create(self, text: str, chat_id: int, segment_id: Optional[int] = None) -> int:
+        if segment_id is not None:
+            segment = await segments.get(segment_id)
+            if segment is None:
+                raise ValueError(f'сегмент #{segment_id} не найден')
+            total = segment['member_count']
+        else:
+            total, _, _, _ = await stats()
+        def _insert(conn):
+            with conn:
+                cur = conn.execute(
+                    'INSERT INTO broadcast_jobs (text, total, chat_id, created_at, segment_id) VALUES (?, ?, ?, ?, ?)',
+                    (text, total, chat_id, datetime.now().isoformat(), segment_id)
+                )
+                return cur.lastrowid
+        job_id = await db.run(_insert)
+        if RUNS_BACKGROUND_JOBS:
+            self.start(job_id)
+        # иначе задачу подхватит watch() в фоновом воркере
+        return job_id
+
+    def start(self, job_id: int):
+        if job_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def resume_pending(self):
+        for row in await db.fetchall("SELECT id FROM broadcast_jobs WHERE status='running'"):
+            if row['id'] in self._tasks:
+                continue
+            logger.info('Возобновляю рассылку #%s', row['id'])
+            self.start(row['id'])
+
+    async def watch(self, interval: float = BROADCAST_PICKUP_INTERVAL):
+        # В режиме с воркерами рассылки создаются в процессах-шардах, а выполняются здесь
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.resume_pending()
+            except sqlite3.Error:
+                logger.exception('Не удалось проверить новые рассылки')
+
+    async def cancel(self, job_id: int) -> bool:
+        updated = await db.execute("UPDATE broadcast_jobs SET status='cancelled', finished_at=? WHERE id=? AND status='running'",
+                                   (datetime.now().isoformat(), job_id))
+        task = self._tasks.get(job_id)
+        if task:
+            task.cancel()
+        if updated:
+            await self._report(await self._load(job_id))
+        return updated > 0
+
+    async def shutdown(self):
+        # Статус остаётся 'running' — задачи будут возобновлены при следующем запуске
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _load(self, job_id: int) -> Optional[sqlite3.Row]:
+        return await db.fetchone('SELECT * FROM broadcast_jobs WHERE id=?', (job_id,))
+
+    async def _send_one(self, user_id: int, text: str, sem: asyncio.Semaphore) -> str:
+        async with sem:
+            for _ in range(BROADCAST_MAX_RETRIES):
+                await self.bucket.acquire()
+                try:
+                    await bot.send_message(user_id, text)
+                    return 'sent'
+                except TelegramRetryAfter as e:
+                    self.bucket.pause(e.retry_after)
+                except TelegramForbiddenError:
+                    return 'blocked'
+                except TelegramBadRequest:
+                    return 'failed'
+                except TelegramAPIError as e:
+                    logger.warning('Рассылка: ошибка отправки %s: %s', user_id, e)
+                    return 'failed'
+            return 'failed'
+
+    async def _run(self, job_id: int):
+        outbound_priority.set(PRIORITY_BULK)
+        job = await self._load(job_id)
+        if job is None or job['status'] != 'running':
+            return
+        text = job['text']
+        cursor = job['last_user_id']
+        sem = asyncio.Semaphore(self.concurrency)
+        last_report = 0.0
+        while True:
+            if job['segment_id'] is not None:
+                rows = await db.fetchall(
+                    'SELECT user_id FROM segment_members WHERE segment_id=? AND user_id > ? ORDER BY user_id LIMIT ?',
+                    (job['segment_id'], cursor, BROADCAST_BATCH)
+                )
+            else:
+                rows = await db.fetchall('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                                         (cursor, BROADCAST_BATCH))
+            if not rows:
+                break
+            results = await asyncio.gather(*(self._send_one(r['user_id'], text, sem) for r in rows))
+            cursor = rows[-1]['user_id']
+            updated = await db.execute(
+                "UPDATE broadcast_jobs SET last_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+? "
+                "WHERE id=? AND status='running'",
+                (cursor, results.count('sent'), results.count('failed'), results.count('blocked'), job_id)
+            )
+            if not updated:
+                # Остановлена из другого процесса: cancel() уже сменил статус и показал итог
+                return
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await self._report(await self._load(job_id))
+        await db.execute("UPDATE broadcast_jobs SET status='done', finished_at=? WHERE id=? AND status='running'",
+                         (datetime.now().isoformat(), job_id))
+        await self._report(await self._load(job_id))
+
+    async def _report(self, job: Optional[sqlite3.Row]):
+        if job is None or not job['chat_id']:
+            return
+        status = {'running': '⏳ идёт', 'done': '✅ завершена', 'cancelled': '⛔️ остановлена'}.get(job['status'], job['status'])
+        processed = job['sent'] + job['failed'] + job['blocked']
+        text = (
+            f"Рассылка #{job['id']}: {status}\n"
+            f"Обработано: {processed}/{job['total']}\n"
+            f"Доставлено: {job['sent']}\n"
+            f"Заблокировали бота: {job['blocked']}\n"
+            f"Ошибки: {job['failed']}"
+        )
+        kb = build_broadcast_keyboard(job['id']) if job['status'] == 'running' else None
+        try:
+            if job['message_id']:
+                await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'], reply_markup=kb)
+            else:
+                msg = await bot.send_message(job['chat_id'], text, reply_markup=kb)
+                await db.execute('UPDATE broadcast_jobs SET message_id=? WHERE id=?', (msg.message_id, job['id']))
+        except TelegramRetryAfter as e:
+            self.bucket.pause(e.retry_after)
+        except TelegramAPIError as e:
+            logger.debug('Рассылка #%s: не удалось обновить прогресс: %s', job['id'], e)
+
+
+broadcaster = BroadcastEngine()
+
+# ==================== CHANGE FEED ====================
+CHANGEFEED_INTERVAL = float(os.getenv('CHANGEFEED_INTERVAL', '60'))  # 0 — уведомления выключены
+CHANGEFEED_BATCH = 5000
+CHANGEFEED_RETENTION = 30 * 86400
+
+
+def format_digest(counts: Dict[str, int], sums: Dict[str, float]) -> Optional[str]:
+    lines = []
+    if counts.get('new'):
+        lines.append(f"Новых пользователей: {counts['new']}")
+    if counts.get('registration'):
+        lines.append(f"Новых регистраций: {counts['registration']}")
+    if counts.get('deposit'):
+        lines.append(f"Новых депозитов: {counts['deposit']} на сумму {sums['deposit']:.2f}")
+    if counts.get('deposit_change'):
+        lines.append(f"Изменено сумм депозитов: {counts['deposit_change']} ({sums['deposit_change']:+.2f})")
+    if counts.get('delete'):
+        lines.append(f"Удалено пользователей: {counts['delete']}")
+    if not lines:
+        return None
+    return '🔔 Новые события:\n\n' + '\n'.join(lines)
+
+
+class ChangeFeed:
+    # Читает user_changes от сохранённой отметки seq: стоимость зависит только от числа новых событий
+    def __init__(self, name: str = 'admin_digest', interval: float = CHANGEFEED_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _high_water(self) -> int:
+        row = await db.fetchone('SELECT seq FROM feed_state WHERE name=?', (self.name,))
+        if row is not None:
+            return row['seq']
+        # Первый запуск: не пересылаем накопленную историю
+        row = await db.fetchone('SELECT COALESCE(MAX(seq), 0) FROM user_changes')
+        await self._commit(row[0])
+        return row[0]
+
+    async def _commit(self, seq: int):
+        await db.execute(
+            'INSERT INTO feed_state (name, seq) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET seq=excluded.seq',
+            (self.name, seq)
+        )
+
+    async def poll(self, after: int) -> Tuple[int, Optional[str]]:
+        counts: Dict[str, int] = {}
+        sums: Dict[str, float] = {}
+        while True:
+            rows = await db.fetchall(
+                'SELECT seq, kind, amount FROM user_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                (after, CHANGEFEED_BATCH)
+            )
+            for r in rows:
+                counts[r['kind']] = counts.get(r['kind'], 0) + 1
+                sums[r['kind']] = sums.get(r['kind'], 0.0) + (r['amount'] or 0.0)
+            if rows:
+                after = rows[-1]['seq']
+            if len(rows) < CHANGEFEED_BATCH:
+                return after, format_digest(counts, sums)
+
+    async def _run(self):
+        outbound_priority.set(PRIORITY_NOTIFY)
+        seq = await self._high_water()
+        last_trim = 0.0
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                new_seq, digest = await self.poll(seq)
+                if digest:
+                    await bot.send_message(ADMIN_ID, digest)
+                if new_seq != seq:
+                    # Отметка сдвигается только после отправки: при сбое сводка придёт повторно, но не потеряется
+                    await self._commit(new_seq)
+                    seq = new_seq
+                if time.monotonic() - last_trim > 3600:
+                    last_trim = time.monotonic()
+                    await db.execute('DELETE FROM user_changes WHERE seq <= ? AND ts < ?',
+                                     (seq, int(time.time()) - CHANGEFEED_RETENTION))
+            except (TelegramAPIError, sqlite3.Error):
+                logger.exception('Не удалось отправить сводку изменений')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+change_feed = ChangeFeed()
+
+# ==================== SEGMENTS ====================
+# Мини-язык условий через пробел (все условия — И):
+#   reg / !reg, dep / !dep          — регистрация и депозит подтверждены / нет
+#   amount>=100, amount<50          — сумма последнего депозита (только с подтверждённым депозитом)
+#   total>=500, deposits>=2         — сумма и число всех депозитов по журналу
+#   reg_days<=7, dep_days>30        — дней с регистрации / депозита
+#   id>=1000000                     — диапазон user_id
+SEGMENT_FLAGS = {'reg': 'registered', 'dep': 'deposit_confirmed'}
+# поле: (колонка, тип значения, условие, при котором поле осмысленно)
+SEGMENT_FIELDS = {
+    'id': ('user_id', int, None),
+    'amount': ('deposit_amount', float, 'deposit_confirmed = 1'),
+    'reg_days': ('reg_ts', 'days', 'registered = 1'),
+    'dep_days': ('deposit_ts', 'days', 'deposit_confirmed = 1'),
+    'total': ('deposits_total', float, 'deposit_confirmed = 1'),
+    'deposits': ('deposits_count', int, None),
+}
+SEGMENT_OPS = ('<=', '>=', '!=', '=', '<', '>')
+SEGMENT_COND_RE = re.compile(r'^([a-z_]+)(<=|>=|!=|=|<|>)(.+)$')
+# Возраст в днях сравнивается с меткой времени в обратную сторону: «не старше 7 дней» — reg_ts >= now - 7д
+DAYS_OPS = {'<=': '>=', '<': '>', '>=': '<=', '>': '<'}
+SEGMENT_BATCH = 1000
+SEGMENT_MAX = 20
+SEGMENT_TIME_REFRESH = 300
+SEGMENT_INCREMENTAL_MAX = 50_000
+
+SEGMENT_PRESETS = {
+    'rn': ('Рег без депозита', 'reg !dep'),
+    'r7': ('Рег за 7 дней', 'reg reg_days<=7'),
+    'd1': ('Депозит ≥ 100', 'dep amount>=100'),
+    'd30': ('Депозит за 30 дней', 'dep dep_days<=30'),
+}
+
+
+def parse_segment(expr: str) -> List[Tuple[str, str, Any]]:
+    conds = set()
+    for token in expr.lower().split():
+        negate = token.startswith('!')
+        if token.lstrip('!') in SEGMENT_FLAGS:
+            conds.add((token.lstrip('!'), '=', 0 if negate else 1))
+            continue
+        m = SEGMENT_COND_RE.match(token)
+        if m is None or m.group(1) not in SEGMENT_FIELDS:
+            raise ValueError(f'неизвестное условие {token!r}')
+        field, op, raw = m.groups()
+        kind = SEGMENT_FIELDS[field][1]
+        try:
+            if kind == 'days':
+                if op not in DAYS_OPS:
+                    raise ValueError
+                value: Any = int(raw.rstrip('d'))
+            else:
+                value = kind(raw)
+        except ValueError:
+            raise ValueError(f'некорректное значение в {token!r}') from None
+        conds.add((field, op, value))
+    if not conds:
+        raise ValueError('пустой сегмент')
+    return sorted(conds, key=lambda c: (c[0] not in SEGMENT_FLAGS, c))
+
+
+def format_segment(conds: Sequence[Tuple[str, str, Any]]) -> str:
+    # Каноническая запись: одинаковые по смыслу выражения дают один сегмент
+    parts = []
+    for field, op, value in conds:
+        if field in SEGMENT_FLAGS:
+            parts.append(field if value else f'!{field}')
+        else:
+            parts.append(f'{field}{op}{format_segment_number(value)}')
+    return ' '.join(parts)
+
+
+def format_segment_number(value: Any) -> str:
+    # Запись хранится и разбирается заново, поэтому число должно читаться обратно точно (:g округляет до 6 знаков)
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+def compile_segment(conds: Sequence[Tuple[str, str, Any]], anchor: int) -> Tuple[str, List[Any]]:
+    # Колонка всегда слева и без функций, а условия частичных индексов добавляются явно —
+    # так SQLite может использовать idx_users_reg_ts, idx_users_deposit_ts и idx_users_deposit_amount
+    where: List[str] = []
+    params: List[Any] = []
+    implied: List[str] = []
+    for field, op, value in conds:
+        if field in SEGMENT_FLAGS:
+            where.append(f'{SEGMENT_FLAGS[field]} = ?')
+            params.append(value)
+            continue
+        column, kind, requires = SEGMENT_FIELDS[field]
+        if requires and requires not in implied:
+            implied.append(requires)
+        if kind == 'days':
+            where.append(f'{column} {DAYS_OPS[op]} ?')
+            params.append(anchor - value * 86400)
+        else:
+            where.append(f'{column} {op} ?')
+            params.append(value)
+    return ' AND '.join(implied + where), params
+
+
+def _segment_refresh(conn: sqlite3.Connection, segment_id: int, conds, force: bool) -> int:
+    now = int(time.time())
+    relative = any(SEGMENT_FIELDS.get(f, (None, None))[1] == 'days' for f, _, _ in conds)
+    with conn:
+        # Запись сразу: seq журнала и состояние users должны соответствовать друг другу
+        conn.execute('BEGIN IMMEDIATE')
+        # seq и member_count — только под блокировкой: параллельное обновление того же сегмента
+        # могло уже применить эти события, и повторная дельта исказила бы счётчик
+        segment = conn.execute('SELECT * FROM segments WHERE id=?', (segment_id,)).fetchone()
+        if segment is None:
+            return 0
+        head = conn.execute('SELECT COALESCE(MAX(seq), 0), MIN(seq) FROM user_changes').fetchone()
+        top, oldest = head[0], head[1]
+        full = (
+            force or segment['refreshed_at'] == 0
+            or (relative and now - segment['anchor'] > SEGMENT_TIME_REFRESH)
+            or (oldest is not None and oldest > segment['seq'] + 1)  # журнал уже подрезан
+        )
+        anchor = now if full else segment['anchor']
+        where, params = compile_segment(conds, anchor)
+        if not full:
+            # Стоимость пропорциональна числу событий после seq сегмента, а не размеру users
+            changed = [r[0] for r in conn.execute(
+                'SELECT DISTINCT user_id FROM user_changes WHERE seq > ? AND seq <= ? LIMIT ?',
+                (segment['seq'], top, SEGMENT_INCREMENTAL_MAX + 1)
+            )]
+            full = len(changed) > SEGMENT_INCREMENTAL_MAX
+        if full:
+            conn.execute('DELETE FROM segment_members WHERE segment_id=?', (segment['id'],))
+            count = conn.execute(
+                f'INSERT INTO segment_members (segment_id, user_id) SELECT ?, user_id FROM users WHERE {where}',
+                [segment['id']] + params
+            ).rowcount
+        else:
+            removed = conn.executemany('DELETE FROM segment_members WHERE segment_id=? AND user_id=?',
+                                       [(segment['id'], uid) for uid in changed]).rowcount
+            added = conn.executemany(
+                f'INSERT INTO segment_members (segment_id, user_id) SELECT ?, user_id FROM users WHERE user_id = ? AND {where}',
+                [[segment['id'], uid] + params for uid in changed]
+            ).rowcount
+            count = segment['member_count'] - removed + added
+        conn.execute(
+            'UPDATE segments SET member_count=?, seq=?, anchor=?, refreshed_at=?, used_at=? WHERE id=?',
+            (count, top, anchor, now if full else segment['refreshed_at'], now, segment['id'])
+        )
+    return count
+
+
+def _segment_open(conn: sqlite3.Connection, expr: str) -> sqlite3.Row:
+    with conn:
+        conn.execute('INSERT INTO segments (expr, used_at) VALUES (?, ?) ON CONFLICT(expr) DO NOTHING',
+                     (expr, int(time.time())))
+        # Храним не больше SEGMENT_MAX сегментов, не трогая те, по которым идёт рассылка
+        stale = [r[0] for r in conn.execute(
+            "SELECT id FROM segments WHERE expr != ? AND id NOT IN "
+            "(SELECT segment_id FROM broadcast_jobs WHERE status='running' AND segment_id IS NOT NULL) "
+            'ORDER BY used_at DESC LIMIT -1 OFFSET ?', (expr, SEGMENT_MAX - 1)
+        )]
+        for segment_id in stale:
+            conn.execute('DELETE FROM segment_members WHERE segment_id=?', (segment_id,))
+            conn.execute('DELETE FROM segments WHERE id=?', (segment_id,))
+    return conn.execute('SELECT * FROM segments WHERE expr=?', (expr,)).fetchone()
+
+
+class SegmentEngine:
+    # Членство сегментов материализуется в segment_members; счётчик обновляется
+    # инкрементально по user_changes, поэтому повторный показ не сканирует users
+    async def open(self, expr: str, force: bool = False) -> sqlite3.Row:
+        conds = parse_segment(expr)
+        segment = await db.run(_segment_open, format_segment(conds))
+        await db.run(_segment_refresh, segment['id'], conds, force)
+        return await db.fetchone('SELECT * FROM segments WHERE id=?', (segment['id'],))
+
+    async def get(self, segment_id: int, force: bool = False) -> Optional[sqlite3.Row]:
+        segment = await db.fetchone('SELECT * FROM segments WHERE id=?', (segment_id,))
+        if segment is None:
+            return None
+        return await self.open(segment['expr'], force)
+
+    async def iter_members(self, segment_id: int, batch: int = SEGMENT_BATCH,
+                           after: int = -(1 << 63)):
+        # Потоковая выдача членов сегмента пачками по ключу (segment_id, user_id)
+        while True:
+            rows = await db.fetchall(
+                'SELECT user_id FROM segment_members WHERE segment_id=? AND user_id > ? ORDER BY user_id LIMIT ?',
+                (segment_id, after, batch)
+            )
+            if not rows:
+                return
+            after = rows[-1]['user_id']
+            yield [r['user_id'] for r in rows]
+
+
+segments = SegmentEngine()
+
+# ==================== CALLBACK DATA ====================
+# Короткие префиксы укладывают payload в лимит 64 байта; aiogram проверяет длину при pack()
+class MenuCb(CallbackData, prefix='mn'):
+    pass
+
+class StatsCb(CallbackData, prefix='st'):
+    period: str = 'all'
+
+class UsersPageCb(CallbackData, prefix='ul'):
+    direction: str = 'n'
+    cursor: Optional[int] = None
+
+class UserCardCb(CallbackData, prefix='uc'):
+    user_id: int
+
+class SearchPromptCb(CallbackData, prefix='sq'):
+    pass
+
+class SearchPageCb(CallbackData, prefix='sr'):
+    offset: int = 0
+
+class BroadcastPromptCb(CallbackData, prefix='bp'):
+    pass
+
+class BroadcastGoCb(CallbackData, prefix='bg'):
+    pass
+
+class BroadcastStopCb(CallbackData, prefix='bs'):
+    job_id: int
+
+class SettingsCb(CallbackData, prefix='se'):
+    pass
+
+class SegmentMenuCb(CallbackData, prefix='sm'):
+    pass
+
+class SegmentPresetCb(CallbackData, prefix='sp'):
+    key: str
+
+class SegmentCb(CallbackData, prefix='sg'):
+    segment_id: int
+
+class SegmentBroadcastCb(CallbackData, prefix='sb'):
+    segment_id: int
+
+
+CallbackHandler = Callable[[CallbackQuery, Any, FSMContext], Awaitable[Any]]
+
+
+# Диспетчеризация по точному совпадению префикса: O(1) и без коллизий вида admin:users / admin:users:
+class CallbackRouter:
+    def __init__(self):
+        self._routes: Dict[str, Tuple[Type[CallbackData], CallbackHandler]] = {}
+
+    def route(self, cb_type: Type[CallbackData]) -> Callable[[CallbackHandler], CallbackHandler]:
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            prefix = cb_type.__prefix__
+            if prefix in self._routes:
+                raise ValueError(f'Префикс callback {prefix!r} уже зарегистрирован')
+            self._routes[prefix] = (cb_type, handler)
+            return handler
+        return decorator
+
+    def resolve(self, data: str) -> Optional[Tuple[CallbackHandler, CallbackData]]:
+        route = self._routes.get(data.split(':', 1)[0])
+        if route is None:
+            return None
+        cb_type, handler = route
+        try:
+            return handler, cb_type.unpack(data)
+        except (TypeError, ValueError):
+            return None
+
+
+callbacks = CallbackRouter()
+
+# ==================== RENDER CACHE ====================
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '512'))
+# TTL ограничивает устаревание, если журнал user_changes недоступен или опрос отстаёт
+RENDER_CACHE_TTL = float(os.getenv('RENDER_CACHE_TTL', '30'))
+# Записи других процессов (основной бот добавляет пользователей) подхватываются из user_changes
+RENDER_CACHE_POLL = float(os.getenv('RENDER_CACHE_POLL', '2'))  # 0 — только TTL
+RENDER_CACHE_POLL_BATCH = 5000
+
+
+class RenderCache:
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE, ttl: float = RENDER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: 'OrderedDict[Hashable, Tuple[float, str, Optional[InlineKeyboardMarkup], Tuple[int, ...]]]' = OrderedDict()
+        self._by_user: Dict[int, Set[Hashable]] = {}
+        # Диапазон user_id (lo, hi] страницы списка; None — без границы. Новый или удалённый
+        # пользователь из диапазона меняет состав страницы, хотя в user_ids её записи его нет
+        self._spans: Dict[Hashable, Tuple[Optional[int], Optional[int]]] = {}
+
+    def get(self, key: Hashable) -> Optional[Tuple[str, Optional[InlineKeyboardMarkup]]]:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                self._drop(key)
+            metrics.render_cache.inc('miss')
+            return None
+        self._entries.move_to_end(key)
+        metrics.render_cache.inc('hit')
+        return entry[1], entry[2]
+
+    def put(self, key: Hashable, text: str, markup: Optional[InlineKeyboardMarkup], user_ids: Iterable[int],
+            span: Optional[Tuple[Optional[int], Optional[int]]] = None):
+        self._drop(key)
+        user_ids = tuple(user_ids)
+        self._entries[key] = (time.monotonic(), text, markup, user_ids)
+        for uid in user_ids:
+            self._by_user.setdefault(uid, set()).add(key)
+        if span is not None:
+            self._spans[key] = span
+        while len(self._entries) > self.maxsize:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        for key in self._by_user.pop(user_id, ()):
+            self._drop(key)
+
+    def invalidate_users(self, user_ids: Iterable[int]):
+        for uid in user_ids:
+            if not self._entries:
+                return
+            self.invalidate_user(uid)
+
+    def invalidate_inserted(self, user_ids: Iterable[int]):
+        # Для вставок и удалений: сбрасывает страницы, в диапазон которых попадает user_id
+        ids = sorted(set(user_ids))
+        if not ids:
+            return
+        for key, (lo, hi) in list(self._spans.items()):
+            i = 0 if lo is None else bisect.bisect_right(ids, lo)
+            if i < len(ids) and (hi is None or ids[i] <= hi):
+                self._drop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_user.clear()
+        self._spans.clear()
+
+    async def follow(self, interval: float = RENDER_CACHE_POLL):
+        # Хвост user_changes от текущего seq: новые и удалённые пользователи сбрасывают страницы
+        # по диапазону, остальные события — карточки и страницы с этим пользователем
+        row = await db.fetchone('SELECT COALESCE(MAX(seq), 0) FROM user_changes')
+        seq = row[0]
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                while True:
+                    rows = await db.fetchall(
+                        'SELECT seq, user_id, kind FROM user_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                        (seq, RENDER_CACHE_POLL_BATCH)
+                    )
+                    if not rows:
+                        break
+                    seq = rows[-1]['seq']
+                    self.invalidate_inserted(r['user_id'] for r in rows if r['kind'] in ('new', 'delete'))
+                    self.invalidate_users({r['user_id'] for r in rows})
+                    if len(rows) < RENDER_CACHE_POLL_BATCH:
+                        break
+            except sqlite3.Error:
+                logger.exception('Не удалось прочитать user_changes для кэша рендеринга')
+
+    def _drop(self, key: Hashable):
+        self._spans.pop(key, None)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for uid in entry[3]:
+            keys = self._by_user.get(uid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_user[uid]
+
+
+render_cache = RenderCache()
+
+# ==================== INLINE SEARCH ====================
+INLINE_FETCH_LIMIT = 200
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_SIZE = 256
+INLINE_CACHE_TTL = 15
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', '0.3'))
+INLINE_DEADLINE = 5.0
+
+
+def search_rank(row: Dict[str, Any], query: str) -> int:
+    # То же ранжирование, что в SQL search_users: точное совпадение, префикс, подстрока
+    q = query.lower()
+    uid = str(row['user_id'])
+    if query in (uid, row['username'], row['trader_id'], row['click_id']):
+        return 0
+    if (row['username'] or '').lower().startswith(q) or uid.startswith(q):
+        return 1
+    return 2
+
+
+def search_matches(row: Dict[str, Any], query: str) -> bool:
+    q = query.lower()
+    return any(q in str(row[col] or '').lower() for col in ('user_id', 'username', 'trader_id', 'click_id'))
+
+
+# Ранжированные результаты недавних фрагментов. Список для «alice» получается фильтрацией
+# закэшированного полного списка для «alic» без запроса к БД: подстрочное совпадение
+# с длинным фрагментом влечёт совпадение с его префиксом (только для фрагментов от SEARCH_MIN_TRIGRAM)
+class InlineSearchCache:
+    def __init__(self, maxsize: int = INLINE_CACHE_SIZE, ttl: float = INLINE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, Tuple[float, List[Dict[str, Any]], bool]]' = OrderedDict()
+
+    def _get(self, key: str) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def _put(self, key: str, rows: List[Dict[str, Any]], complete: bool):
+        self._entries[key] = (time.monotonic(), rows, complete)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def lookup(self, fragment: str) -> Optional[List[Dict[str, Any]]]:
+        cached = self._get(fragment)
+        if cached is not None:
+            metrics.render_cache.inc('inline_hit')
+            return cached[0]
+        for length in range(len(fragment) - 1, SEARCH_MIN_TRIGRAM - 1, -1):
+            parent = self._get(fragment[:length])
+            if parent is None or not parent[1]:
+                continue
+            order = {row['user_id']: i for i, row in enumerate(parent[0])}
+            rows = sorted((r for r in parent[0] if search_matches(r, fragment)),
+                          key=lambda r: (search_rank(r, fragment), order[r['user_id']]))
+            self._put(fragment, rows, True)
+            metrics.render_cache.inc('inline_prefix_hit')
+            return rows
+        return None
+
+    async def results(self, fragment: str) -> List[Dict[str, Any]]:
+        rows = self.lookup(fragment)
+        if rows is not None:
+            return rows
+        metrics.render_cache.inc('inline_miss')
+        found, has_more, truncated = await search_users(fragment, 0, INLINE_FETCH_LIMIT, columns='u.*')
+        rows = [dict(r) for r in found]
+        self._put(fragment, rows, not (has_more or truncated))
+        return rows
+
+
+inline_cache = InlineSearchCache()
+
 # ==================== KEYBOARDS ====================
 def build_admin_menu() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text='📊 Статистика', callback_data='admin:stats')],
-        [InlineKeyboardButton(text='👥 Список пользователей', callback_data='admin:users:0')],
-        [InlineKeyboardButton(text='🔍 Поиск пользователя', callback_data='admin:search')],
-        [InlineKeyboardButton(text='📢 Рассылка', callback_data='admin:broadcast')],
-        [InlineKeyboardButton(text='⚙️ Настройки', callback_data='admin:settings')],
+        [InlineKeyboardButton(text='📊 Статистика', callback_data=StatsCb().pack())],
+        [InlineKeyboardButton(text='👥 Список пользователей', callback_data=UsersPageCb().pack())],
+        [InlineKeyboardButton(text='🔍 Поиск пользователя', callback_data=SearchPromptCb().pack())],
+        [InlineKeyboardButton(text='📢 Рассылка', callback_data=BroadcastPromptCb().pack())],
+        [InlineKeyboardButton(text='🎯 Сегменты', callback_data=SegmentMenuCb().pack())],
+        [InlineKeyboardButton(text='⚙️ Настройки', callback_data=SettingsCb().pack())],
     ])
     return kb
 
-def build_users_keyboard(offset: int, has_more: bool) -> InlineKeyboardMarkup:
+def build_users_keyboard(first_id: Optional[int], last_id: Optional[int], has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
     buttons = []
     row = []
+    if has_prev:
+        row.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=UsersPageCb(direction='p', cursor=first_id).pack()))
+    if has_next:
+        row.append(InlineKeyboardButton(text='Далее ➡️', callback_data=UsersPageCb(direction='n', cursor=last_id).pack()))
+    if row:
+        buttons.append(row)
+    buttons.append([InlineKeyboardButton(text='🔙 В меню', callback_data=MenuCb().pack())])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def build_search_keyboard(rows: List[sqlite3.Row], offset: int, has_more: bool) -> InlineKeyboardMarkup:
+    buttons = [
+        [InlineKeyboardButton(text=f"{r['user_id']} | @{r['username'] or '—'}", callback_data=UserCardCb(user_id=r['user_id']).pack())]
+        for r in rows
+    ]
+    row = []
     if offset > 0:
-        row.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'admin:users:{max(0, offset-10)}'))
+        row.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=SearchPageCb(offset=max(0, offset - SEARCH_PAGE_SIZE)).pack()))
     if has_more:
-        row.append(InlineKeyboardButton(text='Далее ➡️', callback_data=f'admin:users:{offset+10}'))
+        row.append(InlineKeyboardButton(text='Далее ➡️', callback_data=SearchPageCb(offset=offset + SEARCH_PAGE_SIZE).pack()))
     if row:
         buttons.append(row)
-    buttons.append([InlineKeyboardButton(text='🔙 В меню', callback_data='admin:menu')])
+    buttons.append([InlineKeyboardButton(text='🔙 В меню', callback_data=MenuCb().pack())])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def build_broadcast_confirm_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='✅ Отправить', callback_data=BroadcastGoCb().pack())],
+        [InlineKeyboardButton(text='🔙 Отмена', callback_data=MenuCb().pack())],
+    ])
+
+def build_stats_keyboard() -> InlineKeyboardMarkup:
+    periods = [InlineKeyboardButton(text=title, callback_data=StatsCb(period=key).pack())
+               for key, (title, _) in STATS_PERIODS.items()]
+    periods.append(InlineKeyboardButton(text='Всё время', callback_data=StatsCb().pack()))
+    return InlineKeyboardMarkup(inline_keyboard=[periods] + build_admin_menu().inline_keyboard)
+
+def build_segments_keyboard() -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton(text=title, callback_data=SegmentPresetCb(key=key).pack())]
+               for key, (title, _) in SEGMENT_PRESETS.items()]
+    buttons.append([InlineKeyboardButton(text='🔙 В меню', callback_data=MenuCb().pack())])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def build_segment_keyboard(segment_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='📢 Рассылка по сегменту', callback_data=SegmentBroadcastCb(segment_id=segment_id).pack())],
+        [InlineKeyboardButton(text='🔄 Обновить', callback_data=SegmentCb(segment_id=segment_id).pack())],
+        [InlineKeyboardButton(text='🔙 К сегментам', callback_data=SegmentMenuCb().pack())],
+    ])
+
+# Статичные клавиатуры строятся один раз при импорте модуля
+ADMIN_MENU = build_admin_menu()
+SEGMENTS_KEYBOARD = build_segments_keyboard()
+STATS_KEYBOARD = build_stats_keyboard()
+BROADCAST_CONFIRM_KEYBOARD = build_broadcast_confirm_keyboard()
+
+def build_broadcast_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='⛔️ Остановить', callback_data=BroadcastStopCb(job_id=job_id).pack())],
+    ])
+
 # ==================== HANDLERS ====================
+class SearchStates(StatesGroup):
+    query = State()
+
+class BroadcastStates(StatesGroup):
+    text = State()
+
 async def is_admin(user_id):
     return user_id == ADMIN_ID
 
@@ -155,42 +2685,111 @@ async def cmd_start(message: Message):
     if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
-    await message.answer('Админ-меню:', reply_markup=build_admin_menu())
+    await message.answer('Админ-меню:', reply_markup=ADMIN_MENU)
 
 @dp.message(Command("stats"))
 async def cmd_stats(message: Message):
     if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
-    total, registered, deposited, total_deposits = stats()
-    text = (
-        f"Всего пользователей: {total}\n"
-        f"Зарегистрировано: {registered}\n"
-        f"С депозитом: {deposited}\n"
-        f"Сумма депозитов: {total_deposits}"
-    )
-    await message.reply(text)
+    parts = message.text.split()
+    period = parts[1].lower() if len(parts) > 1 else 'all'
+    if period != 'all' and period not in STATS_PERIODS:
+        await message.reply('Использование: /stats [today|7d|30d]')
+        return
+    await message.reply(await render_stats(period), reply_markup=STATS_KEYBOARD)
+
+def format_funnel(registered: int, deposited: int, deposit_sum: float) -> List[str]:
+    conversion = deposited / registered * 100 if registered else 0.0
+    average = deposit_sum / deposited if deposited else 0.0
+    return [
+        f"Конверсия рег → деп: {conversion:.1f}%",
+        f"Средний депозит: {average:.2f}",
+    ]
+
+async def render_stats(period: str = 'all') -> str:
+    if period in STATS_PERIODS:
+        title, days = STATS_PERIODS[period]
+        registered, deposited, deposit_sum = await period_stats(days)
+        repeat_count, repeat_sum = await repeat_deposit_stats(days)
+        lines = [
+            f"Период: {title}",
+            f"Регистраций: {registered}",
+            f"Депозитов: {deposited}",
+            f"Сумма депозитов: {deposit_sum}",
+            f"Повторных депозитов: {repeat_count} на сумму {repeat_sum:.2f}",
+        ]
+        return '\n'.join(lines + format_funnel(registered, deposited, deposit_sum)) + snapshot.caption()
+    total, registered, deposited, total_deposits = await stats()
+    repeat_users = await repeat_users_count()
+    repeat_share = f" ({repeat_users / deposited * 100:.1f}% от депозитивших)" if deposited else ''
+    lines = [
+        f"Всего пользователей: {total}",
+        f"Зарегистрировано: {registered}",
+        f"С депозитом: {deposited}",
+        f"Сумма депозитов: {total_deposits}",
+        f"С повторными депозитами: {repeat_users}{repeat_share}",
+    ]
+    return '\n'.join(lines + format_funnel(registered, deposited, total_deposits)) + snapshot.caption()
+
+@dp.message(Command("stats_rebuild"))
+async def cmd_stats_rebuild(message: Message):
+    if not await is_admin(message.from_user.id):
+        await message.reply('Доступ запрещён.')
+        return
+    old, fresh = await rebuild_stats()
+    if old is not None and tuple(old[:3]) == tuple(fresh[:3]) and abs(old[3] - fresh[3]) < 1e-6 and old[4] == fresh[4]:
+        await message.reply('Агрегаты согласованы, расхождений нет.')
+        return
+    before = ', '.join(str(v) for v in old) if old else '—'
+    after = ', '.join(str(v) for v in fresh)
+    await message.reply(f"Агрегаты пересчитаны.\nБыло: {before}\nСтало: {after}")
 
 @dp.message(Command("users"))
 async def cmd_users(message: Message):
     if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
-    await show_users_page(message, 0)
+    parts = message.text.split()
+    after = None
+    if len(parts) > 1:
+        # /users <user_id> — перейти к странице, начинающейся с этого ID
+        try:
+            after = int(parts[1]) - 1
+        except ValueError:
+            await message.reply('Использование: /users [user_id]')
+            return
+    await show_users_page(message, after=after)
 
-async def show_users_page(message_or_call, offset: int):
-    rows = fetch_users(offset, 10)
-    text_lines = []
-    for r in rows:
-        text_lines.append(
-            f"ID: {r['user_id']} | @{r['username'] or '—'} | Зарегистрирован: {'✅' if r['registered'] else '❌'} | Депозит: {'✅' if r.get('deposit_confirmed', 0) else '❌'}"
-        )
-    has_more = len(rows) == 10
-    text = '\n'.join(text_lines) if text_lines else 'Пользователи не найдены.'
+def format_user_line(r: sqlite3.Row) -> str:
+    return f"ID: {r['user_id']} | @{r['username'] or '—'} | Зарегистрирован: {'✅' if r['registered'] else '❌'} | Депозит: {'✅' if r['deposit_confirmed'] else '❌'}"
+
+async def render_users_page(after: Optional[int] = None, before: Optional[int] = None) -> Tuple[str, InlineKeyboardMarkup]:
+    key = ('users', after, before)
+    cached = render_cache.get(key)
+    if cached is not None:
+        return cached
+    rows, has_prev, has_next = await fetch_users(after, before, USERS_PAGE_SIZE)
+    text_lines = [format_user_line(r) for r in rows]
+    text = ('\n'.join(text_lines) if text_lines else 'Пользователи не найдены.') + snapshot.caption()
+    first_id = rows[0]['user_id'] if rows else None
+    last_id = rows[-1]['user_id'] if rows else None
+    kb = build_users_keyboard(first_id, last_id, has_prev, has_next)
+    # Keyset-страница зависит только от user_id в своём диапазоне: (after, last_id] или [first_id, before);
+    # у крайней страницы граница открыта — вставка за ней меняет кнопку «назад»/«вперёд»
+    span = (
+        (after if before is None else first_id - 1) if has_prev else None,
+        (last_id if before is None else before - 1) if has_next else None,
+    )
+    render_cache.put(key, text, kb, (r['user_id'] for r in rows), span)
+    return text, kb
+
+async def show_users_page(message_or_call, after: Optional[int] = None, before: Optional[int] = None):
+    text, kb = await render_users_page(after, before)
     if isinstance(message_or_call, Message):
-        await message_or_call.reply(text, reply_markup=build_users_keyboard(offset, has_more))
+        await message_or_call.reply(text, reply_markup=kb)
     else:
-        await message_or_call.message.edit_text(text, reply_markup=build_users_keyboard(offset, has_more))
+        await message_or_call.message.edit_text(text, reply_markup=kb)
 
 @dp.message(Command("user"))
 async def cmd_user(message: Message):
@@ -202,10 +2801,31 @@ async def cmd_user(message: Message):
         await message.reply('Использование: /user <user_id или username>')
         return
     identifier = parts[1].strip()
-    row = fetch_user(identifier)
+    await show_user_card(message, identifier)
+
+async def show_user_card(message_or_call, identifier):
+    if isinstance(message_or_call, CallbackQuery):
+        await message_or_call.answer()
+        message_or_call = message_or_call.message
+    text = await render_user_card(identifier)
+    await message_or_call.reply(text or 'Пользователь не найден.')
+
+async def render_user_card(identifier: str) -> Optional[str]:
+    identifier = str(identifier).strip().lstrip('@')
+    user_id = parse_user_id(identifier)
+    if user_id is not None:
+        cached = render_cache.get(('card', user_id))
+        if cached is not None:
+            return cached[0]
+    row = await fetch_user(identifier)
     if not row:
-        await message.reply('Пользователь не найден.')
-        return
+        return None
+    history = await fetch_deposit_history(row['user_id']) if row['deposits_count'] else []
+    text = format_user_card(row, history)
+    render_cache.put(('card', row['user_id']), text, None, (row['user_id'],))
+    return text
+
+def format_user_card(row, history: Sequence[sqlite3.Row] = ()) -> str:
     txt = []
     txt.append(f"ID: {row['user_id']}")
     txt.append(f"Username: @{row['username'] or '—'}")
@@ -216,22 +2836,128 @@ async def cmd_user(message: Message):
     txt.append(f"Дата депозита: {row['deposit_date'] or '—'}")
     txt.append(f"Trader ID: {row['trader_id'] or '—'}")
     txt.append(f"Click ID: {row['click_id'] or '—'}")
-    await message.reply('\n'.join(txt))
+    if row['deposits_count']:
+        txt.append(f"Депозитов всего: {row['deposits_count']} на сумму {row['deposits_total']:.2f}")
+    if history:
+        txt.append('Последние депозиты:')
+        for d in history:
+            when = datetime.fromtimestamp(d['ts'], timezone.utc).strftime('%Y-%m-%d %H:%M')
+            txt.append(f"  {when} — {d['amount']:.2f}")
+    return '\n'.join(txt)
 
 @dp.message(Command("search"))
-async def cmd_search(message: Message):
+async def cmd_search(message: Message, state: FSMContext):
     if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
+    parts = message.text.split(maxsplit=1)
+    if len(parts) == 2 and parts[1].strip():
+        await run_search(message, state, parts[1])
+        return
+    await state.set_state(SearchStates.query)
     await message.answer('Введите user_id или username для поиска:')
 
+async def run_search(message: Message, state: FSMContext, query: str):
+    query = query.strip()
+    await state.set_state(None)
+    await state.update_data(search_query=query)
+    await show_search_page(message, query, 0)
+
+async def show_search_page(message_or_call, query: str, offset: int):
+    rows, has_more, truncated = await search_users(query, offset, SEARCH_PAGE_SIZE)
+    if rows:
+        text = f'Результаты поиска «{query}»:\n\n' + '\n'.join(format_user_line(r) for r in rows)
+    else:
+        text = f'По запросу «{query}» ничего не найдено.'
+    if truncated:
+        text += f'\n\nСовпадений больше, показаны первые {SEARCH_CANDIDATES} — уточните запрос.'
+    text += snapshot.caption()
+    kb = build_search_keyboard(rows, offset, has_more)
+    if isinstance(message_or_call, Message):
+        await message_or_call.reply(text, reply_markup=kb)
+    else:
+        await message_or_call.message.edit_text(text, reply_markup=kb)
+
+# Инлайн-режим (@bot <фрагмент>) должен быть включён у бота в @BotFather (/setinline)
+inline_latest: Dict[int, str] = {}
+
+def build_inline_result(row: Dict[str, Any]) -> InlineQueryResultArticle:
+    title = f"@{row['username']}" if row['username'] else f"ID {row['user_id']}"
+    description = (
+        f"ID: {row['user_id']} | Рег: {'✅' if row['registered'] else '❌'} | "
+        f"Деп: {'✅ ' + str(row['deposit_amount'] or 0) if row['deposit_confirmed'] else '❌'}"
+    )
+    return InlineQueryResultArticle(
+        id=str(row['user_id']), title=title, description=description,
+        input_message_content=InputTextMessageContent(message_text=format_user_card(row)),
+    )
+
+@dp.inline_query()
+async def on_inline_query(query: InlineQuery):
+    if not await is_admin(query.from_user.id):
+        await query.answer([], is_personal=True, cache_time=INLINE_CACHE_TTL)
+        return
+    fragment = query.query.strip().lstrip('@')
+    if not fragment:
+        await query.answer([], is_personal=True, cache_time=0)
+        return
+    rows = inline_cache.lookup(fragment)
+    if rows is None:
+        # Пока админ печатает, каждый символ — новый inline_query; в БД идёт только последний
+        inline_latest[query.from_user.id] = query.id
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if inline_latest.get(query.from_user.id) != query.id:
+            return
+        try:
+            rows = await asyncio.wait_for(inline_cache.results(fragment), INLINE_DEADLINE)
+        except asyncio.TimeoutError:
+            logger.warning('Инлайн-поиск «%s» не уложился в %s с', fragment, INLINE_DEADLINE)
+            rows = []
+    # offset — позиция в закэшированном ранжированном списке, а не SQL OFFSET
+    start = int(query.offset) if query.offset.isdigit() else 0
+    page = rows[start:start + INLINE_PAGE_SIZE]
+    next_offset = str(start + INLINE_PAGE_SIZE) if start + INLINE_PAGE_SIZE < len(rows) else ''
+    await query.answer([build_inline_result(r) for r in page], is_personal=True,
+                       cache_time=INLINE_CACHE_TTL, next_offset=next_offset)
+
 @dp.message(Command("broadcast"))
-async def cmd_broadcast(message: Message):
+async def cmd_broadcast(message: Message, state: FSMContext):
     if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
+    await state.update_data(broadcast_segment=None)
+    parts = message.text.split(maxsplit=1)
+    if len(parts) == 2 and parts[1].strip():
+        await preview_broadcast(message, state, parts[1].strip())
+        return
+    await state.set_state(BroadcastStates.text)
     await message.answer('Введите текст для рассылки всем пользователям:')
 
+async def preview_broadcast(message: Message, state: FSMContext, text: str):
+    await state.set_state(None)
+    await state.update_data(broadcast_text=text)
+    segment_id = (await state.get_data()).get('broadcast_segment')
+    segment = await segments.get(segment_id) if segment_id is not None else None
+    if segment is not None:
+        audience = f"Сегмент #{segment['id']} ({segment['expr']}), получателей: {segment['member_count']}"
+    else:
+        total, _, _, _ = await stats()
+        audience = f"Получателей: {total}"
+    await message.reply(f"Текст рассылки:\n\n{text}\n\n{audience}. Отправить?",
+                        reply_markup=BROADCAST_CONFIRM_KEYBOARD)
+
+@dp.message(Command("broadcast_stop"))
+async def cmd_broadcast_stop(message: Message):
+    if not await is_admin(message.from_user.id):
+        await message.reply('Доступ запрещён.')
+        return
+    parts = message.text.split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        await message.reply('Использование: /broadcast_stop <id рассылки>')
+        return
+    ok = await broadcaster.cancel(int(parts[1]))
+    await message.reply('Рассылка остановлена.' if ok else 'Активная рассылка с таким ID не найдена.')
+
 @dp.message(Command("confirm_reg"))
 async def cmd_confirm_reg(message: Message):
     if not await is_admin(message.from_user.id):
@@ -246,7 +2972,7 @@ async def cmd_confirm_reg(message: Message):
     except ValueError:
         await message.reply('Некорректный user_id.')
         return
-    ok = confirm_registration(uid)
+    ok = await confirm_registration(uid)
     await message.reply('Регистрация подтверждена.' if ok else 'Пользователь не найден или уже подтверждён.')
 
 @dp.message(Command("confirm_dep"))
@@ -264,348 +2990,781 @@ async def cmd_confirm_dep(message: Message):
     except ValueError:
         await message.reply('Некорректные аргументы.')
         return
-    ok = confirm_deposit(uid, amt)
+    ok = await confirm_deposit(uid, amt)
     await message.reply('Депозит подтверждён.' if ok else 'Пользователь не найден или ошибка обновления.')
 
-@dp.callback_query()
-async def on_callback(call: CallbackQuery):
-    if not await is_admin(call.from_user.id):
-        await call.answer('Доступ запрещён.', show_alert=True)
+@dp.message(Command("perf"))
+async def cmd_perf(message: Message):
+    if not await is_admin(message.from_user.id):
+        await message.reply('Доступ запрещён.')
         return
-    data = call.data or ''
-    if data.startswith('admin:stats'):
-        total, registered, deposited, total_deposits = stats()
-        text = (
-            f"Всего пользователей: {total}\n"
-            f"Зарегистрировано: {registered}\n"
-            f"С депозитом: {deposited}\n"
-            f"Сумма депозитов: {total_deposits}"
-        )
-        await call.message.edit_text(text, reply_markup=build_admin_menu())
-    elif data.startswith('admin:users:'):
-        try:
-            offset = int(data.split(':')[-1])
-        except Exception:
-            offset = 0
-        await show_users_page(call, offset)
-    elif data.startswith('admin:search'):
-        await call.message.edit_text('Введите user_id или username для поиска:', reply_markup=build_admin_menu())
-    elif data.startswith('admin:broadcast'):
-        await call.message.edit_text('Введите текст для рассылки всем пользователям:', reply_markup=build_admin_menu())
-    elif data.startswith('admin:settings'):
-        await call.message.edit_text('Настройки (заглушка):\n\nПока здесь ничего нет.', reply_markup=build_admin_menu())
-    elif data.startswith('admin:menu'):
-        await call.message.edit_text('Админ-меню:', reply_markup=build_admin_menu())
-    else:
-        await call.answer()
-
-async def main():
-    ensure_users_table()
-    print("🚀 Admin бот запускается в режиме polling...")
-    await dp.start_polling(bot)
-
-if __name__ == "__main__":
-    asyncio.run(main())
-=======
-import os
-import asyncio
-import sqlite3
-from typing import List, Tuple, Optional
-
-from aiogram import Bot, Dispatcher
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
-from aiogram.filters import Command
-from dotenv import load_dotenv
-
-load_dotenv()
-
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-DB_PATH = os.getenv('USERS_DB', '../users.db')
-ADMIN_ID = 8444406750
-
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def ensure_users_table():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            registered INTEGER DEFAULT 0,
-            reg_date TEXT,
-            deposit_amount REAL DEFAULT 0,
-            deposit_confirmed INTEGER DEFAULT 0,
-            deposit_date TEXT,
-            trader_id TEXT,
-            click_id TEXT
-        )
-        """
-    )
-    conn.commit()
-    conn.close()
-
-def stats() -> Tuple[int, int, int, float]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT COUNT(*) FROM users')
-    total = cur.fetchone()[0]
-    cur.execute('SELECT COUNT(*) FROM users WHERE registered=1')
-    registered = cur.fetchone()[0]
-    cur.execute('SELECT COUNT(*) FROM users WHERE deposit_confirmed=1')
-    deposited = cur.fetchone()[0]
-    cur.execute('SELECT SUM(deposit_amount) FROM users WHERE deposit_confirmed=1')
-    s = cur.fetchone()[0]
-    total_deposits = float(s) if s is not None else 0.0
-    conn.close()
-    return total, registered, deposited, total_deposits
+    await message.reply(format_perf_report())
 
-def fetch_users(offset: int = 0, limit: int = 10) -> List[sqlite3.Row]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT user_id, username, registered FROM users ORDER BY user_id LIMIT ? OFFSET ?', (limit, offset))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def fetch_user(user_identifier: str) -> Optional[sqlite3.Row]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM users WHERE user_id=?', (user_identifier,))
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return row
-    cur.execute('SELECT * FROM users WHERE username=?', (user_identifier,))
-    row = cur.fetchone()
-    conn.close()
-    return row
-
-def search_users(query: str, offset: int = 0, limit: int = 10) -> List[sqlite3.Row]:
-    q = f"%{query}%"
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        'SELECT user_id, username, registered FROM users WHERE CAST(user_id AS TEXT) LIKE ? OR username LIKE ? OR trader_id LIKE ? ORDER BY user_id LIMIT ? OFFSET ?',
-        (q, q, q, limit, offset)
+def format_perf_report(top: int = 8) -> str:
+    def section(title: str, hist: Histogram) -> List[str]:
+        keys = sorted(hist.series, key=lambda k: hist.series[k][-1], reverse=True)[:top]
+        lines = [title]
+        if not keys:
+            lines.append('  нет данных')
+        for key in keys:
+            count = hist.series[key][-2]
+            lines.append(
+                f"  {key[:48]}: n={count} p50={hist.quantile(key, 0.5) * 1000:.1f}мс "
+                f"p99={hist.quantile(key, 0.99) * 1000:.1f}мс"
+            )
+        return lines
+    lines = []
+    lines += section('⏱ Хендлеры:', metrics.handler_seconds)
+    lines += section('🗄 SQL (по суммарному времени):', metrics.db_seconds)
+    lines += section('📡 Bot API:', metrics.api_seconds)
+    errors = sum(metrics.api_errors.values.values())
+    retry_after = sum(metrics.api_retry_after.values.values())
+    lines.append(f'Ошибки API: {errors:g}, RetryAfter: {retry_after:g}')
+    wait = metrics.outbound_wait
+    skipped = metrics.outbound_skipped.values
+    lines.append(
+        f"Очередь исходящих: p99 ожидания={wait.quantile('interactive', 0.99) * 1000:.1f}мс, "
+        f"склеено правок: {skipped.get('coalesced', 0):g}, без изменений: {skipped.get('not_modified', 0):g}"
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def confirm_registration(user_id: int) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('UPDATE users SET registered=1 WHERE user_id=?', (user_id,))
-    conn.commit()
-    updated = cur.rowcount
-    conn.close()
-    return updated > 0
-
-def confirm_deposit(user_id: int, amount: float) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('UPDATE users SET deposit_confirmed=1, deposit_amount=?, deposit_date=CURRENT_TIMESTAMP WHERE user_id=?', (amount, user_id))
-    conn.commit()
-    updated = cur.rowcount
-    conn.close()
-    return updated > 0
+    lag = metrics.loop_lag
+    lines.append(f"Лаг event loop: p50={lag.quantile('main', 0.5) * 1000:.1f}мс p99={lag.quantile('main', 0.99) * 1000:.1f}мс")
+    return '\n'.join(lines)
 
-def build_admin_menu() -> InlineKeyboardMarkup:
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text='📊 Статистика', callback_data='admin:stats')],
-        [InlineKeyboardButton(text='👥 Список пользователей', callback_data='admin:users:0')],
-        [InlineKeyboardButton(text='🔍 Поиск пользователя', callback_data='admin:search')],
-        [InlineKeyboardButton(text='📢 Рассылка', callback_data='admin:broadcast')],
-        [InlineKeyboardButton(text='⚙️ Настройки', callback_data='admin:settings')],
-    ])
-    return kb
+SEGMENT_USAGE = (
+    'Использование: /segment <условия>\n'
+    'reg, !reg, dep, !dep — регистрация / депозит\n'
+    'amount>=100 — сумма последнего депозита, total>=500 — сумма всех\n'
+    'deposits>=2 — число депозитов\n'
+    'reg_days<=7, dep_days<=30 — дней с регистрации / депозита\n'
+    'id>=1000 — диапазон user_id\n'
+    'Пример: /segment reg !dep reg_days<=7'
+)
 
-def build_users_keyboard(offset: int, has_more: bool) -> InlineKeyboardMarkup:
-    buttons = []
-    row = []
-    if offset > 0:
-        row.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'admin:users:{max(0, offset-10)}'))
-    if has_more:
-        row.append(InlineKeyboardButton(text='Далее ➡️', callback_data=f'admin:users:{offset+10}'))
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton(text='🔙 В меню', callback_data='admin:menu')])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+def render_segment(segment: sqlite3.Row) -> str:
+    refreshed = datetime.fromtimestamp(segment['refreshed_at'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    return (
+        f"🎯 Сегмент #{segment['id']}: {segment['expr']}\n"
+        f"Пользователей: {segment['member_count']}\n"
+        f"Полный пересчёт: {refreshed} UTC"
+    )
 
-async def on_start(message: Message):
-    if message.from_user.id != ADMIN_ID:
+@dp.message(Command("segment"))
+async def cmd_segment(message: Message):
+    if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
-    await message.answer('Админ-меню:', reply_markup=build_admin_menu())
-
-async def cmd_stats(message: Message):
-    if message.from_user.id != ADMIN_ID:
-        await message.reply('Доступ запрещён.')
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.reply(SEGMENT_USAGE, reply_markup=SEGMENTS_KEYBOARD)
         return
-    total, registered, deposited, total_deposits = stats()
-    text = (
-        f"Всего пользователей: {total}\n"
-        f"Зарегистрировано: {registered}\n"
-        f"С депозитом: {deposited}\n"
-        f"Сумма депозитов: {total_deposits}"
-    )
-    await message.reply(text)
+    try:
+        segment = await segments.open(parts[1])
+    except ValueError as e:
+        await message.reply(f'Ошибка: {e}\n\n{SEGMENT_USAGE}')
+        return
+    await message.reply(render_segment(segment), reply_markup=build_segment_keyboard(segment['id']))
 
-async def cmd_users(message: Message):
-    if message.from_user.id != ADMIN_ID:
+@dp.message(Command("export"))
+async def cmd_export(message: Message):
+    if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
-    await show_users_page(message, 0)
-
-async def show_users_page(message_or_call, offset: int):
-    rows = fetch_users(offset, 10)
-    text_lines = []
-    for r in rows:
-        text_lines.append(
-            f"ID: {r['user_id']} | @{r['username'] or '—'} | Зарегистрирован: {'✅' if r['registered'] else '❌'} | Депозит: {'✅' if r.get('deposit_confirmed', 0) else '❌'}"
+    try:
+        fmt, filters = parse_export_args(message.text.split()[1:])
+    except ValueError as e:
+        await message.reply(
+            f'Ошибка: {e}\n'
+            'Использование: /export [csv|xlsx] [registered] [deposited] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]'
         )
-    has_more = len(rows) == 10
-    text = '\n'.join(text_lines) if text_lines else 'Пользователи не найдены.'
-    if isinstance(message_or_call, Message):
-        await message_or_call.reply(text, reply_markup=build_users_keyboard(offset, has_more))
-    else:
-        await message_or_call.message.edit_text(text, reply_markup=build_users_keyboard(offset, has_more))
+        return
+    total = (await stats())[0] if filters.empty else None
+    status = await message.reply('Экспорт запущен…')
+    reported = [0]
 
-async def cmd_user(message: Message):
-    if message.from_user.id != ADMIN_ID:
+    async def on_progress(done: int):
+        if done == reported[0]:
+            return
+        reported[0] = done
+        text = f'Экспорт: выгружено {done}' + (f' из {total}' if total else '') + ' строк…'
+        try:
+            await status.edit_text(text)
+        except TelegramAPIError:
+            pass
+
+    suffix = '.xlsx' if fmt == 'xlsx' else '.csv.gz'
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        count = await export_users(path, fmt, filters, on_progress)
+        size = os.path.getsize(path)
+        if size > TELEGRAM_DOCUMENT_LIMIT:
+            await status.edit_text(f'Файл слишком большой для отправки ботом ({size // (1024 * 1024)} МБ). Уточните фильтры.')
+            return
+        filename = f"users_{datetime.now():%Y%m%d_%H%M}{suffix}"
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f'Экспорт: {count} строк.')
+        await status.edit_text(f'Экспорт завершён: {count} строк.')
+    except (OSError, sqlite3.Error) as e:
+        await status.edit_text(f'Ошибка экспорта: {e}')
+    finally:
+        os.remove(path)
+
+@dp.message(Command("import"))
+async def cmd_import(message: Message):
+    if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
-        await message.reply('Использование: /user <user_id или username>')
+        await message.reply('Использование: /import <путь к CSV/JSONL> или отправьте файл документом.')
         return
-    identifier = parts[1].strip()
-    await show_user_card(message, identifier)
-
-async def show_user_card(message_or_call, identifier):
-    row = fetch_user(identifier)
-    if not row:
-        await message_or_call.reply('Пользователь не найден.')
+    path = parts[1].strip()
+    if not os.path.isfile(path):
+        await message.reply('Файл не найден.')
         return
-    txt = []
-    txt.append(f"ID: {row['user_id']}")
-    txt.append(f"Username: @{row['username'] or '—'}")
-    txt.append(f"Зарегистрирован: {'Да' if row['registered'] else 'Нет'}")
-    txt.append(f"Дата регистрации: {row['reg_date'] or '—'}")
-    txt.append(f"Депозит подтверждён: {'Да' if row['deposit_confirmed'] else 'Нет'}")
-    txt.append(f"Сумма депозита: {row['deposit_amount'] or 0}")
-    txt.append(f"Дата депозита: {row['deposit_date'] or '—'}")
-    txt.append(f"Trader ID: {row['trader_id'] or '—'}")
-    txt.append(f"Click ID: {row['click_id'] or '—'}")
-    await message_or_call.reply('\n'.join(txt))
+    await run_import(message, path)
 
-async def cmd_search(message: Message):
-    if message.from_user.id != ADMIN_ID:
+@dp.message(F.document)
+async def on_import_document(message: Message):
+    if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
-    await message.answer('Введите user_id или username для поиска:')
+    name = message.document.file_name or 'import.csv'
+    if not name.lower().endswith(('.csv', '.jsonl', '.ndjson', '.json', '.txt')):
+        await message.reply('Поддерживаются файлы CSV и JSONL.')
+        return
+    suffix = os.path.splitext(name)[1]
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        await bot.download(message.document, destination=path)
+        await run_import(message, path)
+    finally:
+        os.remove(path)
+
+async def run_import(message: Message, path: str):
+    await message.reply('Импорт запущен…')
+    try:
+        summary = await import_file(path)
+    except (OSError, UnicodeDecodeError, ValueError, OverflowError, csv.Error, sqlite3.Error) as e:
+        await message.reply(f'Ошибка импорта: {e}')
+        return
+    await message.reply(format_import_summary(summary))
 
-async def cmd_broadcast(message: Message):
-    if message.from_user.id != ADMIN_ID:
+@dp.message(SearchStates.query)
+async def on_search_query(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
-    await message.answer('Введите текст для рассылки всем пользователям:')
+    if not message.text:
+        await message.reply('Введите текст запроса.')
+        return
+    await run_search(message, state, message.text)
 
-async def cmd_confirm_reg(message: Message):
-    if message.from_user.id != ADMIN_ID:
+@dp.message(BroadcastStates.text)
+async def on_broadcast_text(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
         await message.reply('Доступ запрещён.')
         return
-    parts = message.text.split()
-    if len(parts) != 2:
-        await message.reply('Использование: /confirm_reg <user_id>')
+    if not message.text:
+        await message.reply('Поддерживается только текст.')
         return
-    try:
-        uid = int(parts[1])
-    except ValueError:
-        await message.reply('Некорректный user_id.')
+    await preview_broadcast(message, state, message.text)
+
+@dp.callback_query()
+async def on_callback(call: CallbackQuery, state: FSMContext):
+    if not await is_admin(call.from_user.id):
+        await call.answer('Доступ запрещён.', show_alert=True)
         return
-    ok = confirm_registration(uid)
-    await message.reply('Регистрация подтверждена.' if ok else 'Пользователь не найден или уже подтверждён.')
+    resolved = callbacks.resolve(call.data or '')
+    if resolved is None:
+        await call.answer('Кнопка устарела, откройте меню заново.')
+        return
+    handler, payload = resolved
+    start = time.perf_counter()
+    try:
+        await handler(call, payload, state)
+    finally:
+        metrics.handler_seconds.observe(f'callback:{handler.__name__}', time.perf_counter() - start)
 
-async def cmd_confirm_dep(message: Message):
-    if message.from_user.id != ADMIN_ID:
-        await message.reply('Доступ запрещён.')
+@callbacks.route(StatsCb)
+async def on_stats(call: CallbackQuery, payload: StatsCb, state: FSMContext):
+    period = payload.period if payload.period in STATS_PERIODS else 'all'
+    await call.message.edit_text(await render_stats(period), reply_markup=STATS_KEYBOARD)
+
+@callbacks.route(UsersPageCb)
+async def on_users_page(call: CallbackQuery, payload: UsersPageCb, state: FSMContext):
+    if payload.cursor is not None and payload.direction == 'p':
+        await show_users_page(call, before=payload.cursor)
+    else:
+        await show_users_page(call, after=payload.cursor)
+
+@callbacks.route(UserCardCb)
+async def on_user_card(call: CallbackQuery, payload: UserCardCb, state: FSMContext):
+    await show_user_card(call, str(payload.user_id))
+
+@callbacks.route(SearchPromptCb)
+async def on_search_prompt(call: CallbackQuery, payload: SearchPromptCb, state: FSMContext):
+    await state.set_state(SearchStates.query)
+    await call.message.edit_text('Введите user_id или username для поиска:', reply_markup=ADMIN_MENU)
+
+@callbacks.route(SearchPageCb)
+async def on_search_page(call: CallbackQuery, payload: SearchPageCb, state: FSMContext):
+    query = (await state.get_data()).get('search_query')
+    if not query:
+        await call.answer('Поиск устарел, начните заново.', show_alert=True)
         return
-    parts = message.text.split()
-    if len(parts) != 3:
-        await message.reply('Использование: /confirm_dep <user_id> <сумма>')
+    await show_search_page(call, query, max(0, payload.offset))
+
+@callbacks.route(BroadcastPromptCb)
+async def on_broadcast_prompt(call: CallbackQuery, payload: BroadcastPromptCb, state: FSMContext):
+    await state.update_data(broadcast_segment=None)
+    await state.set_state(BroadcastStates.text)
+    await call.message.edit_text('Введите текст для рассылки всем пользователям:', reply_markup=ADMIN_MENU)
+
+@callbacks.route(BroadcastGoCb)
+async def on_broadcast_go(call: CallbackQuery, payload: BroadcastGoCb, state: FSMContext):
+    data = await state.get_data()
+    text = data.get('broadcast_text')
+    if not text:
+        await call.answer('Текст рассылки не найден, начните заново.', show_alert=True)
         return
+    await state.update_data(broadcast_text=None, broadcast_segment=None)
     try:
-        uid = int(parts[1])
-        amt = float(parts[2])
-    except ValueError:
-        await message.reply('Некорректные аргументы.')
+        job_id = await broadcaster.create(text, call.message.chat.id, data.get('broadcast_segment'))
+    except ValueError as e:
+        await call.answer(f'Ошибка: {e}', show_alert=True)
         return
-    ok = confirm_deposit(uid, amt)
-    await message.reply('Депозит подтверждён.' if ok else 'Пользователь не найден или ошибка обновления.')
+    await call.message.edit_text(f'Рассылка #{job_id} запущена.')
 
-async def on_callback(call: CallbackQuery):
-    if call.from_user.id != ADMIN_ID:
-        await call.answer('Доступ запрещён.', show_alert=True)
+@callbacks.route(BroadcastStopCb)
+async def on_broadcast_stop(call: CallbackQuery, payload: BroadcastStopCb, state: FSMContext):
+    ok = await broadcaster.cancel(payload.job_id)
+    await call.answer('Рассылка остановлена.' if ok else 'Рассылка уже завершена.')
+
+@callbacks.route(SettingsCb)
+async def on_settings(call: CallbackQuery, payload: SettingsCb, state: FSMContext):
+    await call.message.edit_text('Настройки (заглушка):\n\nПока здесь ничего нет.', reply_markup=ADMIN_MENU)
+
+@callbacks.route(SegmentMenuCb)
+async def on_segment_menu(call: CallbackQuery, payload: SegmentMenuCb, state: FSMContext):
+    await call.message.edit_text(SEGMENT_USAGE, reply_markup=SEGMENTS_KEYBOARD)
+
+@callbacks.route(SegmentPresetCb)
+async def on_segment_preset(call: CallbackQuery, payload: SegmentPresetCb, state: FSMContext):
+    preset = SEGMENT_PRESETS.get(payload.key)
+    if preset is None:
+        await call.answer('Кнопка устарела, откройте меню заново.')
         return
-    data = call.data or ''
-    if data.startswith('admin:stats'):
-        total, registered, deposited, total_deposits = stats()
-        text = (
-            f"Всего пользователей: {total}\n"
-            f"Зарегистрировано: {registered}\n"
-            f"С депозитом: {deposited}\n"
-            f"Сумма депозитов: {total_deposits}"
-        )
-        await call.message.edit_text(text, reply_markup=build_admin_menu())
-    elif data.startswith('admin:users:'):
+    segment = await segments.open(preset[1])
+    await call.message.edit_text(render_segment(segment), reply_markup=build_segment_keyboard(segment['id']))
+
+@callbacks.route(SegmentCb)
+async def on_segment(call: CallbackQuery, payload: SegmentCb, state: FSMContext):
+    segment = await segments.get(payload.segment_id)
+    if segment is None:
+        await call.answer('Сегмент удалён, создайте его заново.', show_alert=True)
+        return
+    await call.message.edit_text(render_segment(segment), reply_markup=build_segment_keyboard(segment['id']))
+
+@callbacks.route(SegmentBroadcastCb)
+async def on_segment_broadcast(call: CallbackQuery, payload: SegmentBroadcastCb, state: FSMContext):
+    await state.update_data(broadcast_segment=payload.segment_id)
+    await state.set_state(BroadcastStates.text)
+    await call.message.edit_text(f'Введите текст для рассылки по сегменту #{payload.segment_id}:',
+                                 reply_markup=ADMIN_MENU)
+
+@callbacks.route(MenuCb)
+async def on_menu(call: CallbackQuery, payload: MenuCb, state: FSMContext):
+    await call.message.edit_text('Админ-меню:', reply_markup=ADMIN_MENU)
+
+# ==================== STARTUP ====================
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '127.0.0.1')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+
+background_tasks: List[asyncio.Task] = []
+metrics_runner: Optional[web.AppRunner] = None
+
+@dp.startup()
+async def on_startup():
+    global metrics_runner
+    await db.open()
+    await ensure_users_table()
+    await writes.start()
+    await snapshot.start()
+    if RUNS_BACKGROUND_JOBS:
+        await broadcaster.resume_pending()
+        change_feed.start()
+        if WORKER_ROLE is not None:
+            background_tasks.append(asyncio.create_task(broadcaster.watch()))
+    background_tasks.append(asyncio.create_task(monitor_loop_lag()))
+    if RENDER_CACHE_POLL > 0 and not snapshot.enabled:
+        # Со снимком страницы читаются из него и сбрасываются при его обновлении
+        background_tasks.append(asyncio.create_task(render_cache.follow()))
+    if METRICS_PORT:
+        app = web.Application()
+        app.router.add_get('/metrics', metrics_endpoint)
+        metrics_runner = web.AppRunner(app)
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    if BOT_MODE == 'webhook' and WEBHOOK_URL and WORKER_ROLE is None:
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+
+@dp.shutdown()
+async def on_shutdown():
+    global metrics_runner
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+    await broadcaster.shutdown()
+    await change_feed.stop()
+    await outbound.close()
+    await writes.close()
+    await snapshot.close()
+    await fsm_storage.close()
+    await db.close()
+
+async def health(request: web.Request) -> web.Response:
+    try:
+        await db.fetchone('SELECT 1')
+    except sqlite3.Error as e:
+        return web.json_response({'status': 'error', 'error': str(e)}, status=503)
+    return web.json_response({'status': 'ok', 'mode': BOT_MODE})
+
+def build_webhook_app() -> web.Application:
+    # Апдейты обрабатываются в фоновых задачах (handle_in_background), ответ Telegram уходит сразу
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    app.router.add_get('/health', health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    runner = web.AppRunner(build_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    print(f"🚀 Admin бот запускается в режиме webhook на {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}...")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # cleanup дожидается завершения запросов и вызывает shutdown-хуки диспетчера
+        await runner.cleanup()
+
+async def run_polling():
+    print("🚀 Admin бот запускается в режиме polling...")
+    await dp.start_polling(bot)
+
+# ==================== WORKERS ====================
+# WORKERS > 0 — режим супервизора: лёгкий фронт-процесс принимает апдейты (polling или webhook)
+# и раздаёт сырой JSON по локальным сокетам N процессам-шардам по chat id, так что апдейты
+# одного чата обрабатываются одним процессом по порядку. Долгие задачи (экспорт, импорт,
+# пересчёт агрегатов, рассылки, сводка изменений) уходят в отдельный пул фоновых воркеров.
+# Все процессы — на одной машине и с одной SQLite-базой в WAL.
+WORKERS = int(os.getenv('WORKERS', '0'))
+BACKGROUND_WORKERS = max(1, int(os.getenv('BACKGROUND_WORKERS', '1')))
+WORKER_PING_INTERVAL = float(os.getenv('WORKER_PING_INTERVAL', '5'))
+WORKER_PING_TIMEOUT = float(os.getenv('WORKER_PING_TIMEOUT', '30'))
+WORKER_START_TIMEOUT = float(os.getenv('WORKER_START_TIMEOUT', '120'))
+WORKER_STOP_TIMEOUT = float(os.getenv('WORKER_STOP_TIMEOUT', '30'))
+WORKER_RESTART_MAX_DELAY = 30.0
+WORKER_LINE_LIMIT = 16 * 1024 * 1024
+POLLING_TIMEOUT = 30
+# Эти обработчики (и приём документа на импорт) не пишут FSM, поэтому их можно увести из шарда чата:
+# кэш состояний SQLiteStorage локален для процесса
+BACKGROUND_COMMANDS = frozenset({'export', 'import', 'stats_rebuild'})
+
+
+def update_chat_id(update: Dict[str, Any]) -> int:
+    # По сырому JSON, без разбора в модели aiogram: чат сообщения, иначе автор (инлайн-запросы и т.п.)
+    for payload in update.values():
+        if not isinstance(payload, dict):
+            continue
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = payload.get('from') or payload.get('user')
+        if user:
+            return user['id']
+    return 0
+
+
+def is_background_update(update: Dict[str, Any]) -> bool:
+    message = update.get('message')
+    if not message:
+        return False
+    if message.get('document'):
+        return True
+    text = message.get('text') or ''
+    if not text.startswith('/'):
+        return False
+    command = text.split(maxsplit=1)[0][1:].split('@', 1)[0].lower()
+    return command in BACKGROUND_COMMANDS
+
+
+def encode_line(payload: Dict[str, Any]) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+
+
+# Дочерний процесс и его конец socketpair. Протокол — JSON по строке: супервизор шлёт апдейты
+# и {"ping": n}, воркер отвечает {"ready": true} после старта, {"ack": update_id} и {"pong": n}.
+# Апдейт без ack после падения воркера уходит новому процессу; уже начатый — нет, обработчики не идемпотентны
+class WorkerProcess:
+    def __init__(self, role: str, index: int, slot: int):
+        self.role = role
+        self.index = index
+        self.slot = slot
+        self.name = f'{role}#{index}'
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.unacked: 'OrderedDict[int, bytes]' = OrderedDict()
+        self.ready = False
+        self.last_seen = 0.0
+        self.inflight = 0
+        self.restarts = 0
+        self._pings = itertools.count(1)
+        self._reader_task: Optional[asyncio.Task] = None
+
+    def _env(self, fd: int) -> Dict[str, str]:
+        env = dict(os.environ, WORKER_ROLE=self.role, WORKER_INDEX=str(self.index), WORKER_FD=str(fd),
+                   OUTBOUND_PROCESSES=str(WORKERS + BACKGROUND_WORKERS))
+        if METRICS_PORT:
+            env['METRICS_PORT'] = str(METRICS_PORT + 1 + self.slot)
+        if SNAPSHOT_MODE and SNAPSHOT_MODE != 'memory':
+            # Снимок пишется через .tmp и подменяется — у каждого процесса должен быть свой файл
+            env['SNAPSHOT'] = f'{SNAPSHOT_MODE}.{self.role}{self.index}'
+        return env
+
+    async def spawn(self):
+        parent, child = socket.socketpair()
         try:
-            offset = int(data.split(':')[-1])
-        except Exception:
-            offset = 0
-        await show_users_page(call, offset)
-    elif data.startswith('admin:search'):
-        await call.message.edit_text('Введите user_id или username для поиска:', reply_markup=build_admin_menu())
-    elif data.startswith('admin:broadcast'):
-        await call.message.edit_text('Введите текст для рассылки всем пользователям:', reply_markup=build_admin_menu())
-    elif data.startswith('admin:settings'):
-        await call.message.edit_text('Настройки (заглушка):\n\nПока здесь ничего нет.', reply_markup=build_admin_menu())
-    elif data.startswith('admin:menu'):
-        await call.message.edit_text('Админ-меню:', reply_markup=build_admin_menu())
+            self.proc = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__),
+                env=self._env(child.fileno()), pass_fds=(child.fileno(),),
+            )
+        except BaseException:
+            parent.close()
+            raise
+        finally:
+            child.close()
+        reader, self.writer = await asyncio.open_unix_connection(sock=parent, limit=WORKER_LINE_LIMIT)
+        self.ready = False
+        self.inflight = 0
+        self.last_seen = time.monotonic()
+        self._reader_task = asyncio.create_task(self._read(reader))
+        # Всё, что прошлый процесс не подтвердил, — первым и в исходном порядке
+        for line in self.unacked.values():
+            self.writer.write(line)
+        logger.info('Воркер %s запущен, pid %s', self.name, self.proc.pid)
+
+    def send(self, update_id: int, line: bytes):
+        # Пока процесс перезапускается, апдейты копятся в unacked
+        self.unacked[update_id] = line
+        if self.writer is not None:
+            self.writer.write(line)
+
+    def ping(self):
+        if self.writer is not None and self.ready:
+            self.writer.write(encode_line({'ping': next(self._pings)}))
+
+    async def _read(self, reader: asyncio.StreamReader):
+        while True:
+            try:
+                line = await reader.readline()
+            except (ConnectionError, ValueError):
+                return
+            if not line:
+                return
+            msg = json.loads(line)
+            self.last_seen = time.monotonic()
+            if 'ack' in msg:
+                self.unacked.pop(msg['ack'], None)
+            elif 'pong' in msg:
+                self.inflight = msg.get('inflight', 0)
+            elif msg.get('ready'):
+                self.ready = True
+
+    async def _watch(self):
+        # Возвращается, когда процесс завершился сам или перестал отвечать и был убит
+        while True:
+            try:
+                await asyncio.wait_for(self.proc.wait(), WORKER_PING_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            silent = time.monotonic() - self.last_seen
+            if silent > (WORKER_PING_TIMEOUT if self.ready else WORKER_START_TIMEOUT):
+                logger.error('Воркер %s не отвечает %.0f с, перезапускаю', self.name, silent)
+                self.proc.kill()
+                await self.proc.wait()
+                return
+            self.ping()
+
+    def _detach(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        self.ready = False
+
+    async def supervise(self):
+        delay = 1.0
+        while True:
+            try:
+                await self.spawn()
+            except OSError:
+                logger.exception('Не удалось запустить воркер %s', self.name)
+            else:
+                started = time.monotonic()
+                try:
+                    await self._watch()
+                finally:
+                    self._detach()
+                if time.monotonic() - started > 2 * WORKER_RESTART_MAX_DELAY:
+                    delay = 1.0
+                self.restarts += 1
+                logger.warning('Воркер %s завершился с кодом %s (в обработке было %s, ждут доставки %s), '
+                               'перезапуск через %.0f с', self.name, self.proc.returncode, self.inflight,
+                               len(self.unacked), delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+
+    async def stop(self, timeout: float = WORKER_STOP_TIMEOUT):
+        self._detach()
+        if self.proc is None or self.proc.returncode is not None:
+            return
+        self.proc.terminate()
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Воркер %s не завершился за %s с, убиваю', self.name, timeout)
+            self.proc.kill()
+            await self.proc.wait()
+
+    def health(self) -> Dict[str, Any]:
+        running = self.proc is not None and self.proc.returncode is None
+        return {
+            'name': self.name,
+            'pid': self.proc.pid if running else None,
+            'ready': running and self.ready,
+            'restarts': self.restarts,
+            'inflight': self.inflight,
+            'queued': len(self.unacked),
+            'last_seen_s': round(time.monotonic() - self.last_seen, 1) if running else None,
+        }
+
+
+class Supervisor:
+    def __init__(self, shards: int = WORKERS, background: int = BACKGROUND_WORKERS):
+        self.shards = [WorkerProcess('shard', i, i) for i in range(shards)]
+        self.background = [WorkerProcess('background', i, shards + i) for i in range(background)]
+        self._tasks: List[asyncio.Task] = []
+        self._stop = asyncio.Event()
+
+    @property
+    def workers(self) -> List[WorkerProcess]:
+        return self.shards + self.background
+
+    def dispatch(self, update: Dict[str, Any]):
+        pool = self.background if is_background_update(update) else self.shards
+        pool[update_chat_id(update) % len(pool)].send(update['update_id'], encode_line(update))
+
+    def start(self):
+        self._tasks = [asyncio.create_task(w.supervise()) for w in self.workers]
+
+    def stop(self):
+        self._stop.set()
+
+    async def wait(self):
+        await self._stop.wait()
+
+    async def close(self):
+        # Сначала снимаем надзор, чтобы остановленные процессы не перезапускались
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        await asyncio.gather(*(w.stop() for w in self.workers))
+        lost = sum(len(w.unacked) for w in self.workers)
+        if lost:
+            logger.warning('Остановка: %s апдейтов не доставлено воркерам', lost)
+
+    def health(self) -> Dict[str, Any]:
+        workers = [w.health() for w in self.workers]
+        return {
+            'status': 'ok' if all(w['ready'] for w in workers) else 'degraded',
+            'mode': BOT_MODE,
+            'workers': workers,
+        }
+
+
+supervisor = Supervisor()
+
+
+async def front_health(request: web.Request) -> web.Response:
+    report = supervisor.health()
+    return web.json_response(report, status=200 if report['status'] == 'ok' else 503)
+
+async def front_webhook(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    supervisor.dispatch(await request.json())
+    return web.Response()
+
+async def poll_updates():
+    # Фронт не разбирает апдейты в модели aiogram: ответ getUpdates сразу раскладывается по воркерам
+    url = bot.session.api.api_url(token=bot.token, method='getUpdates')
+    params: Dict[str, Any] = {'timeout': POLLING_TIMEOUT, 'allowed_updates': dp.resolve_used_update_types()}
+    delay = 1.0
+    async with ClientSession(timeout=ClientTimeout(total=POLLING_TIMEOUT + 10)) as http:
+        while True:
+            try:
+                async with http.post(url, json=params) as resp:
+                    payload = await resp.json(content_type=None)
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning('getUpdates: %s, повтор через %.0f с', e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+                continue
+            if not payload.get('ok'):
+                retry_after = (payload.get('parameters') or {}).get('retry_after') or delay
+                logger.warning('getUpdates: %s, повтор через %s с', payload.get('description'), retry_after)
+                await asyncio.sleep(retry_after)
+                delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+                continue
+            delay = 1.0
+            for update in payload['result']:
+                supervisor.dispatch(update)
+                params['offset'] = update['update_id'] + 1
+
+async def run_supervisor():
+    # Миграции — один раз до старта воркеров, а не наперегонки из каждого процесса
+    await db.open()
+    try:
+        await ensure_users_table()
+    finally:
+        await db.close()
+    supervisor.start()
+    runner: Optional[web.AppRunner] = None
+    poller: Optional[asyncio.Task] = None
+    if BOT_MODE == 'webhook' or METRICS_PORT:
+        app = web.Application()
+        app.router.add_get('/health', front_health)
+        if BOT_MODE == 'webhook':
+            app.router.add_post(WEBHOOK_PATH, front_webhook)
+            host, port = WEBAPP_HOST, WEBAPP_PORT
+        else:
+            host, port = METRICS_HOST, METRICS_PORT
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+    if BOT_MODE == 'webhook':
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=dp.resolve_used_update_types())
     else:
-        await call.answer()
-
-def main():
-    ensure_users_table()
-    if not BOT_TOKEN:
-        print('Пожалуйста, укажите BOT_TOKEN в .env или переменных среды')
-        return
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
-
-    dp.message.register(on_start, Command(commands=['start']))
-    dp.message.register(cmd_stats, Command(commands=['stats']))
-    dp.message.register(cmd_users, Command(commands=['users']))
-    dp.message.register(cmd_user, Command(commands=['user']))
-    dp.message.register(cmd_search, Command(commands=['search']))
-    dp.message.register(cmd_broadcast, Command(commands=['broadcast']))
-    dp.message.register(cmd_confirm_reg, Command(commands=['confirm_reg']))
-    dp.message.register(cmd_confirm_dep, Command(commands=['confirm_dep']))
-    dp.callback_query.register(on_callback)
-
-    async def _run():
+        poller = asyncio.create_task(poll_updates())
+        poller.add_done_callback(lambda _: supervisor.stop())
+    print(f"🚀 Admin бот запускается в режиме {BOT_MODE}: воркеров {WORKERS}, фоновых {BACKGROUND_WORKERS}...")
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, supervisor.stop)
+    try:
+        await supervisor.wait()
+    finally:
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        if runner is not None:
+            await runner.cleanup()
+        await supervisor.close()
+        await bot.session.close()
+
+async def run_worker():
+    sock = socket.socket(fileno=int(os.environ['WORKER_FD']))
+    reader, writer = await asyncio.open_unix_connection(sock=sock, limit=WORKER_LINE_LIMIT)
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    # Ctrl+C в терминале приходит всей группе процессов; останавливает воркеры супервизор
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    handling: Set[asyncio.Task] = set()
+    chat_tails: Dict[int, asyncio.Task] = {}
+
+    async def handle(update: Dict[str, Any], previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await dp.feed_update(bot, types.Update.model_validate(update, context={'bot': bot}))
+        except Exception:
+            logger.exception('Ошибка обработки апдейта %s', update.get('update_id'))
+
+    def forget(chat_id: int, task: asyncio.Task):
+        handling.discard(task)
+        if chat_tails.get(chat_id) is task:
+            del chat_tails[chat_id]
+
+    async def read_updates():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return  # супервизор закрыл сокет
+            msg = json.loads(line)
+            if 'update_id' not in msg:
+                writer.write(encode_line({'pong': msg.get('ping'), 'inflight': len(handling)}))
+                continue
+            writer.write(encode_line({'ack': msg['update_id']}))
+            # Следующий апдейт чата ждёт предыдущий — порядок внутри чата как у Telegram
+            chat_id = update_chat_id(msg)
+            task = asyncio.create_task(handle(msg, chat_tails.get(chat_id)))
+            chat_tails[chat_id] = task
+            handling.add(task)
+            task.add_done_callback(partial(forget, chat_id))
+
+    writer.write(encode_line({'ready': True}))
+    logger.info('Воркер %s#%s готов, pid %s', WORKER_ROLE, WORKER_INDEX, os.getpid())
+    reading = asyncio.create_task(read_updates())
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait({reading, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        if reading.done():
+            reading.result()
+    finally:
+        reading.cancel()
+        stopping.cancel()
+        if handling:
+            _, left = await asyncio.wait(set(handling), timeout=WORKER_STOP_TIMEOUT)
+            for task in left:
+                task.cancel()
+        writer.close()
         try:
-            await dp.start_polling(bot)
+            await dp.emit_shutdown(bot=bot, dispatcher=dp)
         finally:
             await bot.session.close()
 
-    asyncio.run(_run())
+async def main():
+    if WORKER_ROLE is not None:
+        await run_worker()
+    elif WORKERS > 0:
+        await run_supervisor()
+    elif BOT_MODE == 'webhook':
+        await run_webhook()
+    else:
+        await run_polling()
 
-if __name__ == '__main__':
-    main()
->>>>>>> a380bdbc38c9d77587f388474d6ba9a2dfc96991
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import asyncio
+import argparse
+import itertools
+import platform
+import statistics
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List
+
+# Бенчмарки для admin_bot.py на синтетических данных.
+#
+#   python bench.py generate --rows 1000000 --db bench_1m.db
+#   python bench.py run --db bench_1m.db --out results.json
+#   python bench.py compare old.json new.json
+#
+# Запуск бенчмарков изменяет базу (confirm_*), поэтому по умолчанию работаем с копией.
+
+PRESETS = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+SYLLABLES = ['ka', 'ri', 'mo', 'an', 'to', 'le', 'vi', 'sa', 'ne', 'dro', 'max', 'pro', 'el', 'yu', 'zo', 'tra', 'de']
+
+
+def parse_rows(value: str) -> int:
+    value = value.lower()
+    return PRESETS[value] if value in PRESETS else int(value)
+
+
+def iter_users(rows: int, seed: int):
+    rnd = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    user_id = 100_000_000
+    for i in range(rows):
+        user_id += rnd.randint(1, 40)
+        username = None
+        if rnd.random() < 0.7:
+            username = ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))) + str(rnd.randint(0, 9999))
+        registered = rnd.random() < 0.6
+        deposited = registered and rnd.random() < 0.25
+        reg_date = (start + timedelta(seconds=rnd.randint(0, 86400 * 600))) if registered else None
+        amount = round(rnd.lognormvariate(4, 1), 2) if deposited else 0
+        dep_date = (reg_date + timedelta(seconds=rnd.randint(60, 86400 * 30))) if deposited else None
+        yield (
+            user_id,
+            username,
+            int(registered),
+            reg_date.isoformat() if reg_date else None,
+            amount,
+            int(deposited),
+            dep_date.isoformat() if dep_date else None,
+            f'TR{rnd.randint(10 ** 7, 10 ** 8 - 1)}' if registered else None,
+            f'clk{i:x}{rnd.randint(0, 0xffff):04x}',
+        )
+
+
+def generate(db_path: str, rows: int, seed: int, batch: int = 50_000):
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    os.environ['USERS_DB'] = db_path
+    import admin_bot
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.executescript(admin_bot.USERS_SCHEMA_SQL)
+    started = time.perf_counter()
+    users = iter_users(rows, seed)
+    done = 0
+    while True:
+        chunk = list(itertools.islice(users, batch))
+        if not chunk:
+            break
+        with conn:
+            conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', chunk)
+        done += len(chunk)
+        print(f'\r{done}/{rows}', end='', file=sys.stderr)
+    conn.close()
+    print(file=sys.stderr)
+
+    # Индексы, триггеры и агрегаты создаются миграциями уже после массовой вставки
+    async def _migrate():
+        await admin_bot.db.open()
+        try:
+            await admin_bot.ensure_users_table()
+        finally:
+            await admin_bot.db.close()
+    asyncio.run(_migrate())
+    print(f'Сгенерировано {rows} строк за {time.perf_counter() - started:.1f}с: {db_path}', file=sys.stderr)
+
+
+async def measure(fn: Callable[[], Awaitable[Any]], iterations: int, warmup: int = 3) -> Dict[str, float]:
+    for _ in range(warmup):
+        await fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        'n': iterations,
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        'min_ms': samples[0] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def make_fake_session():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message as TgMessage, User
+
+    class FakeSession(BaseSession):
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b''
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            if name == 'GetMe':
+                return User(id=1, is_bot=True, first_name='bench', username='bench_bot')
+            if name in ('SendMessage', 'EditMessageText'):
+                return TgMessage(message_id=1, date=datetime.now(), chat=Chat(id=1, type='private'), text=method.text)
+            return True
+
+    return FakeSession()
+
+
+async def run_benchmarks(iterations: int, seed: int) -> Dict[str, Dict[str, float]]:
+    import admin_bot as ab
+    from aiogram import Bot
+    from aiogram.types import Update
+
+    rnd = random.Random(seed)
+    await ab.db.open()
+    await ab.ensure_users_table()
+    total = (await ab.stats())[0]
+    if not total:
+        raise SystemExit('База пуста: сначала выполните bench.py generate')
+    sample = [r['user_id'] for r in await ab.db.fetchall('SELECT user_id FROM users ORDER BY random() LIMIT 200')]
+    usernames = [r['username'] for r in await ab.db.fetchall(
+        'SELECT username FROM users WHERE username IS NOT NULL LIMIT 200')]
+    deep_cursor = (await ab.db.fetchone('SELECT user_id FROM users ORDER BY user_id LIMIT 1 OFFSET ?',
+                                        (int(total * 0.9),)))['user_id']
+    results: Dict[str, Dict[str, float]] = {}
+
+    async def bench(name: str, fn: Callable[[], Awaitable[Any]]):
+        results[name] = await measure(fn, iterations)
+        print(f"{name:32} p50={results[name]['p50_ms']:8.3f}мс p95={results[name]['p95_ms']:8.3f}мс", file=sys.stderr)
+
+    # --- DB ---
+    await bench('db.stats', ab.stats)
+    await bench('db.fetch_users.first_page', lambda: ab.fetch_users())
+    await bench('db.fetch_users.deep_page', lambda: ab.fetch_users(after=deep_cursor))
+    await bench('db.fetch_users.deep_page_back', lambda: ab.fetch_users(before=deep_cursor))
+    await bench('db.fetch_user.by_id', lambda: ab.fetch_user(str(rnd.choice(sample))))
+    await bench('db.fetch_user.by_username', lambda: ab.fetch_user(rnd.choice(usernames)))
+    await bench('db.search_users.substring', lambda: ab.search_users(rnd.choice(usernames)[1:5]))
+    await bench('db.search_users.short', lambda: ab.search_users(rnd.choice(usernames)[:2]))
+    await bench('db.search_users.user_id', lambda: ab.search_users(str(rnd.choice(sample))[:6]))
+    await bench('db.confirm_registration', lambda: ab.confirm_registration(rnd.choice(sample)))
+    await bench('db.confirm_deposit', lambda: ab.confirm_deposit(rnd.choice(sample), round(rnd.uniform(10, 500), 2)))
+
+    # --- Handlers: Dispatcher.feed_update с подменённой сессией Bot API ---
+    bot = Bot(ab.BOT_TOKEN, session=make_fake_session())
+    ids = itertools.count(1)
+    admin = {'id': ab.ADMIN_ID, 'is_bot': False, 'first_name': 'bench'}
+    chat = {'id': ab.ADMIN_ID, 'type': 'private'}
+
+    def message(text: str) -> Update:
+        command = text.split()[0]
+        return Update.model_validate({'update_id': next(ids), 'message': {
+            'message_id': next(ids), 'date': 0, 'chat': chat, 'from': admin, 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        }})
+
+    def callback(data: str) -> Update:
+        return Update.model_validate({'update_id': next(ids), 'callback_query': {
+            'id': str(next(ids)), 'chat_instance': 'bench', 'data': data, 'from': admin,
+            'message': {'message_id': 1, 'date': 0, 'chat': chat, 'text': '…'},
+        }})
+
+    def feed(make_update: Callable[[], Update], cold: bool = True):
+        async def _feed():
+            if cold:
+                ab.render_cache.clear()
+            await ab.dp.feed_update(bot, make_update())
+        return _feed
+
+    await bench('handler.cmd_stats', feed(lambda: message('/stats')))
+    await bench('handler.cmd_user', feed(lambda: message(f'/user {rnd.choice(sample)}')))
+    await bench('handler.cmd_search', feed(lambda: message(f'/search {rnd.choice(usernames)[1:5]}')))
+    await bench('handler.cmd_confirm_reg', feed(lambda: message(f'/confirm_reg {rnd.choice(sample)}')))
+    await bench('handler.callback_stats', feed(lambda: callback(ab.StatsCb().pack())))
+    await bench('handler.callback_users_first', feed(lambda: callback(ab.UsersPageCb().pack())))
+    await bench('handler.callback_users_deep', feed(lambda: callback(ab.UsersPageCb(cursor=deep_cursor).pack())))
+    await bench('handler.callback_users_cached', feed(lambda: callback(ab.UsersPageCb().pack()), cold=False))
+    await bench('handler.callback_user_card', feed(lambda: callback(ab.UserCardCb(user_id=rnd.choice(sample)).pack())))
+
+    await ab.db.close()
+    return results
+
+
+def cmd_generate(args):
+    generate(args.db, parse_rows(args.rows), args.seed)
+
+
+def cmd_run(args):
+    db_path = args.db
+    if not args.in_place:
+        db_path = args.db + '.run'
+        shutil.copyfile(args.db, db_path)
+    os.environ['USERS_DB'] = db_path
+    import logging
+    logging.getLogger('aiogram').setLevel(logging.WARNING)
+    try:
+        results = asyncio.run(run_benchmarks(args.iterations, args.seed))
+    finally:
+        if not args.in_place:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+    conn = sqlite3.connect(args.db)
+    rows = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    conn.close()
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'rows': rows,
+            'iterations': args.iterations,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+def cmd_compare(args):
+    with open(args.old, encoding='utf-8') as f:
+        old = json.load(f)['results']
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)['results']
+    regressions: List[str] = []
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print(f"{name:32} {'только в новом' if name in new else 'только в старом'}")
+            continue
+        before, after = old[name][args.metric], new[name][args.metric]
+        ratio = after / before if before else float('inf')
+        mark = ''
+        if ratio > 1 + args.threshold:
+            mark = '  ⚠️ регрессия'
+            regressions.append(name)
+        print(f'{name:32} {before:9.3f} -> {after:9.3f} мс  x{ratio:5.2f}{mark}')
+    if regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки admin_bot.py на синтетических данных')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('generate', help='создать users.db с синтетическими пользователями')
+    p.add_argument('--db', required=True)
+    p.add_argument('--rows', default='10k', help='10k, 1m, 10m или число строк')
+    p.add_argument('--seed', type=int, default=42)
+    p.set_defaults(func=cmd_generate)
+
+    p = sub.add_parser('run', help='запустить бенчмарки и вывести JSON')
+    p.add_argument('--db', required=True)
+    p.add_argument('--out')
+    p.add_argument('--iterations', type=int, default=200)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--in-place', action='store_true', help='не копировать базу перед запуском')
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser('compare', help='сравнить два JSON-отчёта')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--metric', default='p50_ms')
+    p.add_argument('--threshold', type=float, default=0.2, help='допустимое замедление (0.2 = 20%%)')
+    p.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    os.environ.setdefault('BOT_TOKEN', '123456:bench-token')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
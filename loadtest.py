@@ -0,0 +1,395 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import asyncio
+import argparse
+import itertools
+import platform
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+# Сквозной нагрузочный тест admin_bot.py: настоящий main() и polling-цикл aiogram
+# против локальной имитации Bot API, без выхода в сеть.
+#
+#   python bench.py generate --rows 10k --db bench_10k.db
+#   python loadtest.py --db bench_10k.db --rate 50 --duration 30 --latency-ms 40 --error-rate 0.01
+#   python loadtest.py --db bench_10k.db --rate 10 --duration 30 --workers 4   # через супервизор
+#
+# Задержка апдейта — от постановки в очередь getUpdates до первого успешного ответа бота на него
+# (reply на сообщение, edit/reply в сообщении с кнопкой или answerCallbackQuery).
+
+FAKE_TOKEN = '123456:loadtest-token'
+START_MESSAGE_ID = 1_000_000
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def summarize(samples: List[float], duration: float) -> Dict[str, float]:
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'throughput_rps': len(samples) / duration if duration else 0.0,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p90_ms': percentile(samples, 0.90) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': (samples[-1] if samples else 0.0) * 1000,
+    }
+
+
+class FakeBotAPI:
+    # Минимальный Bot API: getUpdates (long polling), sendMessage, editMessageText, answerCallbackQuery.
+    # Остальные методы отвечают True. Задержка и 429 вносятся во все методы, кроме getUpdates
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 42):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rnd = random.Random(seed)
+        self.url = ''
+        self.updates: List[Dict[str, Any]] = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(START_MESSAGE_ID)
+        self.polling = asyncio.Event()
+        self._new_updates = asyncio.Condition()
+        self._runner: Optional[web.AppRunner] = None
+        # ключ ответа -> запись апдейта [вид, время отправки, время ответа]
+        self.pending: Dict[Tuple[str, Any], List[Any]] = {}
+        self.records: List[List[Any]] = []
+        self.calls: Dict[str, int] = {}
+        self.injected_429: Dict[str, int] = {}
+        self.texts: Dict[int, str] = {}
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def push(self, kind: str, update: Dict[str, Any], keys: List[Tuple[str, Any]]):
+        update['update_id'] = next(self.update_ids)
+        record = [kind, time.perf_counter(), None]
+        self.records.append(record)
+        for key in keys:
+            self.pending[key] = record
+        async with self._new_updates:
+            self.updates.append(update)
+            self._new_updates.notify_all()
+
+    def outstanding(self) -> int:
+        return sum(1 for r in self.records if r[2] is None)
+
+    @staticmethod
+    def _ok(result: Any) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _params(self, request: web.Request) -> Dict[str, Any]:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = {}
+        for k, v in (await request.post()).items():
+            if isinstance(v, str) and v[:1] in ('{', '['):
+                v = json.loads(v)
+            params[k] = v
+        return params
+
+    def _complete(self, key: Tuple[str, Any]):
+        record = self.pending.pop(key, None)
+        if record is not None and record[2] is None:
+            record[2] = time.perf_counter()
+
+    async def _get_updates(self, params: Dict[str, Any]) -> web.Response:
+        self.polling.set()
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        # Подтверждённые (offset) апдейты больше не отдаём
+        self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates and timeout:
+            async with self._new_updates:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        limit = int(params.get('limit') or 100)
+        return self._ok(self.updates[:limit])
+
+    def _message(self, chat_id: Any, text: str, message_id: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            'message_id': message_id if message_id is not None else next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'text': text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.rnd.uniform(0, self.jitter))
+        if method == 'getMe':
+            return self._ok({'id': 1, 'is_bot': True, 'first_name': 'loadtest', 'username': 'loadtest_bot'})
+        if self.error_rate and self.rnd.random() < self.error_rate:
+            self.injected_429[method] = self.injected_429.get(method, 0) + 1
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        if method == 'sendMessage':
+            reply = params.get('reply_parameters') or {}
+            reply_to = reply.get('message_id') if isinstance(reply, dict) else None
+            reply_to = reply_to or params.get('reply_to_message_id')
+            if reply_to is not None:
+                self._complete(('m', int(reply_to)))
+            return self._ok(self._message(params.get('chat_id'), params.get('text', '')))
+        if method == 'editMessageText':
+            message_id = int(params.get('message_id') or 0)
+            text = params.get('text', '')
+            if self.texts.get(message_id) == text:
+                return web.json_response({
+                    'ok': False, 'error_code': 400,
+                    'description': 'Bad Request: message is not modified: specified new message content '
+                                   'and reply markup are exactly the same as a current content and reply markup of the message',
+                }, status=400)
+            self.texts[message_id] = text
+            self._complete(('m', message_id))
+            return self._ok(self._message(params.get('chat_id'), text, message_id))
+        if method == 'answerCallbackQuery':
+            self._complete(('c', params.get('callback_query_id')))
+            return self._ok(True)
+        if method == 'sendDocument':
+            return self._ok(self._message(params.get('chat_id'), ''))
+        return self._ok(True)
+
+
+class ScenarioDriver:
+    # Смесь апдейтов как у команды админов: навигация по спискам, статистика, карточки, подтверждения
+    def __init__(self, ab, api: FakeBotAPI, user_ids: List[int], usernames: List[str], seed: int = 42):
+        self.ab = ab
+        self.api = api
+        self.user_ids = user_ids
+        self.usernames = usernames or ['user']
+        self.rnd = random.Random(seed)
+        self.admin = {'id': ab.ADMIN_ID, 'is_bot': False, 'first_name': 'loadtest'}
+        self.chat = {'id': ab.ADMIN_ID, 'type': 'private'}
+        self.ids = itertools.count(1)
+        self.scenarios: List[Tuple[str, float, Callable[[], Tuple[str, Any]]]] = [
+            ('callback:users_page', 30, lambda: ('cb', self.ab.UsersPageCb(cursor=self.rnd.choice(self.user_ids)).pack())),
+            ('callback:users_first', 10, lambda: ('cb', self.ab.UsersPageCb().pack())),
+            ('callback:stats', 15, lambda: ('cb', self.ab.StatsCb().pack())),
+            ('callback:user_card', 10, lambda: ('cb', self.ab.UserCardCb(user_id=self.rnd.choice(self.user_ids)).pack())),
+            ('cmd:stats', 5, lambda: ('msg', '/stats')),
+            ('cmd:user', 5, lambda: ('msg', f'/user {self.rnd.choice(self.user_ids)}')),
+            ('cmd:search', 5, lambda: ('msg', f'/search {self.rnd.choice(self.usernames)[1:5]}')),
+            ('cmd:confirm_reg', 10, lambda: ('msg', f'/confirm_reg {self.rnd.choice(self.user_ids)}')),
+            ('cmd:confirm_dep', 10, lambda: ('msg', f'/confirm_dep {self.rnd.choice(self.user_ids)} '
+                                                    f'{round(self.rnd.uniform(10, 500), 2)}')),
+        ]
+        self.weights = [w for _, w, _ in self.scenarios]
+
+    def _message(self, text: str) -> Tuple[Dict[str, Any], List[Tuple[str, Any]]]:
+        message_id = next(self.ids)
+        command = text.split()[0]
+        update = {'message': {
+            'message_id': message_id, 'date': int(time.time()), 'chat': self.chat, 'from': self.admin, 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        }}
+        return update, [('m', message_id)]
+
+    def _callback(self, data: str) -> Tuple[Dict[str, Any], List[Tuple[str, Any]]]:
+        # У каждого нажатия своё сообщение с кнопками, чтобы edit/reply однозначно сопоставлялись с апдейтом
+        message_id = next(self.ids)
+        callback_id = str(next(self.ids))
+        update = {'callback_query': {
+            'id': callback_id, 'chat_instance': 'loadtest', 'data': data, 'from': self.admin,
+            'message': {'message_id': message_id, 'date': int(time.time()), 'chat': self.chat, 'text': '…'},
+        }}
+        return update, [('m', message_id), ('c', callback_id)]
+
+    async def next_update(self):
+        name, _, make = self.rnd.choices(self.scenarios, weights=self.weights)[0]
+        kind, payload = make()
+        update, keys = self._message(payload) if kind == 'msg' else self._callback(payload)
+        await self.api.push(name, update, keys)
+
+    async def run(self, rate: float, duration: float):
+        # Открытый цикл: апдейты приходят по расписанию независимо от того, успевает ли бот
+        total = int(rate * duration)
+        start = time.perf_counter()
+        for i in range(total):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.next_update()
+
+
+def load_sample(db_path: str) -> Tuple[List[int], List[str]]:
+    conn = sqlite3.connect(db_path)
+    try:
+        ids = [r[0] for r in conn.execute('SELECT user_id FROM users ORDER BY random() LIMIT 500')]
+        names = [r[0] for r in conn.execute('SELECT username FROM users WHERE username IS NOT NULL LIMIT 500')]
+    finally:
+        conn.close()
+    if not ids:
+        raise SystemExit('База пуста: сначала выполните bench.py generate')
+    return ids, names
+
+
+async def run_loadtest(args, db_path: str) -> Dict[str, Any]:
+    api = FakeBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.retry_after, args.seed)
+    await api.start()
+    os.environ['TELEGRAM_API_URL'] = api.url
+    os.environ['USERS_DB'] = db_path
+    os.environ['BOT_MODE'] = 'polling'
+    os.environ['BOT_TOKEN'] = FAKE_TOKEN
+    os.environ['METRICS_PORT'] = '0'
+    if args.chat_rate:
+        # Лимит чата касается уведомлений и рассылок; ответы на действия админа им не ограничиваются
+        os.environ['OUTBOUND_CHAT_RATE'] = str(args.chat_rate)
+    if args.workers:
+        # Супервизор с воркерами-процессами; они наследуют окружение, в т.ч. адрес имитации Bot API.
+        # OUTBOUND_RATE делится между процессами, так что суммарно бот не превышает лимит Telegram
+        os.environ['WORKERS'] = str(args.workers)
+    import admin_bot as ab
+
+    user_ids, usernames = load_sample(db_path)
+    bot_task = asyncio.create_task(ab.main())
+    try:
+        await asyncio.wait_for(api.polling.wait(), 30)
+        if args.workers:
+            # Фронт опрашивает getUpdates сразу, а воркерам ещё нужно импортировать модуль и открыть базу
+            deadline = time.perf_counter() + 60
+            while ab.supervisor.health()['status'] != 'ok' and time.perf_counter() < deadline:
+                await asyncio.sleep(0.1)
+        driver = ScenarioDriver(ab, api, user_ids, usernames, args.seed)
+        started = time.perf_counter()
+        await driver.run(args.rate, args.duration)
+        sent_done = time.perf_counter()
+        while api.outstanding() and time.perf_counter() - sent_done < args.drain_timeout:
+            await asyncio.sleep(0.05)
+        # Пропускная способность — до последнего ответа, без ожидания апдейтов, оставшихся без ответа
+        finished = max([r[2] for r in api.records if r[2] is not None], default=sent_done)
+        elapsed = max(finished, sent_done) - started
+    finally:
+        if args.workers:
+            ab.supervisor.stop()
+        else:
+            await ab.dp.stop_polling()
+        await bot_task
+        await api.stop()
+
+    by_kind: Dict[str, List[float]] = {}
+    failed: Dict[str, int] = {}
+    for kind, sent, done in api.records:
+        if done is None:
+            failed[kind] = failed.get(kind, 0) + 1
+        else:
+            by_kind.setdefault(kind, []).append(done - sent)
+    all_samples = [s for samples in by_kind.values() for s in samples]
+    total = len(api.records)
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'rate': args.rate,
+            'duration': args.duration,
+            'latency_ms': args.latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'error_rate': args.error_rate,
+            'seed': args.seed,
+            'workers': args.workers,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'summary': {
+            'sent': total,
+            'completed': len(all_samples),
+            'failed': total - len(all_samples),
+            'error_rate': (total - len(all_samples)) / total if total else 0.0,
+            'elapsed_s': elapsed,
+            **summarize(all_samples, elapsed),
+        },
+        'scenarios': {
+            kind: {**summarize(by_kind.get(kind, []), elapsed), 'failed': failed.get(kind, 0)}
+            for kind in sorted(set(by_kind) | set(failed))
+        },
+        'api_calls': dict(sorted(api.calls.items())),
+        'injected_429': dict(sorted(api.injected_429.items())),
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    s = report['summary']
+    print(f"Отправлено: {s['sent']}, обработано: {s['completed']}, без ответа: {s['failed']} "
+          f"({s['error_rate'] * 100:.1f}%), {s['throughput_rps']:.1f} апд/с", file=sys.stderr)
+    print(f"{'всего':24} p50={s['p50_ms']:8.1f}мс p90={s['p90_ms']:8.1f}мс p99={s['p99_ms']:8.1f}мс", file=sys.stderr)
+    for kind, r in report['scenarios'].items():
+        print(f"{kind:24} p50={r['p50_ms']:8.1f}мс p90={r['p90_ms']:8.1f}мс p99={r['p99_ms']:8.1f}мс "
+              f"n={r['n']} ошибок={r['failed']}", file=sys.stderr)
+    if report['injected_429']:
+        print(f"Внесено 429: {report['injected_429']}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сквозной нагрузочный тест admin_bot.py с локальным Bot API')
+    parser.add_argument('--db', required=True, help='база, созданная bench.py generate')
+    parser.add_argument('--rate', type=float, default=20, help='апдейтов в секунду')
+    parser.add_argument('--duration', type=float, default=10, help='секунд подачи нагрузки')
+    parser.add_argument('--latency-ms', type=float, default=0, help='задержка ответа Bot API')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='случайная добавка к задержке')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля вызовов, получающих 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--chat-rate', type=float, default=0, help='OUTBOUND_CHAT_RATE бота (0 — как в конфиге)')
+    parser.add_argument('--workers', type=int, default=0, help='WORKERS бота (0 — один процесс)')
+    parser.add_argument('--drain-timeout', type=float, default=10, help='сколько ждать ответов после подачи')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help='JSON-отчёт')
+    parser.add_argument('--in-place', action='store_true', help='не копировать базу перед запуском')
+    args = parser.parse_args()
+
+    db_path = args.db
+    if not args.in_place:
+        db_path = args.db + '.loadtest'
+        shutil.copyfile(args.db, db_path)
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    # Ошибки обработчиков (в т.ч. внесённые 429) учитываются в отчёте, трейсбеки не нужны
+    logging.getLogger('aiogram.event').setLevel(logging.CRITICAL)
+    try:
+        report = asyncio.run(run_loadtest(args, db_path))
+    finally:
+        if not args.in_place:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+    print_report(report)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
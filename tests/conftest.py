@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import pytest
+from aiohttp import web
+
+# Модуль бота читает окружение при импорте: токен обязателен, база подменяется в фикстуре db
+os.environ.setdefault('BOT_TOKEN', '123456:test-token')
+os.environ['USERS_DB'] = os.path.join(tempfile.mkdtemp(prefix='admin_bot_tests_'), 'users.db')
+os.environ['WEBHOOK_SECRET'] = 'test-secret'
+os.environ['CHANGEFEED_INTERVAL'] = '0'
+os.environ['RENDER_CACHE_POLL'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admin_bot as ab  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def loop():
+    # Один цикл на сессию: пул соединений, очередь записи и планировщик отправки живут в модуле
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.run_until_complete(ab.bot.session.close())
+    loop.close()
+
+
+@pytest.fixture
+def run(loop):
+    return loop.run_until_complete
+
+
+@pytest.fixture
+def db(run, tmp_path):
+    # Чистая база на каждый тест: все модульные компоненты открывают соединения по db.path
+    ab.db.path = str(tmp_path / 'users.db')
+    run(ab.db.open())
+    run(ab.ensure_users_table())
+    ab.render_cache.clear()
+    yield ab.db
+    run(ab.broadcaster.shutdown())
+    run(ab.outbound.close())
+    run(ab.writes.close())
+    run(ab.db.close())
+
+
+def add_users(run, rows: List[Dict[str, Any]]):
+    # Вставка напрямую, как это делает основной бот: агрегаты ведут триггеры
+    def _insert(conn):
+        with conn:
+            for row in rows:
+                cols = ', '.join(row)
+                marks = ', '.join('?' * len(row))
+                conn.execute(f'INSERT INTO users ({cols}) VALUES ({marks})', tuple(row.values()))
+    run(ab.db.run(_insert))
+
+
+class StubBotAPI:
+    # Локальный Bot API: отвечает на любые методы и записывает вызовы.
+    # blocked — chat_id, которым sendMessage отвечает 403; flood — сколько первых sendMessage получат 429
+    def __init__(self):
+        self.calls: List[tuple] = []
+        self.blocked: set = set()
+        self.flood = 0
+        self.url = ''
+        self._message_ids = iter(range(1, 1 << 30))
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def sent(self, method: str = 'sendMessage') -> List[Dict[str, Any]]:
+        return [params for name, params in self.calls if name == method]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = {}
+        for k, v in (await request.post()).items():
+            params[k] = json.loads(v) if isinstance(v, str) and v[:1] in ('{', '[') else v
+        self.calls.append((method, params))
+        if method == 'sendMessage':
+            if self.flood > 0:
+                self.flood -= 1
+                return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                          'parameters': {'retry_after': 1}}, status=429)
+            if int(params['chat_id']) in self.blocked:
+                return web.json_response({'ok': False, 'error_code': 403,
+                                          'description': 'Forbidden: bot was blocked by the user'}, status=403)
+        if method in ('sendMessage', 'editMessageText'):
+            return web.json_response({'ok': True, 'result': {
+                'message_id': int(params.get('message_id') or next(self._message_ids)), 'date': int(time.time()),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': params.get('text', ''),
+            }})
+        return web.json_response({'ok': True, 'result': True})
+
+
+@pytest.fixture
+def stub_api(run):
+    api = StubBotAPI()
+    run(api.start())
+    original = ab.bot.session.api
+    ab.bot.session.api = TelegramAPIServer.from_base(api.url)
+    yield api
+    ab.bot.session.api = original
+    run(api.stop())
+
+
+@pytest.fixture
+def bot_api(db, stub_api):
+    return stub_api
@@ -0,0 +1,71 @@
+import asyncio
+
+import admin_bot as ab
+from conftest import add_users
+
+
+def finish(run):
+    # Рассылка идёт фоновой задачей, ждём её завершения
+    run(asyncio.wait_for(asyncio.gather(*list(ab.broadcaster._tasks.values())), 30))
+
+
+def job(run, job_id):
+    return run(ab.db.fetchone('SELECT * FROM broadcast_jobs WHERE id=?', (job_id,)))
+
+
+def recipients(bot_api):
+    return sorted(int(p['chat_id']) for p in bot_api.sent() if int(p['chat_id']) != ab.ADMIN_ID)
+
+
+def test_counts_sent_and_blocked(run, bot_api):
+    add_users(run, [{'user_id': uid} for uid in range(1, 13)])
+    bot_api.blocked = {3, 7}
+    job_id = run(ab.broadcaster.create('hello', ab.ADMIN_ID))
+    finish(run)
+    row = job(run, job_id)
+    assert (row['status'], row['total'], row['sent'], row['blocked'], row['failed']) == ('done', 12, 10, 2, 0)
+    assert row['last_user_id'] == 12
+    assert recipients(bot_api) == list(range(1, 13))
+    # Итог рассылки отправлен админу
+    report = [p for p in bot_api.sent() if int(p['chat_id']) == ab.ADMIN_ID]
+    assert report and row['message_id']
+    assert 'Доставлено: 10' in bot_api.sent('editMessageText')[-1]['text']
+
+
+def test_flood_wait_is_retried(run, bot_api):
+    add_users(run, [{'user_id': uid} for uid in range(1, 4)])
+    bot_api.flood = 1
+    job_id = run(ab.broadcaster.create('hello', ab.ADMIN_ID))
+    finish(run)
+    row = job(run, job_id)
+    assert (row['sent'], row['failed']) == (3, 0)
+    # Одна отправка получила 429 и была повторена после паузы
+    assert len(recipients(bot_api)) == 4 and set(recipients(bot_api)) == {1, 2, 3}
+
+
+def test_resume_continues_after_cursor(run, bot_api):
+    add_users(run, [{'user_id': uid} for uid in range(1, 9)])
+
+    def _insert(conn):
+        # Задача, прерванная перезапуском после первой пачки
+        with conn:
+            return conn.execute(
+                "INSERT INTO broadcast_jobs (text, total, chat_id, created_at, last_user_id, sent) "
+                "VALUES ('hello', 8, ?, '2026-01-01T00:00:00', 5, 5)", (ab.ADMIN_ID,)
+            ).lastrowid
+    job_id = run(ab.db.run(_insert))
+    run(ab.broadcaster.resume_pending())
+    finish(run)
+    row = job(run, job_id)
+    assert (row['status'], row['sent'], row['last_user_id']) == ('done', 8, 8)
+    assert recipients(bot_api) == [6, 7, 8]
+
+
+def test_segment_broadcast_reaches_members_only(run, bot_api):
+    add_users(run, [{'user_id': uid, 'registered': uid % 2, 'reg_date': '2026-01-01 00:00:00'} for uid in range(1, 9)])
+    segment = run(ab.segments.open('reg'))
+    job_id = run(ab.broadcaster.create('hello', ab.ADMIN_ID, segment['id']))
+    finish(run)
+    row = job(run, job_id)
+    assert (row['total'], row['sent']) == (4, 4)
+    assert recipients(bot_api) == [1, 3, 5, 7]
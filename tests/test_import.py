@@ -0,0 +1,107 @@
+import json
+
+import admin_bot as ab
+from conftest import add_users
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def user(run, uid):
+    return run(ab.db.fetchone(
+        'SELECT registered, deposit_confirmed, deposit_amount, click_id, trader_id, deposits_count '
+        'FROM users WHERE user_id=?', (uid,)
+    ))
+
+
+def seed(run):
+    add_users(run, [
+        {'user_id': 1, 'click_id': 'c1'},
+        {'user_id': 2, 'click_id': 'c2', 'trader_id': 't2'},
+        {'user_id': 3, 'trader_id': 't3'},
+        {'user_id': 4},
+    ])
+
+
+def test_matching_by_user_id_click_id_and_trader_id(run, db, tmp_path):
+    seed(run)
+    path = write(tmp_path, 'import.csv', (
+        'user_id,click_id,trader_id,event,amount,date\n'
+        ',c1,,reg,,2026-03-01 10:00:00\n'
+        # Неизвестный click_id: пользователь находится по trader_id, click_id сохраняется
+        ',c-new,t3,reg,,2026-03-01 11:00:00\n'
+        '4,,,deposit,40,2026-03-02 10:00:00\n'
+        ',,t2,deposit,25,2026-03-02 11:00:00\n'
+        # Неизвестный user_id не ищется по другим полям и не заводит нового пользователя
+        '999,c1,,reg,,2026-03-01 12:00:00\n'
+        ',c-missing,t-missing,reg,,\n'
+    ))
+    summary = run(ab.import_file(path))
+    assert summary == {'rows': 6, 'invalid': 0, 'unmatched': 2, 'conflicts': 0, 'duplicates': 0,
+                       'registrations': 2, 'deposits': 2}
+    assert tuple(user(run, 1)) == (1, 0, 0, 'c1', None, 0)
+    assert tuple(user(run, 3)) == (1, 0, 0, 'c-new', 't3', 0)
+    assert tuple(user(run, 4)) == (0, 1, 40.0, None, None, 1)
+    assert tuple(user(run, 2)) == (0, 1, 25.0, 'c2', 't2', 1)
+    assert run(ab.db.fetchone('SELECT COUNT(*) FROM users'))[0] == 4
+
+
+def test_click_id_conflicts_are_skipped(run, db, tmp_path):
+    seed(run)
+    path = write(tmp_path, 'import.csv', (
+        'user_id,click_id,event,date\n'
+        # click_id c1 уже принадлежит пользователю 1
+        '4,c1,reg,2026-03-01 10:00:00\n'
+        # Новый click_id достаётся первой строке пачки, вторая с тем же click_id — конфликт
+        '3,c-shared,reg,2026-03-01 10:00:00\n'
+        '4,c-shared,reg,2026-03-01 10:00:00\n'
+    ))
+    summary = run(ab.import_file(path))
+    assert (summary['conflicts'], summary['registrations']) == (2, 1)
+    assert tuple(user(run, 3))[:4] == (1, 0, 0, 'c-shared')
+    assert tuple(user(run, 4))[:4] == (0, 0, 0, None)
+    clicks = run(ab.db.fetchall('SELECT click_id FROM users WHERE click_id IS NOT NULL'))
+    assert len(clicks) == len({r[0] for r in clicks})
+
+
+def test_reimport_is_idempotent(run, db, tmp_path):
+    seed(run)
+    path = write(tmp_path, 'import.csv', (
+        'click_id,event,amount,date\n'
+        'c1,reg,,2026-03-01 10:00:00\n'
+        'c1,deposit,10,2026-03-02 10:00:00\n'
+        'c1,deposit,15,2026-03-03 10:00:00\n'
+        'c2,deposit,30,\n'
+        'c2,deposit,30,\n'
+    ))
+    first = run(ab.import_file(path))
+    assert (first['registrations'], first['deposits'], first['duplicates']) == (1, 3, 1)
+    before = run(ab.stats())
+    second = run(ab.import_file(path))
+    assert (second['registrations'], second['deposits'], second['duplicates']) == (0, 0, 5)
+    assert run(ab.stats()) == before == (4, 1, 2, 55.0)
+    # deposit_amount — последний депозит, сумма и число ведутся журналом deposits
+    assert tuple(user(run, 1))[1:] == (1, 15.0, 'c1', None, 2)
+    assert tuple(user(run, 2))[1:] == (1, 30.0, 'c2', 't2', 1)
+    old, fresh = run(ab.rebuild_stats())
+    assert old == fresh
+
+
+def test_invalid_rows(run, db, tmp_path):
+    seed(run)
+    lines = [
+        json.dumps({'user_id': 1, 'event': 'reg', 'date': '2026-03-01 10:00:00'}),
+        json.dumps([1, 'reg']),
+        '42',
+        json.dumps({'event': 'reg'}),
+        # Вне диапазона INTEGER SQLite и не-ASCII цифры: такой user_id не распознаётся
+        json.dumps({'user_id': str(1 << 63), 'event': 'reg'}),
+        json.dumps({'user_id': '١٢', 'event': 'reg'}),
+    ]
+    path = write(tmp_path, 'import.jsonl', '\n'.join(lines) + '\n')
+    summary = run(ab.import_file(path))
+    assert (summary['rows'], summary['invalid'], summary['registrations']) == (6, 5, 1)
+    assert 'Некорректные строки: 5' in ab.format_import_summary(summary)
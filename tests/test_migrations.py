@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+import admin_bot as ab
+
+LEGACY_USERS = [
+    (1, 'alice', 1, '2025-12-01 10:00:00', 100.0, 1, '2025-12-02 11:00:00', 't1', 'c1'),
+    (2, 'bob', 1, '2025-12-03 10:00:00', 0, 0, None, None, 'c2'),
+    (3, None, 0, None, 0, 0, None, None, None),
+]
+
+
+def make_legacy_db(path, users):
+    # База основного бота до миграций: только таблица users, user_version = 0
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executescript(ab.USERS_SCHEMA_SQL)
+        conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', users)
+    conn.close()
+
+
+def user_version(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def dump_users(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT * FROM users ORDER BY user_id').fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def legacy(run, tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    ab.db.path = path
+    yield path
+    run(ab.writes.close())
+    run(ab.db.close())
+
+
+def test_legacy_db_is_migrated_to_latest(run, legacy):
+    make_legacy_db(legacy, LEGACY_USERS)
+    run(ab.db.open())
+    run(ab.ensure_users_table())
+    assert user_version(legacy) == ab.MIGRATIONS[-1][0]
+    # Данные пользователей не меняются, агрегаты и журнал депозитов строятся по ним
+    assert [r[:9] for r in dump_users(legacy)] == LEGACY_USERS
+    assert run(ab.stats()) == (3, 2, 1, 100.0)
+    old, fresh = run(ab.rebuild_stats())
+    assert old == fresh
+    deposits = run(ab.db.fetchall('SELECT user_id, amount FROM deposits'))
+    assert [tuple(r) for r in deposits] == [(1, 100.0)]
+    assert [r[0] for r in run(ab.search_users('alice', 0))[0]] == [1]
+
+
+def test_migrations_are_idempotent(run, legacy):
+    make_legacy_db(legacy, LEGACY_USERS)
+    run(ab.db.open())
+    run(ab.ensure_users_table())
+    before = dump_users(legacy)
+    assert run(ab.db.run(ab._migrate)) == []
+    # Повторный запуск бота по мигрированной базе ничего не применяет и не пересчитывает
+    run(ab.ensure_users_table())
+    assert dump_users(legacy) == before
+    old, fresh = run(ab.rebuild_stats())
+    assert old == fresh
+
+
+def test_duplicate_click_ids_abort_migration(run, legacy):
+    users = LEGACY_USERS + [(4, 'dup', 0, None, 0, 0, None, None, 'c1'), (5, 'dup2', 0, None, 0, 0, None, None, 'c2')]
+    make_legacy_db(legacy, users)
+    run(ab.db.open())
+    with pytest.raises(RuntimeError) as e:
+        run(ab.ensure_users_table())
+    assert 'Миграция 2' in str(e.value)
+    assert 'c1: 1,4' in str(e.value) and 'c2: 2,5' in str(e.value)
+    # Миграция 1 применена, на второй процесс остановился, пользовательские данные не тронуты
+    assert user_version(legacy) == 1
+    assert dump_users(legacy) == users
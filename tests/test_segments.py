@@ -0,0 +1,78 @@
+import pytest
+
+import admin_bot as ab
+from conftest import add_users
+
+
+@pytest.mark.parametrize('expr', [
+    'reg !dep',
+    'dep amount>=100',
+    'dep amount>=1234567',
+    'dep amount<0.1',
+    'dep amount>=99.99',
+    'total>=12345678.9',
+    'amount=1e+16',
+    'deposits>=2 id>1000000',
+    'reg reg_days<=7',
+    'dep dep_days>30',
+    *[f'{preset[1]}' for preset in ab.SEGMENT_PRESETS.values()],
+])
+def test_parse_format_round_trip(expr):
+    conds = ab.parse_segment(expr)
+    canonical = ab.format_segment(conds)
+    assert ab.parse_segment(canonical) == conds
+    assert ab.format_segment(ab.parse_segment(canonical)) == canonical
+
+
+@pytest.mark.parametrize('a, b', [
+    ('dep reg', 'reg   dep'),
+    ('amount>=100 dep', 'DEP amount>=100.0'),
+    ('reg_days<=7d reg', 'reg reg_days<=7'),
+])
+def test_equivalent_expressions_share_canonical_form(a, b):
+    assert ab.format_segment(ab.parse_segment(a)) == ab.format_segment(ab.parse_segment(b))
+
+
+def test_float_values_survive_round_trip():
+    for value in (0.1, 1234567.0, 1234567.5, 1e15, 1e16, 123456789.123):
+        conds = [('amount', '>=', value)]
+        assert ab.parse_segment(ab.format_segment(conds)) == conds
+
+
+@pytest.mark.parametrize('expr', ['', 'foo', 'amount>=x', 'reg_days=7', 'amount>>1', 'id>=1.5'])
+def test_invalid_expressions(expr):
+    with pytest.raises(ValueError):
+        ab.parse_segment(expr)
+
+
+def members(run, segment_id):
+    return {r[0] for r in run(ab.db.fetchall('SELECT user_id FROM segment_members WHERE segment_id=?', (segment_id,)))}
+
+
+def expected(run, expr):
+    where, params = ab.compile_segment(ab.parse_segment(expr), int(ab.time.time()))
+    return {r[0] for r in run(ab.db.fetchall(f'SELECT user_id FROM users WHERE {where}', params))}
+
+
+@pytest.mark.parametrize('expr', ['reg !dep', 'dep amount>=100', 'total>=150 deposits>=2', 'reg reg_days<=7'])
+def test_membership_follows_data(run, db, expr):
+    today = ab.utc_now_str()
+    add_users(run, [
+        {'user_id': 1, 'registered': 1, 'reg_date': today},
+        {'user_id': 2, 'registered': 1, 'reg_date': '2020-01-01 00:00:00'},
+        {'user_id': 3, 'registered': 1, 'reg_date': today, 'deposit_confirmed': 1, 'deposit_amount': 150,
+         'deposit_date': today},
+        {'user_id': 4},
+    ])
+    segment = run(ab.segments.open(expr))
+    assert members(run, segment['id']) == expected(run, expr)
+    assert segment['member_count'] == len(expected(run, expr))
+    # Изменения после материализации применяются инкрементально по user_changes
+    run(ab.confirm_registration(4))
+    run(ab.confirm_deposit(1, 50))
+    run(ab.confirm_deposit(1, 120))
+    run(ab.confirm_deposit(3, 30))
+    add_users(run, [{'user_id': 5, 'registered': 1, 'reg_date': today}])
+    segment = run(ab.segments.open(expr))
+    assert members(run, segment['id']) == expected(run, expr)
+    assert segment['member_count'] == len(expected(run, expr))
@@ -0,0 +1,73 @@
+import admin_bot as ab
+from conftest import add_users
+
+
+def _aggregates(run):
+    stats = run(ab.db.fetchone('SELECT total, registered, deposited, deposit_sum, repeat_users FROM users_stats WHERE id=1'))
+    daily = run(ab.db.fetchall(
+        'SELECT day, registrations, deposits, deposit_sum FROM daily_stats '
+        'WHERE registrations != 0 OR deposits != 0 OR deposit_sum != 0 ORDER BY day'
+    ))
+    return tuple(stats), [tuple(r) for r in daily]
+
+
+def assert_matches_rebuild(run):
+    # Триггерные агрегаты должны совпадать с полным пересчётом, который выполняет /stats_rebuild
+    kept = _aggregates(run)
+    old, fresh = run(ab.rebuild_stats())
+    assert old == fresh
+    assert _aggregates(run) == kept
+
+
+def test_direct_inserts_match_rebuild(run, db):
+    add_users(run, [
+        {'user_id': 1, 'username': 'a'},
+        {'user_id': 2, 'registered': 1, 'reg_date': '2026-01-01 10:00:00'},
+        {'user_id': 3, 'registered': 1, 'reg_date': '2026-01-02 10:00:00', 'deposit_confirmed': 1,
+         'deposit_amount': 50, 'deposit_date': '2026-01-03 12:00:00'},
+    ])
+    assert run(ab.stats()) == (3, 2, 1, 50.0)
+    assert_matches_rebuild(run)
+
+
+def test_admin_confirmations_match_rebuild(run, db):
+    add_users(run, [{'user_id': uid} for uid in range(1, 6)])
+    assert run(ab.confirm_registration(1))
+    assert run(ab.confirm_registration(2))
+    assert run(ab.confirm_deposit(2, 100))
+    assert run(ab.confirm_deposit(2, 25.5))
+    assert run(ab.confirm_deposit(3, 10))
+    assert not run(ab.confirm_deposit(999, 10))
+    total, registered, deposited, deposit_sum = run(ab.stats())
+    assert (total, registered, deposited, deposit_sum) == (5, 2, 2, 135.5)
+    row = run(ab.db.fetchone('SELECT repeat_users FROM users_stats WHERE id=1'))
+    assert row[0] == 1
+    assert_matches_rebuild(run)
+
+
+def test_direct_updates_and_deletes_match_rebuild(run, db):
+    add_users(run, [{'user_id': uid, 'registered': uid % 2, 'reg_date': '2026-02-01 00:00:00'} for uid in range(1, 11)])
+
+    def _writes(conn):
+        with conn:
+            # Основной бот подтверждает депозит прямой записью в users — её зеркалит журнал deposits
+            conn.execute("UPDATE users SET deposit_confirmed=1, deposit_amount=70, deposit_date='2026-02-02 00:00:00' "
+                         "WHERE user_id IN (2, 4)")
+            conn.execute('UPDATE users SET deposit_amount=90 WHERE user_id=4')
+            conn.execute("UPDATE users SET registered=1, reg_date='2026-02-03 00:00:00' WHERE user_id=6")
+            conn.execute('DELETE FROM users WHERE user_id IN (1, 2)')
+    run(ab.db.run(_writes))
+    total, registered, deposited, _ = run(ab.stats())
+    assert (total, registered, deposited) == (8, 5, 1)
+    assert_matches_rebuild(run)
+
+
+def test_import_matches_rebuild(run, db, tmp_path):
+    add_users(run, [{'user_id': uid, 'click_id': f'c{uid}'} for uid in range(1, 21)])
+    path = tmp_path / 'import.csv'
+    path.write_text('click_id,event,amount,date\n'
+                    + ''.join(f'c{uid},reg,,2026-03-01 00:00:00\n' for uid in range(1, 11))
+                    + ''.join(f'c{uid},deposit,{uid},2026-03-02 00:00:00\n' for uid in range(1, 6)))
+    run(ab.import_file(str(path)))
+    assert run(ab.stats()) == (20, 10, 5, 15.0)
+    assert_matches_rebuild(run)
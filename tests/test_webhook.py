@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import admin_bot as ab
+from conftest import add_users
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def message_update(update_id, user_id, text):
+    # Апдейт в том виде, в каком его присылает Telegram
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 1767225600,
+            'chat': {'id': user_id, 'type': 'private', 'first_name': 'Test'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test', 'language_code': 'ru'},
+            'text': text,
+            'entities': entities,
+        },
+    }
+
+
+@pytest.fixture
+def client(run, tmp_path, stub_api):
+    # Приложение целиком, со startup/shutdown-хуками диспетчера: они открывают и закрывают базу
+    ab.db.path = str(tmp_path / 'users.db')
+    async def _start():
+        client = TestClient(TestServer(ab.build_webhook_app()))
+        await client.start_server()
+        return client
+    client = run(_start())
+    yield client
+    run(client.close())
+
+
+async def wait_sent(api, count, timeout=5.0):
+    # Апдейт обрабатывается в фоне после ответа 200, ждём исходящих вызовов
+    deadline = asyncio.get_running_loop().time() + timeout
+    while len(api.sent()) < count:
+        assert asyncio.get_running_loop().time() < deadline, api.calls
+        await asyncio.sleep(0.02)
+    return api.sent()
+
+
+def post(run, client, update, secret=ab.WEBHOOK_SECRET):
+    return run(client.post(ab.WEBHOOK_PATH, json=update, headers={SECRET_HEADER: secret}))
+
+
+def test_health(run, client):
+    resp = run(client.get('/health'))
+    assert resp.status == 200
+    assert run(resp.json())['status'] == 'ok'
+
+
+def test_wrong_secret_is_rejected(run, client, stub_api):
+    resp = post(run, client, message_update(1, ab.ADMIN_ID, '/start'), secret='wrong')
+    assert resp.status == 401
+    run(asyncio.sleep(0.1))
+    assert stub_api.sent() == []
+
+
+def test_admin_start(run, client, stub_api):
+    resp = post(run, client, message_update(1, ab.ADMIN_ID, '/start'))
+    assert resp.status == 200
+    sent = run(wait_sent(stub_api, 1))
+    assert int(sent[0]['chat_id']) == ab.ADMIN_ID
+    assert sent[0]['text'] == 'Админ-меню:'
+    assert sent[0]['reply_markup']
+
+
+def test_non_admin_is_refused(run, client, stub_api):
+    post(run, client, message_update(1, 12345, '/stats'))
+    sent = run(wait_sent(stub_api, 1))
+    assert (int(sent[0]['chat_id']), sent[0]['text']) == (12345, 'Доступ запрещён.')
+
+
+def test_admin_stats(run, client, stub_api):
+    add_users(run, [
+        {'user_id': 1, 'registered': 1, 'reg_date': '2026-01-01 00:00:00'},
+        {'user_id': 2, 'registered': 1, 'reg_date': '2026-01-01 00:00:00', 'deposit_confirmed': 1,
+         'deposit_amount': 42, 'deposit_date': '2026-01-02 00:00:00'},
+        {'user_id': 3},
+    ])
+    post(run, client, message_update(1, ab.ADMIN_ID, '/stats'))
+    text = run(wait_sent(stub_api, 1))[0]['text']
+    assert text.startswith('Всего пользователей: 3\nЗарегистрировано: 2\nС депозитом: 1\nСумма депозитов: 42.0')